@@ -5,10 +5,35 @@
 
 
 import argparse
+import bisect
 import collections
+import contextlib
+import copy
+import cProfile
+import cStringIO
+import fractions
+import hashlib
+import heapq
+import json
+import logging
+import multiprocessing
+import os
 import random
+import shutil
+import sqlite3
 import sys
+import tempfile
+import time
+import xml.parsers.expat
 import xmltodict
+import zipfile
+
+try:
+    import numpy as np
+except ImportError: # analysis falls back to calculate_value_for_bin() one bin at a time
+    np = None
+
+log = logging.getLogger('scatlava')
 
 # Calculate onset density (d), syncopation value (s), and
 # interdependence/coordination value (c) for a bin.
@@ -29,107 +54,85 @@ def calculate_difficulty_from_values(d, s, c, w={'d': 0.33, 's': 0.34, 'c': 0.33
     return ( (d*w['d']) + (s*w['s']) + (c*w['c']) )
 
 
-# Adjust the bin! (recursive)
+# Adjust the bin! (iterative)
 #   - bin to adjust
-#   - bin_duration in MusicXML format (1024 = whole note)
+#   - bin_duration in MusicXML divisions (see Meter)
 #   - bin_divisions: total number of bins in a measure
 #   - target_difficulty (0 to 1, expressed as a ratio to current bin difficulty)
 #   - weights in form {'d': x, 's': y, 'c': z}, where x+y+z = 1 and 0 < x,y,z < 1
 #   - gradients in same form as above
-#   - i (index of current adjustment run)
-def adjust_bin(bin, bin_duration, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, i=0):
-    bin_values = calculate_values_for_bin(bin, bin_duration, bin_divisions)
-    cur_difficulty = calculate_difficulty_from_values(bin_values['density'], bin_values['syncopation'], bin_values['coordination'], weights)
-    print '{} -> values: {}, difficulty: {}'.format(i, bin_values, cur_difficulty)
-
-    if cur_difficulty < target_difficulty:
-        print 'cur_difficulty {} < target_difficulty {}; returning'.format(cur_difficulty, target_difficulty)
-        return bin
-    elif i > 10: # 10 pretty much guarantees we've hit the bottom
-        print 'max runs exceeded! cur_difficulty={}, target_difficulty={}'.format(cur_difficulty, target_difficulty)
-        return bin
-    else:
-        # print 'adjusting bin...'
-        bin = adjust_density(bin, bin_values['density'], gradients['d'], stochastic_modifier, i)
-        bin = adjust_syncopation(bin, bin_values['syncopation'], gradients['s'], stochastic_modifier, i)
-        bin = adjust_coordination(bin, bin_values['coordination'], gradients['c'], stochastic_modifier, i)
-        # bin = adjust_for_rests(bin)
-        return adjust_bin(bin, bin_duration, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, i+1)
+#   - max_iterations: number of adjustment runs before we give up (11 pretty much guarantees we've hit the bottom)
+#   - rng: random number generator to use (the random module or a random.Random)
+# The bin's values are looked up in the bin memo (see analyze_bins()); after each run
+# only the notes the adjustments changed are rescored (see BinScore). The bin passed in
+# is never modified: it is copied before the first adjustment, and returned as is if
+# it needs none.
+def adjust_bin(bin, bin_duration, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, max_iterations=11, rng=random):
+    bin_values = analyze_bins([bin], bin_duration, bin_divisions)[0]
+    score = None
+    i = 0
+    debug = log.isEnabledFor(logging.DEBUG)
+    while True:
+        cur_difficulty = calculate_difficulty_from_values(bin_values['density'], bin_values['syncopation'], bin_values['coordination'], weights)
+        if debug:
+            log.debug('%s -> values: %s, difficulty: %s', i, bin_values, cur_difficulty)
+
+        if cur_difficulty < target_difficulty:
+            if debug:
+                log.debug('cur_difficulty %s < target_difficulty %s; returning', cur_difficulty, target_difficulty)
+            metrics.count_bin(i, bin.changes if score is not None else (), False, i+1)
+            return bin
+        elif i >= max_iterations:
+            if debug:
+                log.debug('max runs exceeded! cur_difficulty=%s, target_difficulty=%s', cur_difficulty, target_difficulty)
+            metrics.count_bin(i, bin.changes if score is not None else (), True, i+1)
+            return bin
+
+        if score is None:
+            bin = bin.copy()
+            score = BinScore(bin, bin_duration, bin_divisions)
+        bin = adjust_density(bin, bin_values['density'], gradients['d'], stochastic_modifier, i, rng)
+        bin = adjust_syncopation(bin, bin_values['syncopation'], gradients['s'], stochastic_modifier, i, rng)
+        bin = adjust_coordination(bin, bin_values['coordination'], gradients['c'], stochastic_modifier, i, rng)
+        score.update()
+        bin_values = score.values()
+        i += 1
 
 # 5.1: Adjust onset density
-def adjust_density(bin, d, g, sm, i):
+def adjust_density(bin, d, g, sm, i, rng=random):
     # return d - g
     adjusted_bin = bin
     # adjust = random.choice([True, False])
-    adjust = random.random() < sm
+    adjust = rng.random() < sm
     if (i*g >= 1) and adjust:
         # adjusted_bin = bin[:1] # get first element only
-        filtered_bin = filter_bin(adjusted_bin)
-        # print filtered_bin
-        # filtered_bin_size = reduce(lambda x, y: 1 if x['@default-x'] != y['@default-x'] else 0, filtered_bin, 0)
-        filtered_bin_size = get_polyphonic_bin_density(filtered_bin)
-        # print filtered_bin
+        filtered_bin_size = get_polyphonic_bin_density(adjusted_bin)
 
         # always remove one note if we have more than one note
         if filtered_bin_size > 1 and len(adjusted_bin) > 1:
-            bi = random.randint(1, len(adjusted_bin) - 1) # we avoid removing the first note
-            adjusted_bin[bi]['rest'] = None
+            bi = rng.randint(1, len(adjusted_bin) - 1) # we avoid removing the first note
+            adjusted_bin.set_rest(bi)
 
             # todo: adjust (reverse tripletize) if it was a triplet and now is eighth note!
             #       and adjust for rests? or that can come later
         else:
-            print 'only {} elements in filtered bin (though adjusted bin has {} elements)'.format(len(filtered_bin), len(adjusted_bin))
+            log.debug('only %s onsets in bin (though bin has %s elements)', filtered_bin_size, len(adjusted_bin))
 
-        print 'density adjusted for run {}'.format(i)
+        log.debug('density adjusted for run %s', i)
     return adjusted_bin
 
 # 5.2: Adjust syncopation
-def adjust_syncopation(bin, s, g, sm, i):
+def adjust_syncopation(bin, s, g, sm, i, rng=random):
     # return s - g
     # dice = random.random()
     # adjust = dice < s # the more syncopated a bin already is, the greater chance of adjustment
     # adjust = True
     # adjust = random.choice([True, False])
-    adjust = random.random() < sm
+    adjust = rng.random() < sm
     adjusted_bin = bin
     # print s
     if i*g >= 1 and adjust:
-        filtered_bin = filter_bin(adjusted_bin)
-        first_note = adjusted_bin[0]
-        first_onset_index = -1
-        oi = 0
-        simultaneous_first_onsets_offset = 1
-
-        # find the first onset index
-        while first_onset_index < 0 and oi < len(adjusted_bin):
-            note = adjusted_bin[oi]
-            if is_onset_note(note):
-                first_onset_index = oi
-            oi += 1
-
-        # swap first note with first onset
-        adjusted_bin = swap(adjusted_bin, 0, first_onset_index)
-
-        # swap any simultaneous onsets corresponding to the new first onset
-        while simultaneous_first_onsets_offset > 0 and first_onset_index + simultaneous_first_onsets_offset < len(adjusted_bin):
-            si = first_onset_index + simultaneous_first_onsets_offset
-            note = adjusted_bin[si]
-            
-            if is_onset_note(note):
-                first_x = adjusted_bin[0]['@default-x']
-                note_x = note['@default-x']
-                print '{},{}'.format(first_x, note_x)
-                if note_x == first_x:
-                    swap(adjusted_bin, simultaneous_first_onsets_offset, si)
-                    simultaneous_first_onsets_offset += 1
-                else:
-                    simultaneous_first_onsets_offset = -1
-            else:
-                simultaneous_first_onsets_offset = -1
-
-
-        # some engraving prettifying
-        adjusted_bin[0]['beam'] = None
+        move_first_onset(adjusted_bin)
 
         # todo: adjust subdivision? esp for 8th triplets and such
 
@@ -138,25 +141,55 @@ def adjust_syncopation(bin, s, g, sm, i):
         # for ni, note in enumerate(adjusted_bin):
         #     if is_valid_note(note) and 'rest' not in note:
 
-        print 'syncopation adjusted for run {}'.format(i)
+        log.debug('syncopation adjusted for run %s', i)
     return adjusted_bin
 
+# Move a bin's first onset, along with the rest of its chord (onsets first), to the start
+# of the bin, the notes before it following in the same order. Chords stay together, so
+# the bin can be written out as it is (see set_measure_bins()).
+def move_first_onset(bin):
+    first_onset_index = -1
+    oi = 0
+
+    # find the first onset index
+    while first_onset_index < 0 and oi < len(bin):
+        note = bin[oi]
+        if is_onset_note(note):
+            first_onset_index = oi
+        oi += 1
+    if first_onset_index < 0:
+        return
+
+    # bring its chord to the front one note at a time, onsets first
+    notes = list(bin)
+    first_chord = bin[first_onset_index].chord
+    members = [note for note in bin if note.chord == first_chord]
+    members = [note for note in members if is_onset_note(note)] + [note for note in members if not is_onset_note(note)]
+    for mi, member in enumerate(members):
+        ni = next(ni for ni, note in enumerate(bin) if note is member)
+        for si in xrange(ni, mi, -1):
+            bin.swap_notes(si-1, si)
+
+    # some engraving prettifying: the notes that moved lose their beams
+    for ni, note in enumerate(bin):
+        if note is not notes[ni]:
+            bin.clear_beam(ni)
+
 # 5.3: Adjust coordination
-def adjust_coordination(bin, c, g, sm, i):
+def adjust_coordination(bin, c, g, sm, i, rng=random):
     # return c - g
     adjusted_bin = bin
     adjusted = False
     # adjust = random.choice([True, False])
-    adjust = random.random() < sm
+    adjust = rng.random() < sm
     if (i*g >= 1) and adjust:
         # make sure there are actual onsets in the bin
-        filtered_bin = filter_bin(adjusted_bin)
-        if len(filtered_bin) < 1:
+        if adjusted_bin.num_onsets < 1:
             return adjusted_bin
 
         # adjust one note
         while not adjusted: 
-            ni = random.randint(0, len(adjusted_bin)-1)
+            ni = rng.randint(0, len(adjusted_bin)-1)
             note = adjusted_bin[ni]
             if is_onset_note(note):
                 subsequent_onsets = filter_bin(adjusted_bin[ni:])
@@ -165,70 +198,382 @@ def adjust_coordination(bin, c, g, sm, i):
                 # change note to next note
                 if len(subsequent_onsets) > 0 and len(previous_onsets) > 0: # choose between next and prev note
                     note_choices = [subsequent_onsets[0], previous_onsets[0]]
-                    note = update_pitch(note, random.choice(note_choices))
+                    note = adjusted_bin.set_pitch(ni, rng.choice(note_choices))
                     adjusted = True
                 elif len(subsequent_onsets) > 0: # next note
-                    note = update_pitch(note, subsequent_onsets[0])
+                    note = adjusted_bin.set_pitch(ni, subsequent_onsets[0])
                     adjusted = True
                 elif len(previous_onsets) > 0: # prev note
-                    note = update_pitch(note, previous_onsets[0])
+                    note = adjusted_bin.set_pitch(ni, previous_onsets[0])
                     adjusted = True
 
                 # and remove a simultaneous note
                 if adjusted:
                     # remove_simultaneous_note = random.choice([True, False])
-                    remove_simultaneous_note = random.random() < sm
+                    remove_simultaneous_note = rng.random() < sm
                     # remove_simultaneous_note = True
-                    if remove_simultaneous_note and ni < len(adjusted_bin)-1:
+                    if remove_simultaneous_note and ni < len(adjusted_bin)-1 and adjusted_bin.chord_size(note.chord) > 1:
                         next_note = adjusted_bin[ni+1]
-                        if is_onset_note(next_note) and next_note['@default-x'] == note['@default-x']: # simultaneous
-                            adjusted_bin = adjusted_bin[:ni] + adjusted_bin[ni+1:]
+                        if is_onset_note(next_note) and next_note.chord == note.chord: # simultaneous
+                            adjusted_bin.remove_note(ni+1)
 
 
             adjusted_bin[ni] = note
 
-        print 'coordination adjusted for run {}'.format(i)
+        log.debug('coordination adjusted for run %s', i)
     return adjusted_bin
 
 
+# Adjust the bin by searching through candidate edits (see get_candidate_edits()) instead
+# of applying random ones, scoring every candidate against the difficulty model.
+#   - strategy: 'greedy' takes the first edit that makes the bin easier, 'beam' keeps
+#     the beam_width easiest bins at every step and expands all of them
+#   - budget: maximum number of candidates to score (metric evaluations) for the bin
+# Stops as soon as a candidate is below target_difficulty (with 'beam', the one closest
+# to it) and otherwise returns the easiest bin found. As with adjust_bin(), the bin
+# passed in is never modified.
+def search_bin(bin, bin_duration, bin_divisions, target_difficulty, weights, strategy='greedy', budget=64, beam_width=2):
+    def evaluate(bin):
+        values = analyze_bins([bin], bin_duration, bin_divisions)[0]
+        return calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights)
+
+    evaluations = 1
+    best = (evaluate(bin), bin)
+    beam = [best]
+    seen = set([get_bin_signature(bin, bin_duration, bin_divisions)])
+    steps = 0
+    while best[0] >= target_difficulty and beam and evaluations < budget:
+        steps += 1
+        candidates = []
+        for difficulty, state in beam:
+            for edit in get_candidate_edits(state):
+                if evaluations >= budget:
+                    break
+                candidate = state.copy()
+                candidate.changes = list(state.changes)
+                apply_edit(candidate, edit)
+                signature = get_bin_signature(candidate, bin_duration, bin_divisions)
+                if signature in seen:
+                    continue
+                seen.add(signature)
+                evaluations += 1
+                candidates.append((evaluate(candidate), candidate))
+                if strategy == 'greedy' and candidates[-1][0] < difficulty:
+                    break
+            if strategy == 'greedy' and candidates and candidates[-1][0] < difficulty:
+                break
+
+        candidates.sort(key=lambda candidate: candidate[0])
+        reached = [candidate for candidate in candidates if candidate[0] < target_difficulty]
+        if reached:
+            best = reached[-1]
+            break
+        if strategy == 'greedy':
+            beam = [candidate for candidate in candidates if candidate[0] < beam[0][0]][:1]
+        else:
+            beam = candidates[:beam_width]
+        if beam and beam[0][0] < best[0]:
+            best = beam[0]
+
+    difficulty, bin = best
+    log.debug('%s search: difficulty %s (target %s) after %s steps, %s evaluations', strategy, difficulty, target_difficulty, steps, evaluations)
+    metrics.count_bin(steps, bin.changes, difficulty >= target_difficulty, evaluations)
+    return bin
+
+# Edits that could make a bin easier, most promising first
+#   - ('remove', i): drop note i, which is simultaneous with an earlier note
+#   - ('rest', i): turn onset i into a rest (never the first note or the last onset)
+#   - ('pitch', i, j): play onset i on onset j's instrument (merging limbs)
+#   - ('move',): move the first onset to the start of the bin (see move_first_onset())
+def get_candidate_edits(bin):
+    edits = []
+    onsets = [ni for ni, note in enumerate(bin) if is_onset_note(note)]
+    for oi, ni in enumerate(onsets):
+        note = bin[ni]
+        if oi > 0 and bin[onsets[oi-1]].chord == note.chord:
+            edits.append(('remove', ni))
+    if bin.num_onset_chords > 1:
+        edits += [('rest', ni) for ni in onsets if ni > 0]
+    for oi, ni in enumerate(onsets):
+        instrument = bin[ni].instrument
+        for nj in onsets[oi-1:oi] + onsets[oi+1:oi+2]: # previous and next onset
+            if nj != ni and bin[nj].instrument != instrument:
+                edits.append(('pitch', ni, nj))
+    if bin and not is_onset_note(bin[0]) and onsets:
+        edits.append(('move',))
+    return edits
+
+# Apply an edit from get_candidate_edits() to a bin
+def apply_edit(bin, edit):
+    if edit[0] == 'remove':
+        bin.remove_note(edit[1])
+    elif edit[0] == 'rest':
+        bin.set_rest(edit[1])
+    elif edit[0] == 'pitch':
+        bin.set_pitch(edit[1], bin[edit[2]])
+    elif edit[0] == 'move':
+        move_first_onset(bin)
+    return bin
+
+# Relative cost of each kind of edit (see get_candidate_edits()) for plan_bins()
+edit_costs = {
+    'remove': 1.,
+    'rest': 1.,
+    'pitch': 1.,
+    'move': 2. # moves every note before the first onset
+}
+
+# Plan edits across many bins (e.g. all bins of a score) so that their total difficulty
+# drops to target_difficulty times what it was with as few edits (by edit_costs) as
+# possible: every bin offers its best next edit (most difficulty removed per cost), and
+# the best of all of them is applied until the target is reached. An edit that would
+# overshoot the target by more than it gets there gives way to the bin's best smaller
+# edit, if it has one. Bins that aren't needed to get there are left untouched. Bins
+# with the same signature (see get_bin_signature()) share their candidate evaluations.
+#   - bins: flat list of bins; bin_values: their values (see analyze_bins())
+#   - bin_duration: either one for all bins or a sequence with one per bin
+#   - budget: maximum number of candidates to evaluate for each edit of a bin
+# Returns the new bins (as a new list; the bins passed in aren't modified)
+def plan_bins(bins, bin_values, bin_duration, bin_divisions, target_difficulty, weights, budget=64):
+    bins = list(bins)
+    difficulties = [calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights) for values in bin_values]
+    remaining = (1 - target_difficulty) * sum(difficulties)
+    evaluations = [0] * len(bins)
+    steps = [0] * len(bins)
+    capped = [False] * len(bins)
+    candidate_gains = {} # signature -> [(gain, edit)] of every candidate edit
+
+    # Gains of the candidate edits of bin bi (only those within the budget if there
+    # are more); only complete lists are shared with bins of the same signature
+    def get_candidate_gains(bi):
+        bin = bins[bi]
+        bin_size = get_bin_size(bin_duration, bi)
+        signature = get_bin_signature(bin, bin_size, bin_divisions)
+        gains = candidate_gains.get(signature)
+        if gains is None:
+            edits = get_candidate_edits(bin)
+            if len(edits) > budget:
+                capped[bi] = True
+            gains = []
+            for edit in edits[:budget]:
+                evaluations[bi] += 1
+                values = analyze_bins([apply_edit(bin.copy(), edit)], bin_size, bin_divisions)[0]
+                gains.append((difficulties[bi] - calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights), edit))
+            if len(edits) <= budget:
+                candidate_gains[signature] = gains
+        return gains
+
+    # Best next edit for bin bi, as (gain per cost, gain, edit), of those that remove
+    # no more than max_gain; None if no edit makes it easier
+    def get_best_edit(bi, max_gain=None):
+        best = None
+        for gain, edit in get_candidate_gains(bi):
+            if gain > 0 and (max_gain is None or gain <= max_gain) and (best is None or gain / edit_costs[edit[0]] > best[0]):
+                best = (gain / edit_costs[edit[0]], gain, edit)
+        return best
+
+    heap = []
+    for bi in xrange(len(bins)):
+        best = get_best_edit(bi) if difficulties[bi] > 0 and remaining > 0 else None
+        if best is not None:
+            heap.append((-best[0], bi, best[1], best[2]))
+    heapq.heapify(heap)
+
+    while remaining > 0 and heap:
+        gain_per_cost, bi, gain, edit = heapq.heappop(heap)
+        if gain - remaining > remaining: # overshoots by more than it gets us; try a smaller edit
+            best = get_best_edit(bi, 2 * remaining)
+            if best is not None:
+                heapq.heappush(heap, (-best[0], bi, best[1], best[2]))
+            continue
+        bin = bins[bi].copy()
+        bin.changes = list(bins[bi].changes)
+        bins[bi] = apply_edit(bin, edit)
+        difficulties[bi] -= gain
+        remaining -= gain
+        steps[bi] += 1
+        best = get_best_edit(bi)
+        if best is not None:
+            heapq.heappush(heap, (-best[0], bi, best[1], best[2]))
+
+    for bi, bin in enumerate(bins):
+        if evaluations[bi] or steps[bi]:
+            metrics.count_bin(steps[bi], bin.changes, capped[bi], evaluations[bi])
+    log.info('planned %s edits over %s bins, %s off the target', sum(steps), len([bi for bi in steps if bi]), remaining)
+    return bins
+
+# Replace a bin with the most similar bin from a corpus (see BinBank) that is easier than
+# target_difficulty and takes up the same time: real rhythms in place of edited ones,
+# found with one lookup instead of adjustment runs. A bin nothing in the corpus can
+# replace is searched with search_bin() ('greedy', within budget) instead.
+#   - bin_start: onset of the bin in its measure; divisions: of the measure (see Meter)
+#   - values: the bin's values (see analyze_bins())
+#   - bank: BinBank to retrieve from (bin_bank by default)
+# As with adjust_bin(), the bin passed in is never modified.
+def retrieve_bin(bin, bin_start, bin_size, divisions, bin_divisions, values, target_difficulty, weights, budget=64, bank=None):
+    bank = bank or bin_bank
+    specs = bank.find(bin, bin_start, bin_size, divisions, bin_divisions, values, target_difficulty, weights)
+    if specs is None:
+        log.debug('nothing to retrieve (target %s), searching instead', target_difficulty)
+        return search_bin(bin, bin_size, bin_divisions, target_difficulty, weights, 'greedy', budget)
+    new_bin = bin.copy()
+    new_bin.replace_notes(specs, divisions)
+    metrics.count_bin(1, new_bin.changes, False, 1)
+    return new_bin
+
+# k-d tree over points (tuples of floats) for nearest neighbour queries under
+# constraints: a subtree is skipped if its bounding box is farther away than the nearest
+# point found so far, or if bound() says no point in the box can qualify
+class KDTree(object):
+    leaf_size = 8
+
+    def __init__(self, points):
+        self.points = points
+        self.root = self.build(range(len(points))) if points else None
+
+    # Node: (lo, hi, indices, dimension, split, left, right), lo and hi being the
+    # corners of its bounding box; leaves have their points' indices, the others
+    # split on the widest dimension of their box
+    def build(self, indices):
+        points = self.points
+        lo = tuple(min(points[i][k] for i in indices) for k in xrange(len(points[0])))
+        hi = tuple(max(points[i][k] for i in indices) for k in xrange(len(points[0])))
+        if len(indices) <= self.leaf_size:
+            return (lo, hi, indices, None, None, None, None)
+        dimension = max(xrange(len(lo)), key=lambda k: hi[k] - lo[k])
+        indices.sort(key=lambda i: points[i][dimension])
+        mid = len(indices) / 2
+        return (lo, hi, None, dimension, points[indices[mid]][dimension], self.build(indices[:mid]), self.build(indices[mid:]))
+
+    # Index of the point nearest to point (by Euclidean distance) for which accept(i)
+    # is true, or None
+    #   - bound: bound(lo, hi) is false if no point within the box can be accepted
+    def nearest(self, point, accept=None, bound=None):
+        points = self.points
+        best = [float('inf'), None]
+
+        def search(node):
+            lo, hi, indices, dimension, split, left, right = node
+            box_distance = 0.
+            for x, l, h in zip(point, lo, hi):
+                if x < l:
+                    box_distance += (l - x) ** 2
+                elif x > h:
+                    box_distance += (x - h) ** 2
+            if box_distance >= best[0] or (bound is not None and not bound(lo, hi)):
+                return
+            if indices is not None:
+                for i in indices:
+                    distance = sum((x - y) ** 2 for x, y in zip(point, points[i]))
+                    if distance < best[0] and (accept is None or accept(i)):
+                        best[:] = [distance, i]
+                return
+            if point[dimension] < split:
+                search(left)
+                search(right)
+            else:
+                search(right)
+                search(left)
+
+        if self.root is not None:
+            search(self.root)
+        return best[1]
+
+# Bins of a corpus to retrieve from (see retrieve_bin()), as patterns (see
+# get_bin_pattern()) loaded from a scatlava_index.py index. Patterns are grouped by
+# bin_divisions and by the time they take up (bin size, start and end of their notes, in
+# whole notes), with a k-d tree per group over their d, s and c and rhythm features
+# (see get_rhythm_features()).
+class BinBank(object):
+    def __init__(self):
+        self.loaded = set() # (index path, bin_divisions)
+        self.groups = {} # (bin_divisions, size, start, end) -> (KDTree, units, patterns)
+
+    # Add the patterns an index holds for bin_divisions (unless they're loaded already)
+    def load(self, index_path, bin_divisions):
+        if (index_path, bin_divisions) in self.loaded:
+            return
+        if not os.path.exists(index_path):
+            raise IOError('no index at {}'.format(index_path))
+        db = sqlite3.connect(index_path)
+        try:
+            rows = db.execute('SELECT pattern, density, syncopation, coordination FROM patterns WHERE bin_divisions = ?', (bin_divisions,)).fetchall()
+        finally:
+            db.close()
+
+        groups = {}
+        for pattern, density, syncopation, coordination in rows:
+            unit, size, start, notes = json.loads(pattern)
+            unit = fractions.Fraction(unit)
+            key = (bin_divisions, unit * size, unit * start, unit * (start + notes[-1][0] + notes[-1][1]))
+            features = (density, syncopation, coordination) + get_rhythm_features([(offset, step is None, (step, octave)) for offset, duration, step, octave, notehead in notes])
+            points, units, patterns = groups.setdefault(key, ([], [], []))
+            points.append(features)
+            units.append(unit)
+            patterns.append(notes)
+        for key, (points, units, patterns) in groups.iteritems():
+            if key in self.groups:
+                tree, old_units, old_patterns = self.groups[key]
+                points, units, patterns = tree.points + points, old_units + units, old_patterns + patterns
+            self.groups[key] = (KDTree(points), units, patterns)
+        self.loaded.add((index_path, bin_divisions))
+        log.info('loaded %s bin patterns from %s', len(rows), index_path)
+
+    # Note specs (see Bin.replace_notes()) of the pattern most like a bin (by d, s, c and
+    # rhythm features) that takes up the same time, is easier than max_difficulty and
+    # only plays instruments the bin plays (so its notes can be written as the part's,
+    # see set_measure_bins()), in the bin's divisions; None if there is none
+    def find(self, bin, bin_start, bin_size, divisions, bin_divisions, values, max_difficulty, weights):
+        if not bin:
+            return None
+        whole = divisions * 4
+        start = bin[0].onset
+        end = bin[-1].onset + bin[-1].duration
+        group = self.groups.get((bin_divisions, fractions.Fraction(bin_size, whole), fractions.Fraction(start - bin_start, whole), fractions.Fraction(end - bin_start, whole)))
+        if group is None:
+            return None
+        tree, units, patterns = group
+        point = (values['density'], values['syncopation'], values['coordination']) + get_rhythm_features([(note.onset, note.rest, note.instrument) for note in bin])
+        instruments = set(instrument_names[note.instrument] for note in bin if not note.rest)
+
+        def accept(i):
+            density, syncopation, coordination = tree.points[i][:3]
+            return calculate_difficulty_from_values(density, syncopation, coordination, weights) < max_difficulty and (units[i] * whole).denominator == 1 and all(step is None or (step, octave) in instruments for offset, duration, step, octave, notehead in patterns[i])
+
+        # the easiest d, s and c in the box
+        def bound(lo, hi):
+            return sum(w * (l if w >= 0 else h) for w, l, h in zip([weights['d'], weights['s'], weights['c']], lo, hi)) < max_difficulty
+
+        i = tree.nearest(point, accept, bound)
+        if i is None:
+            return None
+        scale = int(units[i] * whole)
+        return [[offset * scale, duration * scale, step, octave, notehead] for offset, duration, step, octave, notehead in patterns[i]]
+
+    def stats(self):
+        return {
+            'patterns': sum(len(units) for tree, units, patterns in self.groups.itervalues()),
+            'groups': len(self.groups)
+        }
+
+bin_bank = BinBank()
+
 # Scale subdivisions up by one (so 16ths -> 8th triplets)
 # dummy for now
 def adjust_subdivisions(bin):
     return bin
 
-# Adjust note lengths
-def adjust_for_rests(bin):
-    adjusted_bin = bin
-    for i, note in enumerate(bin):
-        print 'note {}:'.format(i)
-        if is_valid_note(note):
-            new_note_duration = note['duration']
-            if i < len(bin)-1:
-                ni = i + 1
-                while is_valid_note(bin[ni]) and 'rest' in bin[ni] and ni < len(bin)-1:
-                    new_note_duration += bin[ni]['duration']
-                    bin[ni] = 'rest'
-                    # bin[ni]['rest'] = None
-                    ni += 1
-                note['duration'] = new_note_duration
-                bin[i] = note
-    return adjusted_bin
-
 # Strip rests from bin
 def filter_bin(bin):
     return filter(lambda note: is_onset_note(note), bin)
 
-# Determine whether a note is an onset (i.e. a valid non-rest)
+# Determine whether a note is an onset (i.e. a non-rest)
 def is_onset_note(note):
-    return is_valid_note(note) and 'rest' not in note
+    return not note.rest
 
-# Returns size of bin, treating simultaneous onsets as ONE single note
+# Returns number of onsets in bin, treating simultaneous onsets as ONE single note
 def get_polyphonic_bin_density(bin):
-    size = 0
-    for i, note in enumerate(bin):
-        if i == 0 or note['@default-x'] != bin[i-1]['@default-x']:
-            size += 1
-    return size
+    return bin.num_onset_chords
 
 # Swap two elements in a list
 def swap(bin, i, j):
@@ -239,81 +584,11 @@ def swap(bin, i, j):
 
 # Update the pitch of note to that of note_new
 def update_pitch(note, note_new):
-    note['unpitched']['display-step'] = note_new['unpitched']['display-step']
-    note['unpitched']['display-octave'] = note_new['unpitched']['display-octave']
-    if 'notehead' in note_new:
-        note['notehead'] = note_new['notehead']
-        # print '{} == {}'.format(note['notehead'], note_new['notehead'])
+    note.instrument = note_new.instrument
+    if note_new.notehead is not None:
+        note.notehead = note_new.notehead
     return note
 
-# Augmentation of a note, given several params
-def parse_note(note, prev_note, duration_min, duration_left):
-    print '{} left'.format(duration_left)
-    if is_valid_note(note): # otherwise it's a deleted and we ignore it
-
-        if 'rest' in note:
-            return note
-
-        # comparing durations to prev
-        duration = int(note['duration'])
-        prev_note_dur = int(prev_note['duration'])
-        diff = prev_note_dur - duration
-        # duration_error_margin = 10
-        print '{} - {} = {}'.format(prev_note_dur, duration, diff)
-
-        # comparing note equality from prev
-        same_note = False
-        if 'unpitched' in note and 'unpitched' in prev_note:
-            notename = to_note_name(note)
-            prev_notename = to_note_name(prev_note)
-            same_note = (notename == prev_notename)
-
-        if diff > 0: #and same_note:
-            print 'note of duration {} has been removed'.format(duration)
-            # return 'rest'
-            return diff
-
-        # testing
-        if 'dot' not in note:
-            # if 'time-modification' in note:
-            #     while duration < duration_min:
-            #         print '{} < {}'.format(duration, duration_min)
-            #         duration = int(duration * 1.5) # todo: smartly tripletize
-            # else:
-            #     while duration < duration_min:
-            #         print '{} < {}'.format(duration, duration_min)
-            #         duration = int(duration * 2)
-
-            while duration < duration_min: #and duration > duration_left:
-                print '{} < {}'.format(duration, duration_min)
-                if 'time-modification' in duration_to_note_attrs[duration]:
-                    duration = int(duration * 1.5)
-                else:
-                    duration = int(duration * 2)
-
-
-        note_attrs = duration_to_note_attrs[duration]
-
-        note['duration'] = str(duration)
-        note['type'] = note_attrs['type']
-        if 'dot' in note_attrs:
-            note['dot'] = note_attrs['dot']
-        else:
-            note.pop('dot', None)
-        if 'time-modification' in note_attrs['type']:
-            note['time-modification'] = note_attrs['time-modification']
-        else:
-            note.pop('time-modification', None)
-
-        note.pop('@default-x', None)
-
-        print '{}, {}'.format(note['duration'], note_attrs)
-    return note
-
-# Tripletize a note's duration
-def tripletize_duration(duration):
-    return duration*2/3
-
 # Create a data dict that can be debugged
 def make_data_document(data, label):
     return {'data': {
@@ -327,30 +602,10 @@ def debug_unparse(data, label):
 # def remove_rests(note):
     # return
 
-# Concatenates note pitch and octave
-def to_note_name(note):
-    if 'unpitched' not in note:
-        return 'B#0'
-    unpitched = note['unpitched']
-    return '{}{}'.format(unpitched['display-step'], unpitched['display-octave'])
-
 # Determines whether a note is valid and can be operated on. Includes valid rests
 def is_valid_note(note):
     return type(note) is dict or type(note) is collections.OrderedDict
 
-# Add two durations together
-def add_duration(x,y):
-    return x+y
-
-# Convert a note to a (valid) rest
-def note_to_rest(note):
-    rest = {
-        'rest': None,
-        'duration': note['duration'],
-        'type': note['type']
-    }
-    return rest
-
 # Determine the value of d, s, or c for a beat window (bin)
 def calculate_value_for_bin(bin, method, bin_size, bin_divisions=4, max_bin_granularity=32):
     value = 0
@@ -366,7 +621,7 @@ def calculate_value_for_bin(bin, method, bin_size, bin_divisions=4, max_bin_gran
             # value = value * bin_size / granularity
 
             # simplified calculation that accounts for rests
-            value = float(len([note for note in bin if 'rest' not in note])) / granularity
+            value = float(len([note for note in bin if not note.rest])) / granularity
     
 
     # Syncopation (using Keith's measure):
@@ -377,17 +632,17 @@ def calculate_value_for_bin(bin, method, bin_size, bin_divisions=4, max_bin_gran
         for ni, note in enumerate(bin):
             cur_note_on_beat = False
             next_note_on_beat = False
-            note_duration = int(note['duration']) if is_valid_note(note) else 0
+            note_duration = note.duration
             cur_value = 0
 
             # is this note on the beat?
-            if 'rest' not in note and cur_duration % bin_size == 0:
+            if not note.rest and cur_duration % bin_size == 0:
                 cur_note_on_beat = True
 
             # is the next note on the beat?
             if ni < len(bin) - 1:
                 next_note = bin[ni+1]
-                if 'rest' not in next_note and cur_duration + note_duration % bin_size == 0:
+                if not next_note.rest and cur_duration + note_duration % bin_size == 0:
                     next_note_on_beat = True
             else:
                 next_note_on_beat = True
@@ -415,29 +670,24 @@ def calculate_value_for_bin(bin, method, bin_size, bin_divisions=4, max_bin_gran
             cur_duration += note_duration
     
     elif method == 'COORDINATION':
-        # print bin[0].keys()
-        default_xs = [note['@default-x'] if is_valid_note(note) else None for note in bin]
-        # print default_xs
-        # print '{} vs {}'.format(len(default_xs), len(bin))
+        if not isinstance(bin, Bin):
+            bin = Bin(bin)
         num_notes = len(bin)
         value = 0
         max_simultaneous_limbs = 4 # RH, RF, LH, LF
 
         for ni, note in enumerate(bin):
             cur_value = 0
-            cur_note_name = to_note_name(note)
+            cur_note_name = note.instrument
             next_note_name = cur_note_name
             prev_note_name = cur_note_name
 
-            simultaneous_onsets = len(filter(lambda x: is_valid_note(note) and x == note['@default-x'], default_xs))
-            # print simultaneous_onsets
+            simultaneous_onsets = bin.chord_size(note.chord)
 
             if ni < num_notes - 1:
-                next_note = bin[ni+1]
-                next_note_name = to_note_name(next_note)
+                next_note_name = bin[ni+1].instrument
             if ni > 0:
-                prev_note = bin[ni-1]
-                prev_note_name = to_note_name(prev_note)
+                prev_note_name = bin[ni-1].instrument
 
             # score according to contextual note interdependence difficulty (CNID) measure
             if cur_note_name != next_note_name:
@@ -459,191 +709,2311 @@ def calculate_value_for_bin(bin, method, bin_size, bin_divisions=4, max_bin_gran
 
 # Return the total duration of a bin
 def get_total_bin_duration(bin):
-    return reduce(add_duration, [int(note['duration']) if is_valid_note(note) else 0 for note in bin], 0)
+    return sum(note.duration for note in bin)
 
 # Calculate the overall difficulty of a piece
-# TODO: refactor this! it is ugly and repetitive but works as a temporary measure
-def calculate_overall_difficulty(measures, weights):
+#   - meter: as with calculate_measure_difficulties()
+def calculate_overall_difficulty(measures, weights, meter=None):
     overall_difficulty = 0
-    for mi, measure in enumerate(measures):
-        # print measure
-        notes = measure['note']
-        prev_note_dur = 0
-        prev_note = {
-            'duration': '0',
-            'unpitched': {
-                'display-step': 'X',
-                'display-octave': '-1'
-            }
-        }
-        duration_left = 1024 # default measure length in 4/4
-        # print 'num notes before: {}'.format(len(notes))
-
-        # measure values
-        measure_density = 0
-        measure_syncopation = 0
-        measure_coordination = 0
-        measure_difficulty_original = 0
-        measure_difficulty_new = 0
-
-
-        # another approach: binning
-        bin_divisions = 1
-        bin_duration = duration_left / bin_divisions
-        cur_bin_duration = bin_duration
-        bin_i = 0
-        bins = [ [] for i in xrange(bin_divisions) ]
-
-        # separate notes into bins by beat
-        prev_x = 0
-        for ni, note in enumerate(notes):
-            if is_valid_note(note) and 'duration' in note:
-                if ni < len(notes)-1 and note['@default-x'] != notes[ni+1]['@default-x']: # don't increment duration if it's simultaneous onset
-                    cur_bin_duration -= int(note['duration'])
-                bins[bin_i].append(note)
-                prev_x = note['@default-x']
-            if cur_bin_duration <= 0:
-                # print cur_bin_duration
-                bin_i = min(bin_i+1, len(bins)-1)
-
-                while cur_bin_duration < 0: # in cases where a note is longer than a bin size
-                    bin_i = min(bin_i+1, len(bins)-1)
-                    cur_bin_duration += bin_duration
-
-                cur_bin_duration = bin_duration
-
-        # output analysis to validate correct binning
-        for bi, bin in enumerate(bins):
-            total_duration = get_total_bin_duration(bin)
-            bin_density = calculate_value_for_bin(bin, 'DENSITY', bin_duration, bin_divisions)
-            bin_keith = calculate_value_for_bin(bin, 'SYNCOPATION_KEITH', bin_duration, bin_divisions)
-            bin_coordination = calculate_value_for_bin(bin, 'COORDINATION', bin_duration, bin_divisions)
-            difficulty = calculate_difficulty_from_values(bin_density, bin_keith, bin_coordination, weights)
-
-            measure_density += bin_density / bin_divisions
-            measure_syncopation += bin_keith / bin_divisions
-            measure_coordination += bin_coordination / bin_divisions
-            measure_difficulty_original += difficulty / bin_divisions
-
-            # print 'measure {} beat {}: {} notes, total_duration={}, bin_density={}, bin_keith={}, bin_coordination={}, difficulty={}'.format(mi+1, bi+1, len(bin), total_duration, bin_density, bin_keith, bin_coordination, difficulty)
-
-        # print 'measure {} overall d={}, s={}, c={}, D={} (b={})'.format(mi+1, measure_density, measure_syncopation, measure_coordination, measure_difficulty_original, bin_divisions)
-
-        overall_difficulty += measure_difficulty_original/len(measures)
-
+    for measure_difficulty in calculate_measure_difficulties(measures, weights, 1, meter):
+        overall_difficulty += measure_difficulty/len(measures)
     return overall_difficulty
 
+# Calculate the difficulty of each measure of a piece, in one pass over the whole piece
+# (treating each whole measure as one bin by default)
+#   - meter: Meter in effect before the first measure (see get_measure_meter()), or a
+#     list with the Meter of every measure (see get_measure_meters())
+def calculate_measure_difficulties(measures, weights, bin_divisions=1, meter=None):
+    values = analyze_measures(measures, bin_divisions, meter)
+    return [calculate_measure_difficulty_from_values(values[mi*bin_divisions:(mi+1)*bin_divisions], weights, bin_divisions) for mi in xrange(len(measures))]
+
+# Calculate the overall difficulty of a piece from the values of all of its bins
+# (bin_divisions bins per measure, e.g. from analyze_measures() or an AnalysisCache)
+def calculate_overall_difficulty_from_values(score_values, weights, bin_divisions):
+    num_measures = len(score_values) / bin_divisions
+    overall_difficulty = 0
+    for mi in xrange(num_measures):
+        measure_difficulty = calculate_measure_difficulty_from_values(score_values[mi*bin_divisions:(mi+1)*bin_divisions], weights, bin_divisions)
+        overall_difficulty += measure_difficulty/num_measures
+    return overall_difficulty
 
-# Default duration -> note_attrs for MusicXML construction and analysis
-# NOTE: here we only support up to 32nd notes
-duration_to_note_attrs = {
-    #32nds
-    32: {'type': '32nd'},
-
-    # 16th triplets
-    42: {
-        'type': '16th',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': '16th'
-        }
-    },
-    43: {
-        'type': '16th',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': '16th'
-        }
-    },
-
-    # 16ths
-    63: {'type': '16th'}, # rounding
-    64: {'type': '16th'},
-
-    # dotted 16ths
-    96: {'type': '16th', 'dot': ''},
-
-    # 8th triplets
-    84: {  # rounding
-        'type': 'eighth',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': 'eighth'
+# Overall difficulty of every part of a score, from values of the whole score (parts
+# one after another, see get_score_measures())
+#   - values: report key -> (values of every bin, bins per measure), e.g.
+#     {'overall_difficulty': (score_values, 4), 'overall_difficulty_by_measure': (measure_values, 1)}
+# Returns a dict per part with its id, number of measures and a difficulty per key
+def report_parts(parts, weights, values):
+    reports = []
+    for part_id, start, end in parts:
+        report = {'part': part_id, 'measures': end - start}
+        for key, (part_values, bin_divisions) in values.iteritems():
+            report[key] = calculate_overall_difficulty_from_values(part_values[start*bin_divisions:end*bin_divisions], weights, bin_divisions)
+        reports.append(report)
+    return reports
+
+# Bin all measures of a piece and calculate d, s, and c for each bin
+# Returns one dict of values per bin (bin_divisions per measure)
+def analyze_measures(measures, bin_divisions, meter=None):
+    return ScoreLevels(measures, [bin_divisions], keep_source=False, meter=meter).get_values(bin_divisions)
+
+# Calculate the difficulty of a single measure, treating the whole measure as one bin
+def calculate_measure_difficulty(measure, weights, bin_divisions=1, meter=None):
+    return calculate_measure_difficulties([measure], weights, bin_divisions, meter)[0]
+
+# Combine the values of a measure's bins into the measure's difficulty
+def calculate_measure_difficulty_from_values(bin_values, weights, bin_divisions):
+    measure_difficulty = 0
+    for values in bin_values:
+        difficulty = calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights)
+        measure_difficulty += difficulty / bin_divisions
+    return measure_difficulty
+
+# Calculate d, s, and c for a list of bins (e.g. all bins of a score)
+# Bins whose rhythmic signature is in the bin memo aren't analyzed again, and bins that
+# share a signature are only analyzed once. The rest go through the vectorized
+# calculate_values_for_bins() if numpy is available (and there are enough of them).
+#   - bin_duration: either one for all bins or a sequence with one per bin
+# Returns one dict per bin, as with calculate_values_for_bin(); bins with the same
+# signature share their dict, so don't modify them.
+def analyze_bins(bins, bin_duration, bin_divisions):
+    signatures = [get_bin_signature(bin, get_bin_size(bin_duration, bi), bin_divisions) for bi, bin in enumerate(bins)]
+    bin_values = [bin_memo.get(signature) for signature in signatures]
+
+    missing = {} # signature -> bin to analyze it with
+    for bi, values in enumerate(bin_values):
+        if values is None and signatures[bi] not in missing:
+            missing[signatures[bi]] = bins[bi]
+    if not missing:
+        return bin_values
+
+    missing_signatures = missing.keys()
+    missing_bins = [missing[signature] for signature in missing_signatures]
+    missing_sizes = [signature[0] for signature in missing_signatures]
+    if np is None or len(missing_bins) < 8:
+        missing_values = [calculate_values_for_bin(bin, missing_sizes[bi], bin_divisions) for bi, bin in enumerate(missing_bins)]
+    else:
+        densities, syncopations, coordinations = calculate_values_for_bins(missing_bins, missing_sizes, bin_divisions)
+        missing_values = [{
+            'density': d,
+            'syncopation': s,
+            'coordination': c
+        } for d, s, c in zip(densities.tolist(), syncopations.tolist(), coordinations.tolist())]
+
+    analyzed = dict(zip(missing_signatures, missing_values))
+    for signature, values in analyzed.iteritems():
+        bin_memo.put(signature, values)
+    return [values if values is not None else analyzed[signatures[bi]] for bi, values in enumerate(bin_values)]
+
+# Size of bin bi, from either one size for all bins or a sequence with one per bin
+def get_bin_size(bin_size, bi):
+    if isinstance(bin_size, (list, tuple)):
+        return bin_size[bi]
+    return bin_size
+
+# Canonical rhythmic signature of a bin: everything its values depend on (onsets relative
+# to the bin, durations, rests, instruments and which notes are simultaneous, plus
+# bin_size and bin_divisions) but no engraving details like default-x, so that repeated
+# patterns (comping, ride figures, fills...) share a signature.
+def get_bin_signature(bin, bin_size, bin_divisions):
+    chords = {}
+    start = bin[0].onset if bin else 0
+    return (bin_size, bin_divisions) + tuple([(note.onset - start, note.duration, note.rest, note.instrument, chords.setdefault(note.chord, len(chords))) for note in bin])
+
+# Pattern of a bin, for a corpus of bins to retrieve from (see BinBank): where its notes
+# fall, in units of the greatest common divisor of their offsets, their durations and
+# the bin's size, and what they are
+#   - bin_start: onset of the bin (its first note may come later)
+#   - divisions: divisions of the bin's measure (see Meter)
+# Returns [unit, bin size, start, notes] with the unit as a fraction of a whole note
+# (a string), the start of the first note in the bin and [offset, duration, step, octave,
+# notehead] of every note (offsets from the first note, as in Bin.replace_notes()), or
+# None if the bin is empty or its notes don't follow one another
+def get_bin_pattern(bin, bin_start, bin_size, divisions):
+    if not bin:
+        return None
+    start = bin[0].onset
+    ticks = [bin_size, start - bin_start]
+    notes = []
+    prev_note = None
+    for note in bin:
+        if note.duration <= 0 or (prev_note is not None and note.onset not in (prev_note.onset, prev_note.onset + prev_note.duration)):
+            return None
+        step, octave = (None, None) if note.rest else instrument_names[note.instrument]
+        notes.append([note.onset - start, note.duration, step, octave, note.notehead])
+        ticks += [note.onset - start, note.duration]
+        prev_note = note
+    unit = reduce(fractions.gcd, ticks)
+    for note in notes:
+        note[0] /= unit
+        note[1] /= unit
+    return [str(fractions.Fraction(unit, divisions * 4)), bin_size / unit, (start - bin_start) / unit, notes]
+
+# Features of a bin's rhythm besides d, s and c, for finding similar bins (see BinBank):
+# the share of rests, the mean number of onsets per onset position and the number of
+# distinct instruments (limbs), the last two out of 4
+#   - notes: (offset, rest, instrument) of every note
+def get_rhythm_features(notes):
+    if not notes:
+        return (0., 0., 0.)
+    onsets = [(offset, instrument) for offset, rest, instrument in notes if not rest]
+    num_chords = len(set(offset for offset, instrument in onsets))
+    return (
+        float(len(notes) - len(onsets)) / len(notes),
+        float(len(onsets)) / num_chords / 4 if num_chords else 0.,
+        len(set(instrument for offset, instrument in onsets)) / 4.
+    )
+
+# Bounded in-process LRU memo of bin values, keyed by rhythmic signature
+# (see get_bin_signature()), with hit/miss counters
+class BinMemo(object):
+    def __init__(self, max_size=16384):
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, signature):
+        values = self.entries.pop(signature, None)
+        if values is None:
+            self.misses += 1
+            return None
+        self.entries[signature] = values # most recently used go last
+        self.hits += 1
+        return values
+
+    def put(self, signature, values):
+        if self.max_size <= 0:
+            return
+        self.entries.pop(signature, None)
+        self.entries[signature] = values
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.,
+            'entries': len(self.entries),
+            'max_size': self.max_size
         }
-    },
-    85: {
-        'type': 'eighth',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': 'eighth'
+
+bin_memo = BinMemo()
+
+# Vectorized version of calculate_value_for_bin() for DENSITY, SYNCOPATION_KEITH and
+# COORDINATION over many bins at once. The bins' notes are flattened into arrays and
+# each measure is reduced per bin with np.bincount, so the result is exactly the same
+# as calling calculate_value_for_bin() on each bin.
+#   - bins: list of Bins
+#   - bin_size: bin duration, either one for all bins or a sequence with one per bin
+# Returns arrays of densities, syncopations and coordinations (one value per bin)
+def calculate_values_for_bins(bins, bin_size, bin_divisions=4, max_bin_granularity=32):
+    bin_lengths = np.array([len(bin) for bin in bins], dtype=np.int64)
+    num_notes = int(bin_lengths.sum())
+
+    # flatten
+    durations = np.empty(num_notes, dtype=np.int64)
+    rests = np.empty(num_notes, dtype=bool)
+    instruments = np.empty(num_notes, dtype=np.int64)
+    simultaneous_onsets = np.empty(num_notes, dtype=np.int64)
+    ni = 0
+    for bin in bins:
+        chords = bin.chords
+        for note in bin:
+            durations[ni] = note.duration
+            rests[ni] = note.rest
+            instruments[ni] = note.instrument
+            simultaneous_onsets[ni] = len(chords[note.chord])
+            ni += 1
+
+    return calculate_values_for_notes(durations, rests, instruments, simultaneous_onsets, bin_lengths, bin_size, bin_divisions, max_bin_granularity)
+
+# calculate_values_for_bins() on notes that are already flattened into arrays, in bin
+# order (see ScoreSnapshot)
+#   - simultaneous_onsets: size of each note's chord group
+#   - bin_lengths: number of notes in each bin
+def calculate_values_for_notes(durations, rests, instruments, simultaneous_onsets, bin_lengths, bin_size, bin_divisions=4, max_bin_granularity=32):
+    num_bins = len(bin_lengths)
+    num_notes = len(durations)
+    granularity = max_bin_granularity / bin_divisions
+    if num_notes == 0:
+        return np.zeros(num_bins), np.zeros(num_bins), np.zeros(num_bins)
+
+    bin_ids = np.repeat(np.arange(num_bins), bin_lengths)
+    bin_starts = np.cumsum(bin_lengths) - bin_lengths
+    note_bin_lengths = bin_lengths[bin_ids].astype(np.float64)
+    first = np.arange(num_notes) == bin_starts[bin_ids]
+    last = np.arange(num_notes) == bin_starts[bin_ids] + bin_lengths[bin_ids] - 1
+    bin_sizes = np.broadcast_to(np.asarray(bin_size, dtype=np.int64), (num_bins,))[bin_ids]
+
+    # Onset density
+    onsets = np.bincount(bin_ids, weights=~rests, minlength=num_bins)
+    total_durations = np.bincount(bin_ids, weights=durations, minlength=num_bins)
+    densities = np.where(total_durations > 0, onsets / granularity, 0.)
+
+    # Keith's syncopation measure
+    cur_durations = np.cumsum(durations) - durations # duration before each note...
+    cur_durations -= cur_durations[bin_starts[bin_ids]] # ...within its bin
+    cur_on_beat = ~rests & (cur_durations % bin_sizes == 0)
+    next_rests = np.append(rests[1:], True)
+    next_on_beat = last | (~next_rests & (cur_durations + durations % bin_sizes == 0))
+    keith_values = np.where(next_on_beat, np.where(cur_on_beat, 0, 1), np.where(cur_on_beat, 2, 3))
+    syncopations = np.bincount(bin_ids, weights=keith_values / 3. / note_bin_lengths, minlength=num_bins)
+
+    # Contextual note interdependence difficulty (CNID)
+    prev_instruments = np.where(first, instruments, np.roll(instruments, 1))
+    next_instruments = np.where(last, instruments, np.roll(instruments, -1))
+    cnid_values = (instruments != next_instruments).astype(np.int64) + (instruments != prev_instruments)
+    cnid_values += (prev_instruments != next_instruments) & (cnid_values > 0)
+    cnid_values += simultaneous_onsets / 4 # max simultaneous limbs (RH, RF, LH, LF)
+    coordinations = np.bincount(bin_ids, weights=cnid_values / 4. / note_bin_lengths, minlength=num_bins)
+
+    return densities, syncopations, coordinations
+
+# Compact internal representation of a note, used for analysis and generation instead
+# of xmltodict's OrderedDicts. Notes are converted back to MusicXML (to_dict) only when
+# a measure is written out.
+#   - onset: onset tick within the measure (simultaneous notes share an onset)
+#   - duration in MusicXML format
+#   - instrument: instrument (limb) id, see get_instrument_id()
+#   - rest: whether the note is a rest
+#   - chord: chord group id; notes played simultaneously share a chord id
+#   - notehead: notehead to write out (None for default)
+#   - clear_beam: whether to strip the note's beam on output
+#   - spec: whether the note was made from a note spec (see make_spec_notes()) rather
+#     than parsed from its measure
+#   - source: the OrderedDict the note was parsed from or, for notes loaded from a
+#     ScoreSnapshot, the note's index among its measure's notes (see to_dict())
+class Note(object):
+    __slots__ = ('onset', 'duration', 'instrument', 'rest', 'chord', 'notehead', 'clear_beam', 'spec', 'source')
+
+    def __init__(self, onset, duration, instrument, rest=False, chord=0, notehead=None, source=None):
+        self.onset = onset
+        self.duration = duration
+        self.instrument = instrument
+        self.rest = rest
+        self.chord = chord
+        self.notehead = notehead
+        self.clear_beam = False
+        self.spec = False
+        self.source = source
+
+    def copy(self):
+        note = Note(self.onset, self.duration, self.instrument, self.rest, self.chord, self.notehead, self.source)
+        note.clear_beam = self.clear_beam
+        note.spec = self.spec
+        return note
+
+    def __repr__(self):
+        return 'Note(onset={}, duration={}, instrument={}, rest={}, chord={})'.format(self.onset, self.duration, instrument_names[self.instrument], self.rest, self.chord)
+
+    # Convert back to an xmltodict OrderedDict, applying any changes made to the note.
+    # Unchanged notes return their source as is.
+    #   - sources: the xmltodict notes of the note's measure, for notes whose source is
+    #     an index into them
+    #   - chord: whether the note is written with <chord/> (see set_measure_bins())
+    #   - part_attrs: <instrument> and <voice> to write the note with, if it has none
+    #     (see get_part_note_attrs())
+    def to_dict(self, sources=None, chord=False, part_attrs=None):
+        source = self.get_source(sources)
+        if source is None:
+            source = collections.OrderedDict([('duration', str(self.duration))])
+
+        changed = {}
+        if chord != ('chord' in source):
+            changed['chord'] = chord
+        for key, value in (part_attrs or {}).iteritems():
+            if value is not None and key not in source:
+                changed[key] = value
+        if self.rest and 'rest' not in source:
+            changed['rest'] = None
+        if self.instrument != get_instrument_id_for_note(source) and self.instrument != rest_instrument_id:
+            step, octave = instrument_names[self.instrument]
+            unpitched = collections.OrderedDict(source.get('unpitched') or {})
+            unpitched['display-step'] = step
+            unpitched['display-octave'] = octave
+            changed['unpitched'] = unpitched
+        if self.notehead is not None and self.notehead is not source.get('notehead'):
+            changed['notehead'] = self.notehead
+        if self.clear_beam and 'beam' in source:
+            changed['beam'] = None
+        if str(self.duration) != source.get('duration'):
+            changed['duration'] = str(self.duration)
+
+        if not changed:
+            return source
+        note = collections.OrderedDict(source)
+        for key in ['unpitched', 'duration', 'notehead', 'rest']:
+            if key in changed:
+                note[key] = changed[key]
+        if 'beam' in changed:
+            del note['beam']
+        for key in ['instrument', 'voice']: # they go after <duration> (and <tie>, and <voice> after <instrument>)
+            if key in changed:
+                items = note.items()
+                i = max(i for i, (item_key, value) in enumerate(items) if item_key in ('duration', 'tie', 'instrument')) + 1
+                note = collections.OrderedDict(items[:i] + [(key, changed[key])] + items[i:])
+        if changed.get('chord'): # <chord/> goes before the pitch (or rest) and duration
+            keys = note.keys()
+            i = min([keys.index(key) for key in ['pitch', 'unpitched', 'rest', 'duration'] if key in note] or [len(keys)])
+            note = collections.OrderedDict(note.items()[:i] + [('chord', None)] + note.items()[i:])
+        elif 'chord' in changed:
+            del note['chord']
+        return note
+
+    # The OrderedDict the note was parsed from (None for notes made from scratch)
+    #   - sources: as with to_dict()
+    def get_source(self, sources=None):
+        if isinstance(self.source, int):
+            return sources[self.source]
+        return self.source
+
+# Instrument (limb) ids: each (display-step, display-octave) pair gets a small int
+instrument_ids = {}
+instrument_names = []
+
+# Return the id for an instrument, adding it if we haven't seen it yet
+def get_instrument_id(step, octave):
+    key = (step, octave)
+    instrument_id = instrument_ids.get(key)
+    if instrument_id is None:
+        instrument_id = instrument_ids[key] = len(instrument_names)
+        instrument_names.append(key)
+    return instrument_id
+
+# Return the instrument id of an xmltodict note
+def get_instrument_id_for_note(note):
+    if 'unpitched' not in note:
+        return rest_instrument_id
+    unpitched = note['unpitched']
+    return get_instrument_id(unpitched['display-step'], unpitched['display-octave'])
+
+rest_instrument_id = get_instrument_id('B#', '0')
+
+# Notes, along with their MusicXML, for note specs (see Bin.replace_notes()), the first
+# one at onset start. Notes at the same offset make a chord; types, dots and tuplets
+# come from the durations (see get_note_attrs()).
+def make_spec_notes(specs, start, divisions=256):
+    notes = []
+    chord = -1
+    prev_offset = None
+    for offset, duration, step, octave, notehead in specs:
+        source = collections.OrderedDict()
+        if offset == prev_offset:
+            source['chord'] = None
+        else:
+            chord += 1
+        prev_offset = offset
+        if step is None:
+            source['rest'] = None
+        else:
+            source['unpitched'] = collections.OrderedDict([('display-step', step), ('display-octave', octave)])
+        source['duration'] = str(duration)
+        note_attrs = get_note_attrs(duration, divisions)
+        source['type'] = note_attrs['type']
+        if 'dot' in note_attrs:
+            source['dot'] = note_attrs['dot']
+        if 'time-modification' in note_attrs:
+            source['time-modification'] = collections.OrderedDict([
+                (key, str(value)) for key, value in sorted(note_attrs['time-modification'].items())
+            ])
+        if step is not None:
+            source['stem'] = 'up'
+            if notehead is not None:
+                source['notehead'] = notehead
+        note = Note(start + offset, duration, get_instrument_id_for_note(source), step is None, chord, source.get('notehead'), source)
+        note.spec = True
+        notes.append(note)
+    return notes
+
+# A bin of Notes, along with an index of its chord groups (i.e. onset positions) that is
+# built up during binning, so that simultaneous onsets never have to be counted by
+# scanning the bin.
+#   - chords: chord id -> the bin's notes in that chord
+#   - chord_onsets: chord id -> how many of those notes are onsets (non-rests)
+#   - num_onsets: total number of onsets in the bin
+#   - num_onset_chords: number of chords with at least one onset
+#   - changes: log of the adjustments made to the bin, as (operation, index, ...)
+#     tuples: ('rest', i), ('remove', i), ('swap', i, j), ('pitch', i, instrument,
+#     notehead) with the pitch's instrument id and notehead, ('beam', i), ('replace', 0,
+#     specs) with the notes that took the place of all of the bin's (see
+#     replace_notes()). Replaying it on the original bin gives the adjusted bin (see
+#     EditLog).
+# Adjustments should go through the methods below so the index and the change log stay
+# up to date.
+class Bin(list):
+    def __init__(self, notes=()):
+        list.__init__(self)
+        self.chords = {}
+        self.chord_onsets = {}
+        self.num_onsets = 0
+        self.num_onset_chords = 0
+        self.changes = []
+        for note in notes:
+            self.append(note)
+
+    def __reduce__(self):
+        return (Bin, (list(self),), {'changes': self.changes})
+
+    # Copy of the bin with copies of its notes (and a fresh change log)
+    def copy(self):
+        return Bin([note.copy() for note in self])
+
+    def append(self, note):
+        list.append(self, note)
+        self.chords.setdefault(note.chord, []).append(note)
+        if not note.rest:
+            self.count_onset(note.chord, 1)
+
+    # Remove (and return) the note at index i
+    def remove_note(self, i):
+        note = self.pop(i)
+        members = self.chords[note.chord]
+        members.remove(note)
+        if not members:
+            del self.chords[note.chord]
+        if not note.rest:
+            self.count_onset(note.chord, -1)
+        self.changes.append(('remove', i))
+        return note
+
+    # Turn the note at index i into a rest
+    def set_rest(self, i):
+        note = self[i]
+        if not note.rest:
+            note.rest = True
+            self.count_onset(note.chord, -1)
+            self.changes.append(('rest', i))
+
+    # Swap the notes at indices i and j (see retime())
+    def swap_notes(self, i, j):
+        i, j = sorted([i % len(self), j % len(self)])
+        if i != j:
+            swap(self, i, j)
+            self.retime()
+            self.changes.append(('swap', i, j))
+
+    # Give the notes onsets one after another again, from the bin's first onset, after
+    # their order has changed: each chord starts where the one before it ends, as they
+    # would be read back from MusicXML (see set_measure_bins()). The onsets only depend
+    # on the order of the notes, however they got there.
+    def retime(self):
+        onset = min(note.onset for note in self)
+        prev_note = None
+        for note in self:
+            if prev_note is not None and note.chord != prev_note.chord:
+                onset = head.onset + head.duration
+            if prev_note is None or note.chord != prev_note.chord:
+                head = note
+            note.onset = onset
+            prev_note = note
+
+    # Give the note at index i the pitch of note_new (see update_pitch()) and return it
+    def set_pitch(self, i, note_new):
+        note = update_pitch(self[i], note_new)
+        self.changes.append(('pitch', i, note_new.instrument, note_new.notehead))
+        return note
+
+    # Strip the beam of the note at index i
+    def clear_beam(self, i):
+        self[i].clear_beam = True
+        self.changes.append(('beam', i))
+
+    # Replace all of the bin's notes with new ones (see make_spec_notes()), e.g. a bin
+    # from a corpus (see BinBank)
+    #   - specs: [offset, duration, step, octave, notehead] of every new note, offset
+    #     being from the onset of the bin's first note (step and octave are None for
+    #     rests)
+    #   - divisions: divisions of the bin's measure (see Meter), to write the notes with
+    def replace_notes(self, specs, divisions=256):
+        start = self[0].onset if self else 0
+        del self[:]
+        self.chords = {}
+        self.chord_onsets = {}
+        self.num_onsets = 0
+        self.num_onset_chords = 0
+        for note in make_spec_notes(specs, start, divisions):
+            self.append(note)
+        self.changes.append(('replace', 0, specs))
+
+    # Number of notes (rests included) sharing an onset with chord
+    def chord_size(self, chord):
+        members = self.chords.get(chord)
+        return len(members) if members else 0
+
+    def count_onset(self, chord, n):
+        before = self.chord_onsets.get(chord, 0)
+        after = self.chord_onsets[chord] = before + n
+        self.num_onsets += n
+        if before == 0 and after > 0:
+            self.num_onset_chords += 1
+        elif before > 0 and after == 0:
+            self.num_onset_chords -= 1
+
+# Incrementally maintained d, s, and c values of a bin, as in calculate_value_for_bin().
+# Keith's measure and CNID are kept per note; after the bin has been adjusted, update()
+# goes through the bin's change log and rescores only the notes whose neighbourhood
+# was touched instead of the whole bin.
+#   - keith: Keith's measure score (0 to 3) of each note
+#   - cnid: CNID score (0 to 4) of each note
+#   - offsets: duration from the start of the bin to each note
+class BinScore(object):
+    def __init__(self, bin, bin_size, bin_divisions=4, max_bin_granularity=32):
+        self.bin = bin
+        self.bin_size = bin_size
+        self.granularity = max_bin_granularity / bin_divisions
+        self.keith = [0] * len(bin)
+        self.cnid = [0] * len(bin)
+        self.offsets = [0] * len(bin)
+        self.keith_total = 0
+        self.cnid_total = 0
+        self.num_changes = len(bin.changes)
+        self.rescore(0, len(bin), 0, len(bin))
+
+    # Current values, in the form returned by calculate_values_for_bin()
+    def values(self):
+        num_notes = len(self.bin)
+        if num_notes == 0:
+            return {'density': 0, 'syncopation': 0, 'coordination': 0}
+        density = 0
+        if self.offsets[-1] + self.bin[-1].duration > 0:
+            density = float(self.bin.num_onsets) / self.granularity
+        return {
+            'density': density,
+            'syncopation': float(self.keith_total) / 3 / num_notes,
+            'coordination': float(self.cnid_total) / 4 / num_notes
         }
-    },
-    86: {
-        'type': 'eighth',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': 'eighth'
+
+    # Rescore the notes affected by changes made to the bin since the last update
+    def update(self):
+        bin = self.bin
+        changes = bin.changes[self.num_changes:]
+        self.num_changes = len(bin.changes)
+        for change in changes:
+            operation, i = change[0], change[1]
+            if operation == 'rest':
+                self.rescore(i-1, i+1, i, i)
+            elif operation == 'pitch':
+                self.rescore(i, i, i-1, i+2)
+            elif operation == 'swap':
+                j = change[2]
+                self.rescore(i-1, j+1, i-1, i+2)
+                self.rescore(j, j, j-1, j+2)
+            elif operation == 'replace':
+                self.keith = [0] * len(bin)
+                self.cnid = [0] * len(bin)
+                self.offsets = [0] * len(bin)
+                self.keith_total = 0
+                self.cnid_total = 0
+                self.rescore(0, len(bin), 0, len(bin))
+            elif operation == 'remove':
+                # the note is gone and its chord lost a note, so everything from
+                # there on (as well as the rest of that chord) needs rescoring
+                self.keith_total -= self.keith.pop(i)
+                self.cnid_total -= self.cnid.pop(i)
+                self.offsets.pop(i)
+                self.rescore(i-1, len(bin), 0, len(bin))
+
+    # Rescore Keith's measure for notes [k_start, k_end) and CNID for [c_start, c_end)
+    def rescore(self, k_start, k_end, c_start, c_end):
+        bin = self.bin
+        num_notes = len(bin)
+        bin_size = self.bin_size
+
+        k_start, k_end = max(k_start, 0), min(k_end, num_notes)
+        cur_duration = 0
+        if k_start > 0:
+            cur_duration = self.offsets[k_start-1] + bin[k_start-1].duration
+        for ni in xrange(k_start, k_end):
+            note = bin[ni]
+            self.offsets[ni] = cur_duration
+            cur_note_on_beat = not note.rest and cur_duration % bin_size == 0
+            next_note_on_beat = True
+            if ni < num_notes - 1:
+                next_note_on_beat = not bin[ni+1].rest and cur_duration + note.duration % bin_size == 0
+
+            if next_note_on_beat:
+                value = 0 if cur_note_on_beat else 1
+            else:
+                value = 2 if cur_note_on_beat else 3
+            self.keith_total += value - self.keith[ni]
+            self.keith[ni] = value
+            cur_duration += note.duration
+
+        for ni in xrange(max(c_start, 0), min(c_end, num_notes)):
+            cur_note_name = bin[ni].instrument
+            next_note_name = bin[ni+1].instrument if ni < num_notes - 1 else cur_note_name
+            prev_note_name = bin[ni-1].instrument if ni > 0 else cur_note_name
+
+            value = 0
+            if cur_note_name != next_note_name:
+                value += 1
+            if cur_note_name != prev_note_name:
+                value += 1
+            if prev_note_name != next_note_name and value > 0:
+                value += 1
+            value += bin.chord_size(bin[ni].chord) / 4 # max simultaneous limbs (RH, RF, LH, LF)
+            self.cnid_total += value - self.cnid[ni]
+            self.cnid[ni] = value
+
+# Convert a measure's xmltodict notes into Notes, in the order they sound (by onset;
+# notes with the same onset in the order they're written)
+# Onsets follow MusicXML's time cursor: every note starts where the cursor is and moves
+# it on by its duration, except for notes with <chord/>, which start with the note
+# before them, and <backup> and <forward> move it back and forth (see
+# get_measure_moves()). Some exporters leave <chord/> out and give simultaneous notes
+# the same default-x instead, so in measures without any <chord/> a note with the
+# default-x of the note before it is taken to be in its chord. Notes with the same
+# onset (in any voice) are simultaneous and get the same chord id.
+# Notes without a duration (e.g. grace notes) are skipped, as they aren't binned.
+#   - moves: cursor moves of the measure, as from get_measure_moves()
+def parse_notes(notes, keep_source=True, moves=()):
+    parsed = []
+    default_x_chords = not any('chord' in note for note in notes if is_valid_note(note))
+    moves = list(moves)
+    onset = cursor = 0
+    prev_note = None
+    for ni, note in enumerate(notes):
+        while moves and moves[0][0] <= ni:
+            cursor = max(cursor + moves.pop(0)[1], 0)
+            prev_note = None
+        if not is_valid_note(note) or 'duration' not in note:
+            continue
+
+        if prev_note is None:
+            chord = False
+        elif default_x_chords:
+            chord = '@default-x' in note and note['@default-x'] == prev_note.get('@default-x')
+        else:
+            chord = 'chord' in note
+        if not chord:
+            onset = cursor
+            cursor += int(note['duration'])
+
+        parsed.append(Note(onset, int(note['duration']), get_instrument_id_for_note(note), 'rest' in note, onset, note.get('notehead'), note if keep_source else None))
+        prev_note = note
+
+    parsed.sort(key=lambda note: note.onset)
+    chord_ids = {}
+    for note in parsed:
+        note.chord = chord_ids.setdefault(note.chord, len(chord_ids))
+    return parsed
+
+# Bin a measure's notes (see bin_notes())
+#   - meter: Meter of the measure (see get_measure_meter())
+def bin_measure(measure, bin_divisions, keep_source=True, meter=None):
+    return bin_notes(parse_notes(get_measure_notes(measure), keep_source, get_measure_moves(measure)), bin_divisions, meter)
+
+# Write a measure's (adjusted) bins back into the measure as MusicXML notes, so that
+# they parse (see parse_notes()) into the same bins: notes are written in bin order, a
+# note gets <chord/> if it's in the same chord and voice as the note before it (a note
+# without a <voice> being in the voice of the one before it), and <backup> or <forward>
+# (see get_measure_moves()) move the cursor to where a note doesn't follow on from the
+# one before (other voices, gaps, overlaps). Chords that would no longer start within
+# their bin (say a long note moved to the front of it) are held back just enough to
+# stay in it. Notes made from note specs (see make_spec_notes()), which aren't the
+# measure's own, get their <instrument> and <voice> from the measure's notes (see
+# get_part_note_attrs()).
+#   - meter: Meter of the measure (see get_measure_meter())
+def set_measure_bins(measure, bins, meter=None):
+    sources = get_measure_notes(measure)
+    meter = meter or default_meter
+    bin_ends = meter.get_bin_starts(len(bins))[1:] + [meter.duration]
+    notes = []
+    moves = []
+    cursor = 0
+    for bi, bin in enumerate(bins):
+        onsets = get_bin_onsets(bin, bin_ends[bi] if bi < len(bins) - 1 else max([meter.duration] + [note.onset + 1 for note in bin]))
+        prev_note = prev_voice = None
+        for note, onset in zip(bin, onsets):
+            source = note.get_source(sources)
+            part_attrs = get_part_note_attrs(note, sources, prev_voice) if note.spec else None
+            voice = part_attrs['voice'] if part_attrs else source.get('voice', prev_voice) if source else prev_voice
+            chord = prev_note is not None and note.chord == prev_note.chord and voice == prev_voice
+            if not chord:
+                if onset != cursor:
+                    moves.append((len(notes), onset - cursor))
+                cursor = onset + note.duration
+            notes.append(note.to_dict(sources, chord, part_attrs))
+            prev_note, prev_voice = note, voice
+    measure['note'] = notes
+    measure.pop('backup', None)
+    measure.pop('forward', None)
+    measure.moves = moves
+
+# <instrument> and <voice> for a note that isn't one of the measure's own, as the
+# measure's notes of the same pitch have them: a bin from a corpus is played on the
+# part's instruments, in its voices. Rests (and pitches the measure doesn't play) go in
+# voice (the voice of the note before them), or else in the voice of the measure's
+# first note.
+#   - sources: the measure's notes (xmltodict)
+# Returns {'instrument': ..., 'voice': ...}, either being None if there is none to copy
+def get_part_note_attrs(note, sources, voice=None):
+    model = None
+    if not note.rest:
+        model = next((source for source in sources if is_valid_note(source) and 'unpitched' in source and get_instrument_id_for_note(source) == note.instrument), None)
+    if model is not None and 'voice' in model:
+        voice = model['voice']
+    if voice is None:
+        voice = next((source['voice'] for source in sources if is_valid_note(source) and 'voice' in source), None)
+    return {'instrument': model.get('instrument') if model is not None else None, 'voice': voice}
+
+# Onset to write every note of a bin at: its own, unless its chord has to be held back
+# to start before end (and after the chord before it)
+def get_bin_onsets(bin, end):
+    heads = [ni for ni, note in enumerate(bin) if ni == 0 or note.chord != bin[ni-1].chord]
+    starts = [bin[ni].onset for ni in heads]
+    for hi in reversed(xrange(len(starts))):
+        end = starts[hi] = min(starts[hi], end - 1)
+    for hi in xrange(1, len(starts)):
+        starts[hi] = max(starts[hi], starts[hi-1] + 1)
+    onsets = []
+    for hi, ni in enumerate(heads):
+        onsets += [starts[hi]] * ((heads[hi+1] if hi + 1 < len(heads) else len(bin)) - ni)
+    return onsets
+
+# Every measure of every part of a score (score-partwise), one part after another
+# Returns the measures and (part id, start, end) of every part, end being exclusive
+def get_score_measures(score_json):
+    parts = score_json['score-partwise'].get('part') or []
+    if type(parts) != list:
+        parts = [parts]
+    measures = []
+    part_ranges = []
+    for part in parts:
+        part_measures = part.get('measure') or []
+        if type(part_measures) != list: # 1 measure
+            part_measures = [part_measures]
+        part_ranges.append((part.get('@id'), len(measures), len(measures) + len(part_measures)))
+        measures += part_measures
+    return measures, part_ranges
+
+# Meter of every measure (see get_measure_meter()), each part starting from default_meter
+#   - parts: (part id, start, end) of every part, as from get_score_measures()
+def get_measure_meters(measures, parts):
+    meters = []
+    for part_id, start, end in parts:
+        meter = None
+        for measure in measures[start:end]:
+            meter = get_measure_meter(measure, meter)
+            meters.append(meter)
+    return meters
+
+# Parse MusicXML (a score, or a single measure) with xmltodict, keeping what xmltodict
+# loses: where each measure's <backup> and <forward> elements are among its notes (see
+# get_measure_moves())
+def parse_musicxml(xml_input):
+    notes = [0]
+    moves = []
+    def postprocessor(path, key, value):
+        if len(path) > 1 and path[-2][0] == 'measure':
+            if key == 'note':
+                notes[0] += 1
+            elif key in ('backup', 'forward') and value and value.get('duration'):
+                moves.append((notes[0], int(value['duration']) * (-1 if key == 'backup' else 1)))
+        elif key == 'measure':
+            if value is not None:
+                value.moves = list(moves)
+            notes[0] = 0
+            del moves[:]
+        return key, value
+    return xmltodict.parse(xml_input, postprocessor=postprocessor)
+
+# Cursor moves of a measure parsed with parse_musicxml(), as (note index, ticks): before
+# the note at that index among the measure's notes (see get_measure_notes()), the
+# cursor goes back (<backup>, ticks < 0) or forward (<forward>, ticks > 0). Measures
+# parsed otherwise have none.
+def get_measure_moves(measure):
+    return getattr(measure, 'moves', None) or []
+
+# Return a measure's notes as a list (xmltodict gives a single dict for one note)
+def get_measure_notes(measure):
+    notes = measure.get('note', [])
+    if type(notes) != list:
+        notes = [notes]
+    return notes
+
+# A measure's grid: how long it is (in MusicXML divisions, i.e. ticks) and where each
+# of its bins starts, for any number of bins per measure. Bins split the measure evenly
+# (to the tick), whatever its time signature. Meters are shared between all measures
+# with the same divisions and time signature (see get_meter()), so the grid of each
+# is only computed once.
+#   - divisions: ticks per quarter note
+#   - length: length of the measure in whole notes (e.g. 7/8)
+class Meter(object):
+    def __init__(self, divisions=256, length=fractions.Fraction(1)):
+        self.divisions = divisions
+        self.length = length
+        self.duration = int(divisions * 4 * length)
+        self.bin_starts = {} # bin_divisions -> onset tick of every bin
+        self.bin_durations = {} # bin_divisions -> duration of every bin
+
+    def __repr__(self):
+        return 'Meter(divisions={}, length={})'.format(self.divisions, self.length)
+
+    def get_bin_starts(self, bin_divisions):
+        starts = self.bin_starts.get(bin_divisions)
+        if starts is None:
+            starts = self.bin_starts[bin_divisions] = [self.duration * bi / bin_divisions for bi in xrange(bin_divisions)]
+        return starts
+
+    def get_bin_durations(self, bin_divisions):
+        durations = self.bin_durations.get(bin_divisions)
+        if durations is None:
+            ends = self.get_bin_starts(bin_divisions)[1:] + [self.duration]
+            durations = self.bin_durations[bin_divisions] = [max(end - start, 1) for start, end in zip(self.get_bin_starts(bin_divisions), ends)]
+        return durations
+
+meters = {}
+
+# The Meter for divisions and a measure length (in whole notes)
+def get_meter(divisions, length):
+    key = (divisions, length)
+    meter = meters.get(key)
+    if meter is None:
+        meter = meters[key] = Meter(divisions, length)
+    return meter
+
+# What scores without <divisions> or <time> are taken to be in (1024 = whole note, 4/4)
+default_meter = get_meter(256, fractions.Fraction(1))
+
+# Meter of a measure: meter (the one in effect before the measure, default_meter for
+# the first) with any <divisions> and <time> from the measure's <attributes> applied.
+# Composite time signatures (<beats>3+2</beats>, or several <beats>/<beat-type> pairs)
+# add up.
+def get_measure_meter(measure, meter=None):
+    meter = meter or default_meter
+    attributes = measure.get('attributes')
+    if not attributes:
+        return meter
+    if type(attributes) != list:
+        attributes = [attributes]
+
+    divisions, length = meter.divisions, meter.length
+    for attrs in attributes:
+        if not attrs:
+            continue
+        if attrs.get('divisions'):
+            divisions = int(float(attrs['divisions']))
+        time = attrs.get('time')
+        if type(time) == list:
+            time = time[0]
+        if time and time.get('beats') and time.get('beat-type'):
+            beats, beat_types = time['beats'], time['beat-type']
+            if type(beats) != list:
+                beats, beat_types = [beats], [beat_types]
+            length = sum(fractions.Fraction(sum(int(beat) for beat in beat_group.split('+')), int(beat_type)) for beat_group, beat_type in zip(beats, beat_types))
+    return get_meter(divisions, length)
+
+# Separate a measure's notes into bins by beat
+#   - notes: list of Notes in the measure
+#   - bin_divisions: total number of bins in a measure
+#   - meter: Meter of the measure (default_meter if None)
+# Returns the bins and the duration of each bin
+def bin_notes(notes, bin_divisions, meter=None):
+    return bin_notes_levels(notes, [bin_divisions], meter)[bin_divisions]
+
+# Separate a measure's notes into bins at several resolutions at once, in a single pass
+# over the notes: each note goes into the bin its onset falls in, found by bisecting the
+# meter's bin starts (notes past the end of the measure go into the last bin). Levels
+# share the Notes.
+#   - levels: numbers of bins per measure, e.g. [1, 2, 4, 8]
+# Returns {bin_divisions: (bins, bin_durations)} for every level
+def bin_notes_levels(notes, levels, meter=None):
+    meter = meter or default_meter
+    level_starts = [meter.get_bin_starts(bin_divisions) for bin_divisions in levels]
+    level_bins = [[ Bin() for i in xrange(bin_divisions) ] for bin_divisions in levels]
+
+    for note in notes:
+        for li, bins in enumerate(level_bins):
+            bins[bisect.bisect_right(level_starts[li], note.onset) - 1].append(note)
+
+    return dict((bin_divisions, (level_bins[li], meter.get_bin_durations(bin_divisions))) for li, bin_divisions in enumerate(levels))
+
+# Bins and values (d, s, c) of a piece at several resolutions (numbers of bins per
+# measure), from one pass over each measure's notes (see bin_notes_levels()). Values
+# are analyzed per level when first asked for; Keith's measure depends on the bin size
+# for every note, so coarser levels can't be added up from finer ones. Levels that
+# weren't binned up front are binned from the parsed notes, without going back to the
+# MusicXML.
+#   - levels: numbers of bins per measure to bin up front
+#   - meter: Meter in effect before the first measure (see get_measure_meter()), or a
+#     list with the Meter of every measure (see get_measure_meters())
+class ScoreLevels(object):
+    def __init__(self, measures, levels=(1, 2, 4, 8), keep_source=True, meter=None):
+        levels = sorted(set(levels))
+        self.measure_notes = []
+        self.meters = [] # Meter of every measure
+        self.measure_bins = dict((bin_divisions, []) for bin_divisions in levels) # bin_divisions -> bins of every measure
+        self.bin_durations = dict((bin_divisions, []) for bin_divisions in levels) # bin_divisions -> duration of every bin
+        self.values = {} # bin_divisions -> values of every bin (see analyze_bins())
+        measure_meters = meter if type(meter) == list else None
+        for mi, measure in enumerate(measures):
+            meter = measure_meters[mi] if measure_meters is not None else get_measure_meter(measure, meter)
+            self.meters.append(meter)
+            notes = parse_notes(get_measure_notes(measure), keep_source, get_measure_moves(measure))
+            self.measure_notes.append(notes)
+            for bin_divisions, (bins, bin_durations) in bin_notes_levels(notes, levels, meter).iteritems():
+                self.measure_bins[bin_divisions].append(bins)
+                self.bin_durations[bin_divisions].extend(bin_durations)
+
+    # Bins of every measure (a list per measure) at bin_divisions bins per measure
+    def get_bins(self, bin_divisions):
+        if bin_divisions not in self.measure_bins:
+            self.measure_bins[bin_divisions] = []
+            self.bin_durations[bin_divisions] = []
+            for mi, notes in enumerate(self.measure_notes):
+                bins, bin_durations = bin_notes(notes, bin_divisions, self.meters[mi])
+                self.measure_bins[bin_divisions].append(bins)
+                self.bin_durations[bin_divisions].extend(bin_durations)
+        return self.measure_bins[bin_divisions]
+
+    # Values of every bin at bin_divisions bins per measure, as from analyze_bins()
+    def get_values(self, bin_divisions):
+        if bin_divisions not in self.values:
+            bins = [bin for bins in self.get_bins(bin_divisions) for bin in bins]
+            self.values[bin_divisions] = analyze_bins(bins, self.bin_durations[bin_divisions], bin_divisions)
+        return self.values[bin_divisions]
+
+    # Per-measure, per-resolution table: one row per measure and level, with the mean
+    # d, s and c of the measure's bins and the measure's difficulty at that level
+    def get_table(self, weights, levels=None):
+        levels = sorted(levels or self.measure_bins)
+        level_values = dict((bin_divisions, self.get_values(bin_divisions)) for bin_divisions in levels)
+        rows = []
+        for mi in xrange(len(self.meters)):
+            for bin_divisions in levels:
+                bin_values = level_values[bin_divisions][mi*bin_divisions:(mi+1)*bin_divisions]
+                rows.append({
+                    'measure': mi+1,
+                    'bin_divisions': bin_divisions,
+                    'density': sum(values['density'] for values in bin_values) / bin_divisions,
+                    'syncopation': sum(values['syncopation'] for values in bin_values) / bin_divisions,
+                    'coordination': sum(values['coordination'] for values in bin_values) / bin_divisions,
+                    'difficulty': calculate_measure_difficulty_from_values(bin_values, weights, bin_divisions)
+                })
+        return rows
+
+# Analyze a measure bin by bin and (unless analysis_only) create a new phrase in its place
+#   - meter: Meter of the measure (see get_measure_meter())
+# Returns the measure's original and new difficulty (by bins), and whether the measure
+# changed (if not, it's left as it was)
+def generate_measure(measure, mi, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, analysis_only=False, max_iterations=11, seed=None, strategy='stochastic', budget=64, meter=None):
+    with metrics.stage('binning'):
+        bins, bin_durations = bin_measure(measure, bin_divisions, meter=meter)
+
+    with metrics.stage('analysis'):
+        bin_values = analyze_bins(bins, bin_durations, bin_divisions)
+        measure_difficulty_original = calculate_measure_difficulty_from_values(bin_values, weights, bin_divisions)
+    measure_difficulty_new = 0
+
+    if analysis_only:
+        return measure_difficulty_original, measure_difficulty_new, False
+
+    with metrics.stage('generation'):
+        new_bins = generate_bins(bins, bin_values, mi, bin_durations, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, max_iterations, seed, strategy, budget, meter)
+    with metrics.stage('analysis'):
+        bin_values = analyze_bins(new_bins, bin_durations, bin_divisions)
+        measure_difficulty_new = calculate_measure_difficulty_from_values(bin_values, weights, bin_divisions)
+
+    changed = bool(get_dirty_measures([bins], [new_bins]))
+    if changed:
+        with metrics.stage('serialize'):
+            set_measure_bins(measure, new_bins, meter)
+    return measure_difficulty_original, measure_difficulty_new, changed
+
+# Create new phrase based on parameters, adjusting a measure's bins
+#   - bin_values: the bins' values from analysis (see analyze_bins())
+#   - bin_duration: either one for all bins or a sequence with one per bin
+#   - seed: master seed; each bin gets its own random number generator derived from it
+#     (see get_bin_rng()). If None, the random module is used
+#   - strategy: 'stochastic' adjusts bins with adjust_bin(), 'greedy' or 'beam' with
+#     search_bin() (which doesn't use random numbers) within budget evaluations per bin,
+#     'plan' plans edits across the measure's bins with plan_bins(), and 'retrieve'
+#     replaces bins with bins from the corpus in bin_bank (see retrieve_bin())
+#   - meter: Meter of the measure (see get_measure_meter()), for 'retrieve'
+# Returns the adjusted bins as a new list (bins is left untouched)
+def generate_bins(bins, bin_values, mi, bin_duration, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, max_iterations=11, seed=None, strategy='stochastic', budget=64, meter=None):
+    log.info('Creating new phrase for measure %s', mi+1)
+    if strategy == 'plan':
+        return plan_bins(bins, bin_values, bin_duration, bin_divisions, target_difficulty, weights, budget)
+    return [generate_bin(bin, bin_values[bi], mi, bi, get_bin_size(bin_duration, bi), bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, max_iterations, seed, strategy, budget, meter) for bi, bin in enumerate(bins)]
+
+# Adjust bin bi of measure mi with any strategy but 'plan' (see generate_bins())
+#   - values: the bin's values from analysis (see analyze_bins())
+# Returns the adjusted bin (the bin itself if it's left as it is)
+def generate_bin(bin, values, mi, bi, bin_size, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, max_iterations=11, seed=None, strategy='stochastic', budget=64, meter=None):
+    difficulty = calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights)
+
+    log.debug('=== measure %s beat %s ===', mi+1, bi+1)
+
+    if difficulty > 0 and strategy == 'retrieve':
+        meter = meter or default_meter
+        bin = retrieve_bin(bin, meter.get_bin_starts(bin_divisions)[bi], bin_size, meter.divisions, bin_divisions, values, target_difficulty*difficulty, weights, budget)
+    elif difficulty > 0 and strategy != 'stochastic':
+        bin = search_bin(bin, bin_size, bin_divisions, target_difficulty*difficulty, weights, strategy, budget)
+    elif difficulty > 0:
+        rng = random if seed is None else get_bin_rng(seed, mi, bi)
+        bin = adjust_bin(bin, bin_size, bin_divisions, target_difficulty*difficulty, weights, gradients, stochastic_modifier, max_iterations, rng)
+    return bin
+
+# generate_bins() for a process pool: task is (bins, bin_values, mi, ...) with the
+# rest of generate_bins()'s arguments. Returns the adjusted bins and the counts taken
+# from the process's metrics, to be merged into the main process's (see Metrics.merge())
+def generate_bins_task(task):
+    bins = generate_bins(*task)
+    return bins, metrics.take_counts()
+
+# plan_bins() for a process pool, as with generate_bins_task()
+def plan_bins_task(task):
+    bins = plan_bins(*task)
+    return bins, metrics.take_counts()
+
+# Output path for the variation generated for target_difficulty, e.g. out_0.4.xml
+def get_variant_path(path, target_difficulty):
+    root, ext = os.path.splitext(path)
+    return '{}_{}{}'.format(root, target_difficulty, ext)
+
+# Random number generator for a single bin, derived from the master seed and the bin's
+# position in the score. A bin's variation therefore doesn't depend on which process
+# generates it or in what order.
+def get_bin_rng(seed, mi, bi):
+    digest = hashlib.md5('{}:{}:{}'.format(seed, mi, bi)).hexdigest()
+    return random.Random(int(digest, 16))
+
+
+# A parsed, binned and analyzed score (see ScatlavaEngine.load())
+#   - score_xml: the score (MusicXML), which variations are spliced into
+#   - measures: measures of every part, one part after another, or None if the score
+#     was loaded from a ScoreSnapshot (then only the measures that are generated from
+#     are parsed, see get_measures())
+#   - parts: (part id, start, end) of every part (see get_score_measures())
+#   - meters: Meter of every measure
+#   - bin_durations: duration of every bin (bin_divisions per measure)
+#   - measure_values: values of each measure as one bin (as from analyze_measures())
+#   - score_values: values of every bin (bin_divisions per measure)
+class AnalyzedScore(object):
+    def __init__(self, score_hash, score_xml, measures, parts, meters, measure_bins, bin_durations, bin_divisions, measure_values, score_values):
+        self.score_hash = score_hash
+        self.score_xml = score_xml
+        self.measures = measures
+        self.parts = parts
+        self.meters = meters
+        self.measure_bins = measure_bins
+        self.bin_durations = bin_durations
+        self.bin_divisions = bin_divisions
+        self.measure_values = measure_values
+        self.score_values = score_values
+        self.measure_offsets = None # found when first generated from
+
+    # Copies of the measures whose bins in measure_bins differ from the original ones,
+    # with their notes replaced (the analyzed score itself is left untouched, so it can
+    # be generated from again)
+    # Returns measure index -> measure
+    def with_bins(self, measure_bins):
+        new_measures = self.get_measures(get_dirty_measures(self.measure_bins, measure_bins))
+        for mi, measure in new_measures.iteritems():
+            set_measure_bins(measure, measure_bins[mi], self.meters[mi])
+        return new_measures
+
+    # Copies of the measures with indices mis, parsed from the score if it was loaded
+    # from a snapshot
+    # Returns measure index -> measure
+    def get_measures(self, mis):
+        if self.measures is None:
+            return parse_measures_at(self.score_xml, self.get_measure_offsets(), mis)
+        return dict((mi, collections.OrderedDict(self.measures[mi])) for mi in mis)
+
+    # Byte range of every measure of the score (see get_measure_offsets()), found when
+    # first needed
+    def get_measure_offsets(self):
+        if self.measure_offsets is None:
+            self.measure_offsets = get_measure_offsets(self.score_xml)
+        return self.measure_offsets
+
+    # Difficulty report: overall difficulty by bins and by measures (of all parts
+    # together, and of each part) and the difficulty of every measure
+    def report(self, weights):
+        bin_divisions = self.bin_divisions
+        return {
+            'score': self.score_hash,
+            'measures': len(self.meters),
+            'bin_divisions': bin_divisions,
+            'overall_difficulty': calculate_overall_difficulty_from_values(self.score_values, weights, bin_divisions),
+            'overall_difficulty_by_measure': calculate_overall_difficulty_from_values(self.measure_values, weights, 1),
+            'parts': report_parts(self.parts, weights, {
+                'overall_difficulty': (self.score_values, bin_divisions),
+                'overall_difficulty_by_measure': (self.measure_values, 1)
+            }),
+            'measure_difficulties': [calculate_measure_difficulty_from_values(self.score_values[mi*bin_divisions:(mi+1)*bin_divisions], weights, bin_divisions) for mi in xrange(len(self.meters))]
         }
-    },
-
-    # 8ths
-    126: {'type': 'eighth'}, # for rounding when tripletizing up
-    127: {'type': 'eighth'}, # for rounding when tripletizing up
-    128: {'type': 'eighth'},
-    129: {'type': 'eighth'}, # for rounding when tripletizing up
-
-    # dotted 8ths
-    190: {'type': 'eighth', 'dot': ''},  # rounding
-    192: {'type': 'eighth', 'dot': ''},
-
-    # quarter triplets
-    170: {
-        'type': 'quarter',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': 'quarter'
+
+    # The score (MusicXML) with new_measures (as from with_bins()) spliced in
+    def splice(self, new_measures):
+        f = cStringIO.StringIO()
+        splice_measures(self.score_xml, self.get_measure_offsets(), new_measures, f)
+        return f.getvalue()
+
+# Raised by ScatlavaEngine.load() for scores that can't be read: not XML, or not
+# partwise MusicXML
+class ScoreError(ValueError):
+    pass
+
+# Analysis and generation for scores kept in memory, for callers that handle many
+# requests in one process (see scatlava_service.py) rather than one score per run.
+# Scores are parsed and analyzed once and then kept in an LRU of up to max_scores,
+# keyed by content hash and bin_divisions.
+#   - cache: optional AnalysisCache to look analysis values up in
+#   - bank: corpus index (see scatlava_index.py) for the retrieve strategy, loaded into
+#     bin_bank when first needed
+class ScatlavaEngine(object):
+    def __init__(self, max_scores=32, cache=None, bank=None):
+        self.max_scores = max_scores
+        self.cache = cache
+        self.bank = bank
+        self.scores = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    # Parse, bin and analyze a score (MusicXML), unless it's in the LRU already
+    # Returns an AnalyzedScore; raises ScoreError if the score can't be parsed
+    def load(self, score_xml, bin_divisions=4, score_hash=None):
+        if score_hash is None:
+            score_hash = hashlib.sha1(score_xml).hexdigest()
+        key = (score_hash, bin_divisions)
+        score = self.scores.pop(key, None)
+        if score is not None:
+            self.scores[key] = score # most recently used go last
+            self.hits += 1
+            return score
+        self.misses += 1
+
+        try:
+            measures, parts = get_score_measures(parse_musicxml(score_xml))
+        except (xml.parsers.expat.ExpatError, KeyError, TypeError) as e:
+            raise ScoreError('could not read score: {!r}'.format(e))
+        levels = ScoreLevels(measures, [1, bin_divisions], meter=get_measure_meters(measures, parts))
+        measure_bins = levels.get_bins(bin_divisions)
+        bin_durations = levels.bin_durations[bin_divisions]
+
+        measure_values = score_values = None
+        if self.cache is not None:
+            measure_values = self.cache.get(score_hash, 1)
+            score_values = self.cache.get(score_hash, bin_divisions)
+        if measure_values is None:
+            measure_values = levels.get_values(1)
+            if self.cache is not None:
+                self.cache.put(score_hash, 1, measure_values)
+        if score_values is None:
+            score_values = levels.get_values(bin_divisions)
+            if self.cache is not None:
+                self.cache.put(score_hash, bin_divisions, score_values)
+
+        score = AnalyzedScore(score_hash, score_xml, measures, parts, levels.meters, measure_bins, bin_durations, bin_divisions, measure_values, score_values)
+        self.scores[key] = score
+        while len(self.scores) > self.max_scores:
+            self.scores.popitem(last=False)
+        return score
+
+    # Difficulty report of a score (MusicXML)
+    def analyze(self, score_xml, weights, bin_divisions=4, score_hash=None):
+        score = self.load(score_xml, bin_divisions, score_hash)
+        return self.report(score, weights)
+
+    # Difficulty report of an AnalyzedScore (see AnalyzedScore.report())
+    def report(self, score, weights):
+        return score.report(weights)
+
+    # Generate a variation of a score (MusicXML) at target_difficulty; parameters as
+    # with generate_bins(). Each part is generated on its own (with 'plan', edits are
+    # planned per part).
+    #   - part_ids: ids of the parts to generate variations of (all if None); the other
+    #     parts are left as they are
+    #   - edits: return the variation as an edit log (see EditLog) instead of MusicXML
+    # Returns the variation (MusicXML, encoded as the score is; unchanged measures are
+    # copied from it as they are) and a report of the original and new difficulty
+    def generate(self, score_xml, target_difficulty, weights, gradients, stochastic_modifier=0.5, max_iterations=11, seed=None, bin_divisions=4, score_hash=None, strategy='stochastic', budget=64, part_ids=None, edits=False):
+        session = self.session(score_xml, target_difficulty, weights, gradients, stochastic_modifier, max_iterations, seed, bin_divisions, score_hash, strategy, budget, part_ids)
+        if edits:
+            return session.edit_log().dumps(), session.report()
+        return session.variant(), session.report()
+
+    # Start an adaptive learning session on a score (MusicXML) with its first variation
+    # (see ScatlavaSession); parameters as with generate()
+    def session(self, score_xml, target_difficulty, weights, gradients, stochastic_modifier=0.5, max_iterations=11, seed=None, bin_divisions=4, score_hash=None, strategy='stochastic', budget=64, part_ids=None):
+        if strategy == 'retrieve':
+            if self.bank is None:
+                raise ValueError('the retrieve strategy needs a corpus index (bank)')
+            bin_bank.load(self.bank, bin_divisions)
+        score = self.load(score_xml, bin_divisions, score_hash)
+        return ScatlavaSession(score, target_difficulty, weights, gradients, stochastic_modifier, max_iterations, seed, strategy, budget, part_ids)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.,
+            'entries': len(self.scores),
+            'max_size': self.max_scores
         }
-    },
-    171: {
-        'type': 'quarter',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': 'quarter'
+
+
+# A variation of an AnalyzedScore that can be generated again bin by bin, for the
+# adaptive learning loop: when a student marks a few measures (or beats) as too hard,
+# update() gives just those a new target difficulty (or gradients) and regenerates only
+# their bins, always from the original bins. The new overall difficulties, by bins and
+# by measures, are updated by what the regenerated bins and measures add or take away
+# rather than by analyzing the whole variation again.
+#   - score: AnalyzedScore (which is only read from, so it can stay in an engine's LRU)
+#   - target_difficulty, gradients: to start every bin with
+#   - map_tasks: map() to generate the first variation with, e.g. a process pool's (see
+#     generate_bins_task()); every measure (or, with 'plan', every part) is a task
+#   - the other parameters as with ScatlavaEngine.generate()
+class ScatlavaSession(object):
+    def __init__(self, score, target_difficulty, weights, gradients, stochastic_modifier=0.5, max_iterations=11, seed=None, strategy='stochastic', budget=64, part_ids=None, map_tasks=map):
+        self.score = score
+        self.target_difficulty = target_difficulty
+        self.weights = weights
+        self.stochastic_modifier = stochastic_modifier
+        self.max_iterations = max_iterations
+        self.seed = seed
+        self.strategy = strategy
+        self.budget = budget
+        bin_divisions = score.bin_divisions
+        num_bins = len(score.meters) * bin_divisions
+        self.targets = [target_difficulty] * num_bins # target difficulty of every bin
+        self.gradients = [gradients] * num_bins # gradients of every bin
+
+        # the first variation, as with ScatlavaEngine.generate()
+        tasks = []
+        task_ranges = [] # measures each task generates
+        for part_id, start, end in score.parts:
+            if part_ids is not None and part_id not in part_ids:
+                continue
+            if strategy == 'plan':
+                tasks.append(([bin for bins in score.measure_bins[start:end] for bin in bins], score.score_values[start*bin_divisions:end*bin_divisions], score.bin_durations[start*bin_divisions:end*bin_divisions], bin_divisions, target_difficulty, weights, budget))
+                task_ranges.append((start, end))
+                continue
+            for mi in xrange(start, end):
+                bin_values = score.score_values[mi*bin_divisions:(mi+1)*bin_divisions]
+                bin_durations = score.bin_durations[mi*bin_divisions:(mi+1)*bin_divisions]
+                tasks.append((score.measure_bins[mi], bin_values, mi, bin_durations, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, max_iterations, seed, strategy, budget, score.meters[mi]))
+                task_ranges.append((mi, mi+1))
+        with metrics.stage('generation'):
+            results = map_tasks(plan_bins_task if strategy == 'plan' else generate_bins_task, tasks)
+        self.measure_bins = list(score.measure_bins) # bins of the variation's measures
+        for (start, end), (bins, counts) in zip(task_ranges, results):
+            for mi in xrange(start, end):
+                self.measure_bins[mi] = bins[(mi-start)*bin_divisions:(mi-start+1)*bin_divisions]
+            metrics.merge(counts)
+
+        with metrics.stage('analysis'):
+            self.score_values = analyze_bins([bin for bins in self.measure_bins for bin in bins], score.bin_durations, bin_divisions)
+        with metrics.stage('serialize'):
+            self.measures = score.with_bins(self.measure_bins) # changed measures, by index
+        with metrics.stage('analysis'):
+            self.measure_values = list(score.measure_values)
+            dirty = sorted(self.measures)
+            for mi, values in zip(dirty, analyze_measures([self.measures[mi] for mi in dirty], 1, [score.meters[mi] for mi in dirty])):
+                self.measure_values[mi] = values
+
+        self.base_report = score.report(weights)
+        self.totals = {
+            'new_overall_difficulty': calculate_overall_difficulty_from_values(self.score_values, weights, bin_divisions),
+            'new_overall_difficulty_by_measure': calculate_overall_difficulty_from_values(self.measure_values, weights, 1)
         }
-    },
-    172: {
-        'type': 'quarter',
-        'time-modification': {
-            'actual-notes': 3,
-            'normal-notes': 2,
-            'normal-type': 'quarter'
+        self.part_totals = report_parts(score.parts, weights, {
+            'new_overall_difficulty': (self.score_values, bin_divisions),
+            'new_overall_difficulty_by_measure': (self.measure_values, 1)
+        })
+        self.measure_parts = [] # index of every measure's part
+        for pi, (part_id, start, end) in enumerate(score.parts):
+            self.measure_parts += [pi] * (end - start)
+
+    # Report of the original and the current variation's difficulty, as from
+    # ScatlavaEngine.generate()
+    def report(self):
+        report = copy.deepcopy(self.base_report)
+        report.update({
+            'target_difficulty': self.target_difficulty,
+            'seed': self.seed
+        })
+        report.update(self.totals)
+        for part_report, new_part_report in zip(report['parts'], self.part_totals):
+            part_report.update(new_part_report)
+        return report
+
+    # Difficulty of every measure of the current variation (by bins)
+    def measure_difficulties(self):
+        bin_divisions = self.score.bin_divisions
+        return [calculate_measure_difficulty_from_values(self.score_values[mi*bin_divisions:(mi+1)*bin_divisions], self.weights, bin_divisions) for mi in xrange(len(self.measure_bins))]
+
+    # The current variation (MusicXML, see AnalyzedScore.splice())
+    def variant(self):
+        with metrics.stage('serialize'):
+            return self.score.splice(self.measures)
+
+    # Edit log of the current variation (see EditLog)
+    def edit_log(self):
+        return EditLog.from_bins(self.score.score_hash, self.score.bin_divisions, self.score.meters, self.score.measure_bins, self.measure_bins, {'target_difficulty': self.target_difficulty, 'seed': self.seed, 'strategy': self.strategy})
+
+    # Give measures or single bins a new target difficulty and/or gradients, and
+    # regenerate (from the original) the bins that changed
+    #   - targets: {mi: target_difficulty} for every bin of measure mi, or {(mi, bi):
+    #     target_difficulty} for bin bi of it; mi counts the measures of all parts, one
+    #     part after another (as in the report's measure_difficulties)
+    #   - gradients: likewise, with gradients in {'d': x, 's': y, 'c': z} form
+    # With 'plan', the bins being regenerated that share a part and a target are planned
+    # together.
+    # Returns the indices of the measures that were regenerated
+    def update(self, targets=None, gradients=None):
+        score = self.score
+        bin_divisions = score.bin_divisions
+        changed = set() # bins (indices into all of the score's bins) to regenerate
+        for settings, new_settings in [(self.targets, targets), (self.gradients, gradients)]:
+            for key, setting in (new_settings or {}).iteritems():
+                for i in self.get_bin_indices(key):
+                    if settings[i] != setting:
+                        settings[i] = setting
+                        changed.add(i)
+        if not changed:
+            return []
+
+        new_bins = {}
+        if self.strategy == 'plan':
+            groups = collections.defaultdict(list)
+            for i in sorted(changed):
+                groups[(self.measure_parts[i / bin_divisions], self.targets[i])].append(i)
+            for (pi, target_difficulty), indices in groups.iteritems():
+                planned = plan_bins([score.measure_bins[i / bin_divisions][i % bin_divisions] for i in indices], [score.score_values[i] for i in indices], [score.bin_durations[i] for i in indices], bin_divisions, target_difficulty, self.weights, self.budget)
+                new_bins.update(zip(indices, planned))
+        else:
+            for i in sorted(changed):
+                mi, bi = divmod(i, bin_divisions)
+                new_bins[i] = generate_bin(score.measure_bins[mi][bi], score.score_values[i], mi, bi, score.bin_durations[i], bin_divisions, self.targets[i], self.weights, self.gradients[i], self.stochastic_modifier, self.max_iterations, self.seed, self.strategy, self.budget, score.meters[mi])
+
+        # what the new bins add to or take away from the totals, by bins...
+        indices = sorted(new_bins)
+        dirty = sorted(set(i / bin_divisions for i in indices))
+        for mi in dirty:
+            self.measure_bins[mi] = list(self.measure_bins[mi])
+        for i, values in zip(indices, analyze_bins([new_bins[i] for i in indices], [score.bin_durations[i] for i in indices], bin_divisions)):
+            mi, bi = divmod(i, bin_divisions)
+            self.measure_bins[mi][bi] = new_bins[i]
+            self.add_difficulty('new_overall_difficulty', mi, (self.get_difficulty(values) - self.get_difficulty(self.score_values[i])) / bin_divisions)
+            self.score_values[i] = values
+
+        # ...and by measures (those that are back to their original bins are back to their
+        # original values)
+        for mi in dirty:
+            if get_dirty_measures([score.measure_bins[mi]], [self.measure_bins[mi]]):
+                self.measures[mi] = score.get_measures([mi])[mi]
+                set_measure_bins(self.measures[mi], self.measure_bins[mi], score.meters[mi])
+            else:
+                self.measures.pop(mi, None)
+        changed = [mi for mi in dirty if mi in self.measures]
+        new_values = dict(zip(changed, analyze_measures([self.measures[mi] for mi in changed], 1, [score.meters[mi] for mi in changed])))
+        for mi in dirty:
+            values = new_values.get(mi, score.measure_values[mi])
+            self.add_difficulty('new_overall_difficulty_by_measure', mi, self.get_difficulty(values) - self.get_difficulty(self.measure_values[mi]))
+            self.measure_values[mi] = values
+        return dirty
+
+    # Indices (into all of the score's bins) of the bins of measure mi, or of bin bi of
+    # it for (mi, bi)
+    def get_bin_indices(self, key):
+        bin_divisions = self.score.bin_divisions
+        mi, bis = (key[0], [key[1]]) if isinstance(key, tuple) else (key, xrange(bin_divisions))
+        if not 0 <= mi < len(self.measure_bins) or any(not 0 <= bi < bin_divisions for bi in bis):
+            raise ValueError('no such measure or bin: {}'.format(key))
+        return [mi*bin_divisions + bi for bi in bis]
+
+    def get_difficulty(self, values):
+        return calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], self.weights)
+
+    # Add a change in the difficulty of measure mi (already divided by the number of bins
+    # per measure for by-bins totals) to a total and to its part's
+    def add_difficulty(self, key, mi, difference):
+        part = self.part_totals[self.measure_parts[mi]]
+        self.totals[key] += difference / len(self.measure_bins)
+        part[key] += difference / part['measures']
+
+
+# Streams a MusicXML score measure by measure instead of parsing the whole document.
+# Each <measure> is handed to process_measure(measure, mi, part_id) as soon as its
+# closing tag has been read (mi counting the measures of all parts, one part after
+# another) and the result is written straight to f_out; if process_measure returns None
+# the measure is copied through as it was. Everything outside of measures (header, part
+# tags, comments) is copied through verbatim.
+class MeasureStreamer(object):
+    def __init__(self, f_in, f_out, process_measure, chunk_size=65536):
+        self.f_in = f_in
+        self.f_out = f_out
+        self.process_measure = process_measure
+        self.chunk_size = chunk_size
+        self.buffer = '' # raw input bytes from buffer_offset on
+        self.buffer_offset = 0
+        self.written = 0 # input offset up to which everything has been written
+        self.path = []
+        self.measure_start = None
+        self.safe_offset = 0 # everything before this offset is complete and outside of measures
+        self.indentation = ''
+        self.num_measures = 0
+        self.part_id = None
+
+    # Run through the whole input; returns the number of measures processed
+    def run(self):
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.start_element
+        self.parser.EndElementHandler = self.end_element
+        while True:
+            chunk = self.f_in.read(self.chunk_size)
+            self.buffer += chunk
+            self.parser.Parse(chunk, not chunk)
+            if not chunk:
+                break
+            if self.measure_start is None:
+                self.flush(self.safe_offset)
+
+            # drop what has already been written
+            self.buffer = self.buffer[self.written - self.buffer_offset:]
+            self.buffer_offset = self.written
+        self.flush(self.buffer_offset + len(self.buffer))
+        return self.num_measures
+
+    def start_element(self, name, attrs):
+        self.path.append(name)
+        if self.measure_start is not None:
+            return
+        self.safe_offset = self.parser.CurrentByteIndex
+        if name == 'part' and len(self.path) == 2:
+            self.part_id = attrs.get('id')
+        if name == 'measure' and len(self.path) > 1 and self.path[-2] == 'part':
+            self.flush(self.safe_offset)
+            self.measure_start = self.safe_offset
+
+    def end_element(self, name):
+        self.path.pop()
+        i = self.parser.CurrentByteIndex
+        if self.measure_start is None:
+            self.safe_offset = i
+            return
+        if name != 'measure' or len(self.path) < 1 or self.path[-1] != 'part':
+            return
+
+        # find where the measure ends (either at </measure> or right after <measure/>)
+        bi = i - self.buffer_offset
+        if self.buffer.startswith('</measure', bi):
+            bi = self.buffer.index('>', bi) + 1
+        measure_xml = self.buffer[self.measure_start - self.buffer_offset:bi]
+        self.written = self.safe_offset = self.buffer_offset + bi
+        self.measure_start = None
+
+        with metrics.stage('parse'):
+            measure = parse_musicxml(measure_xml)['measure']
+        measure = self.process_measure(measure, self.num_measures, self.part_id)
+        self.num_measures += 1
+        if self.f_out is not None:
+            if measure is None:
+                self.f_out.write(measure_xml)
+            else:
+                with metrics.stage('serialize'):
+                    self.f_out.write(unparse_measure(measure, self.indentation))
+
+    # Copy input bytes up to offset through to the output
+    def flush(self, offset):
+        if offset <= self.written:
+            return
+        data = self.buffer[self.written - self.buffer_offset:offset - self.buffer_offset]
+        if self.f_out is not None:
+            self.f_out.write(data)
+        self.indentation = data.rsplit('\n', 1)[-1]
+        self.written = offset
+
+# Serialize a single measure, indented to sit where the original measure was. The
+# measure's cursor moves (see get_measure_moves()) are written among its notes.
+def unparse_measure(measure, indentation=''):
+    indent = indentation[-1:] or '\t'
+    moves = get_measure_moves(measure)
+    if moves and 'note' in measure:
+        elements = [('note', note) for note in get_measure_notes(measure)]
+        for ni, ticks in reversed(moves):
+            elements.insert(ni, ('backup' if ticks < 0 else 'forward', collections.OrderedDict([('duration', str(abs(ticks)))])))
+        measure = collections.OrderedDict(measure)
+        measure['note'] = notes_marker
+    measure_xml = xmltodict.unparse({'measure': measure}, full_document=False, pretty=True, indent=indent)
+    if moves and 'note' in measure:
+        before, marker, after = measure_xml.partition('<note>{}</note>'.format(notes_marker))
+        element_indentation = before[before.rfind('\n') + 1:]
+        elements_xml = '\n'.join(xmltodict.unparse({name: element}, full_document=False, pretty=True, indent=indent) for name, element in elements)
+        measure_xml = before + elements_xml.replace('\n', '\n' + element_indentation) + after
+    return measure_xml.replace('\n', '\n' + indentation).encode('utf-8')
+
+# Stands in for the notes of a measure with cursor moves while it is serialized
+notes_marker = 'scatlava-notes'
+
+# Byte range (start, end) of every measure of a score (MusicXML) in score_xml, in the
+# order get_score_measures() lists them, from a single pass of expat over the document
+# (nothing is parsed into dicts)
+def get_measure_offsets(score_xml):
+    offsets = []
+    path = []
+    parser = xml.parsers.expat.ParserCreate()
+
+    def start_element(name, attrs):
+        path.append(name)
+        if name == 'measure' and len(path) == 3 and path[1] == 'part':
+            offsets.append(parser.CurrentByteIndex)
+
+    def end_element(name):
+        path.pop()
+        if name == 'measure' and len(path) == 2 and path[1] == 'part':
+            # either at </measure> or right after <measure/>
+            start = offsets[-1]
+            i = parser.CurrentByteIndex
+            if not score_xml.startswith('</measure', i):
+                i = start
+            offsets[-1] = (start, score_xml.index('>', i) + 1)
+
+    parser.StartElementHandler = start_element
+    parser.EndElementHandler = end_element
+    parser.Parse(score_xml, True)
+    return offsets
+
+# Parse single measures of a score from their byte ranges (see get_measure_offsets())
+# Returns measure index -> measure (xmltodict) for every index in mis
+def parse_measures_at(score_xml, measure_offsets, mis):
+    measures = {}
+    for mi in mis:
+        start, end = measure_offsets[mi]
+        measures[mi] = parse_musicxml(score_xml[start:end])['measure']
+    return measures
+
+# Indices of the measures that generation changed: adjusted bins are copies with a log
+# of their changes (see Bin), and bins that needed no adjustment are the original ones
+def get_dirty_measures(measure_bins, new_measure_bins):
+    return [mi for mi, bins in enumerate(new_measure_bins) if bins is not measure_bins[mi] and any(bin is not orig_bin and bin.changes for bin, orig_bin in zip(bins, measure_bins[mi]))]
+
+# Write a score (MusicXML) to f with some of its measures replaced, copying everything
+# else (header, credits, formatting, every other measure) from score_xml byte for byte
+#   - measure_offsets: byte range of every measure (see get_measure_offsets())
+#   - new_measures: measure index -> measure (xmltodict) to write in its place
+def splice_measures(score_xml, measure_offsets, new_measures, f):
+    written = 0
+    for mi in sorted(new_measures):
+        start, end = measure_offsets[mi]
+        f.write(score_xml[written:start])
+        line_start = score_xml.rfind('\n', 0, start) + 1
+        indentation = score_xml[line_start:start]
+        f.write(unparse_measure(new_measures[mi], indentation[:len(indentation) - len(indentation.lstrip())]))
+        written = end
+    f.write(score_xml[written:])
+
+
+# A generated variation as the edits that make it out of the original score, rather
+# than as MusicXML, tied to the content hash of the score they apply to. The change log
+# of every bin generation adjusted (see Bin) is boiled down to what changed about its
+# notes (see get_bin_edits()); replaying that (see apply()) gives the same variation,
+# byte for byte, as writing it out directly.
+# Edit logs are written as NDJSON: a header object (format, version, score hash,
+# bin_divisions, meters, and whatever else was given as info, e.g. target difficulty
+# and seed), then one line per edited measure as [measure, bins], bins having the edits
+# of each of the measure's bins in order (null for bins left as they were, and none
+# after the last edited one). Measures are numbered from 0 over all parts, one part
+# after another. The edits of a bin are an object with only the fields that changed,
+# notes being referred to by their index in the original bin:
+#   - notes: the notes that replaced the bin's (see pack_note_spec()); the other fields
+#     then refer to the new notes
+#   - pitch: [note, display-step and display-octave (e.g. "C5"), notehead] of every
+#     note played on another instrument (the notehead only if it changed)
+#   - rest, beam: notes turned into rests, and notes whose beam was stripped
+#   - order: the notes that are left, in their new order
+# Meters are listed as [measure, divisions, length] for the first edited measure and
+# wherever the meter changes from one edited measure to the next.
+#   - meters: measure index -> Meter of every edited measure
+#   - edits: [measure, bin, edits] of every edited bin
+class EditLog(object):
+    format = 'scatlava-edits'
+    version = 2 # bump whenever edits change meaning, so old logs aren't misapplied
+
+    def __init__(self, score_hash, bin_divisions, meters, edits, info=None):
+        self.score_hash = score_hash
+        self.bin_divisions = bin_divisions
+        self.meters = meters
+        self.edits = edits
+        self.info = info or {}
+
+    # Edit log of a generated variation
+    #   - measure_meters: Meter of every measure
+    #   - measure_bins, new_measure_bins: original and adjusted bins of every measure
+    @classmethod
+    def from_bins(cls, score_hash, bin_divisions, measure_meters, measure_bins, new_measure_bins, info=None):
+        meters = {}
+        edits = []
+        for mi in get_dirty_measures(measure_bins, new_measure_bins):
+            for bi, bin in enumerate(new_measure_bins[mi]):
+                if bin is not measure_bins[mi][bi]:
+                    bin_edits = cls.get_bin_edits(bin.changes, measure_bins[mi][bi])
+                    if bin_edits:
+                        edits.append([mi, bi, bin_edits])
+            if edits and edits[-1][0] == mi:
+                meters[mi] = measure_meters[mi]
+        return cls(score_hash, bin_divisions, meters, edits, info)
+
+    # What a change log did to a bin's notes, as the edits of a bin (see above): the
+    # last pitch of every note that is left (unless it's the one it had), whether it was
+    # turned into a rest or had its beam stripped, and the order of the notes that are
+    # left (if any were removed or moved). If the bin's notes were replaced, the rest is
+    # about the new notes.
+    #   - bin: the original bin
+    @staticmethod
+    def get_bin_edits(changes, bin):
+        edits = collections.OrderedDict()
+        notes = [(note.instrument, note.notehead) for note in bin]
+        replaced = [ci for ci, change in enumerate(changes) if change[0] == 'replace']
+        if replaced:
+            specs = changes[replaced[-1]][2]
+            edits['notes'] = [pack_note_spec(spec) for spec in specs]
+            changes = changes[replaced[-1]+1:]
+            notes = [(get_instrument_id(step, octave) if step is not None else rest_instrument_id, notehead) for offset, duration, step, octave, notehead in specs]
+        num_notes = len(notes)
+        order = range(num_notes) # original index of the note at every position
+        rests = set()
+        beams = set()
+        pitches = {} # original index -> instrument, notehead
+        for change in changes:
+            operation, i = change[0], change[1]
+            if operation == 'remove':
+                order.pop(i)
+            elif operation == 'swap':
+                j = change[2]
+                order[i], order[j] = order[j], order[i]
+            elif operation == 'rest':
+                rests.add(order[i])
+            elif operation == 'beam':
+                beams.add(order[i])
+            elif operation == 'pitch':
+                instrument, notehead = change[2], change[3]
+                if notehead is None and order[i] in pitches: # keeps the notehead it had
+                    notehead = pitches[order[i]][1]
+                pitches[order[i]] = (instrument, notehead)
+
+        kept = set(order)
+        if pitches:
+            edits['pitch'] = [[ni, ''.join(instrument_names[instrument])] + ([notehead] if notehead is not None else []) for ni, (instrument, notehead) in sorted(pitches.iteritems()) if ni in kept and (instrument, notehead or notes[ni][1]) != notes[ni]]
+        if rests:
+            edits['rest'] = sorted(rests & kept)
+        if beams:
+            edits['beam'] = sorted(beams & kept)
+        if order != range(num_notes):
+            edits['order'] = order
+        return collections.OrderedDict((key, value) for key, value in edits.iteritems() if value or key == 'notes')
+
+    def dumps(self):
+        header = collections.OrderedDict([
+            ('format', self.format),
+            ('version', self.version),
+            ('score', self.score_hash),
+            ('bin_divisions', self.bin_divisions),
+            ('meters', [])
+        ])
+        for mi, meter in sorted(self.meters.iteritems()):
+            if not header['meters'] or header['meters'][-1][1:] != [meter.divisions, str(meter.length)]:
+                header['meters'].append([mi, meter.divisions, str(meter.length)])
+        header.update(sorted(self.info.iteritems()))
+        measures = collections.OrderedDict()
+        for mi, bi, edits in self.edits:
+            bins = measures.setdefault(mi, [])
+            bins += [None] * (bi + 1 - len(bins))
+            bins[bi] = edits
+        lines = [json.dumps(header)] + [json.dumps([mi, bins], separators=(',', ':')) for mi, bins in measures.iteritems()]
+        return '\n'.join(lines) + '\n'
+
+    @classmethod
+    def loads(cls, edit_log):
+        lines = [line for line in edit_log.splitlines() if line.strip()]
+        header = json.loads(lines[0], object_pairs_hook=collections.OrderedDict)
+        if header.get('format') != cls.format or header.get('version') != cls.version:
+            raise ValueError('not a version {} edit log'.format(cls.version))
+        edits = []
+        for line in lines[1:]:
+            mi, bins = json.loads(line, object_pairs_hook=collections.OrderedDict)
+            edits += [[mi, bi, bin_edits] for bi, bin_edits in enumerate(bins) if bin_edits]
+        meter_runs = header.pop('meters')
+        meter_starts = [mi for mi, divisions, length in meter_runs]
+        meters = {}
+        for mi in set(edit[0] for edit in edits):
+            start, divisions, length = meter_runs[bisect.bisect_right(meter_starts, mi) - 1]
+            meters[mi] = get_meter(divisions, fractions.Fraction(length))
+        info = dict((key, value) for key, value in header.iteritems() if key not in ('format', 'version', 'score', 'bin_divisions'))
+        return cls(header['score'], header['bin_divisions'], meters, edits, info)
+
+    # The variation (MusicXML, encoded as the score is): only the edited measures are
+    # parsed, binned and replayed, and spliced into the score (see splice_measures())
+    #   - score_xml: the original score; raises ValueError if it isn't the one the edits
+    #     were made on
+    def apply(self, score_xml, measure_offsets=None):
+        if hashlib.sha1(score_xml).hexdigest() != self.score_hash:
+            raise ValueError('edit log is for score {}, not this one'.format(self.score_hash))
+        if measure_offsets is None:
+            measure_offsets = get_measure_offsets(score_xml)
+        new_measures = parse_measures_at(score_xml, measure_offsets, self.meters)
+        measure_bins = dict((mi, bin_measure(measure, self.bin_divisions, meter=self.meters[mi])[0]) for mi, measure in new_measures.iteritems())
+        for mi, bi, edits in self.edits:
+            unknown = set(edits) - set(['notes', 'pitch', 'rest', 'beam', 'order'])
+            if unknown:
+                raise ValueError('unknown edit: {}'.format(', '.join(sorted(unknown))))
+            self.apply_bin_edits(measure_bins[mi][bi], edits, self.meters[mi].divisions)
+        for mi, measure in new_measures.iteritems():
+            set_measure_bins(measure, measure_bins[mi], self.meters[mi])
+        f = cStringIO.StringIO()
+        splice_measures(score_xml, measure_offsets, new_measures, f)
+        return f.getvalue()
+
+    # Replay the edits of a bin (see get_bin_edits()) on the original bin: the
+    # replacement, the changes to each note, then the removals (from the last note back)
+    # and the swaps that put the notes that are left in their order
+    #   - divisions: of the bin's measure, for replaced notes
+    @staticmethod
+    def apply_bin_edits(bin, edits, divisions):
+        if 'notes' in edits:
+            bin.replace_notes([unpack_note_spec(spec) for spec in edits['notes']], divisions)
+        for ni in edits.get('rest', ()):
+            bin.set_rest(ni)
+        for pitch in edits.get('pitch', ()):
+            ni, name, notehead = pitch[0], pitch[1], pitch[2] if len(pitch) > 2 else None
+            bin.set_pitch(ni, Note(0, 0, get_instrument_id(name[0], name[1:]), notehead=notehead))
+        for ni in edits.get('beam', ()):
+            bin.clear_beam(ni)
+        order = edits.get('order')
+        if order is not None:
+            kept = set(order)
+            for ni in reversed(xrange(len(bin))):
+                if ni not in kept:
+                    bin.remove_note(ni)
+            current = sorted(order)
+            for i in xrange(len(current)):
+                if current[i] != order[i]:
+                    j = current.index(order[i], i+1)
+                    current[i], current[j] = current[j], current[i]
+                    bin.swap_notes(i, j)
+
+
+# A note spec (see Bin.replace_notes()) as an edit log has it: [offset, duration] for a
+# rest, [offset, duration, pitch] for a note (display-step and display-octave, e.g.
+# "C5"), and the notehead after that if it has one
+def pack_note_spec(spec):
+    offset, duration, step, octave, notehead = spec
+    if step is None:
+        return [offset, duration]
+    return [offset, duration, step + octave] + ([notehead] if notehead is not None else [])
+
+# The note spec of a packed one (see pack_note_spec())
+def unpack_note_spec(packed):
+    if len(packed) == 2:
+        return [packed[0], packed[1], None, None, None]
+    return [packed[0], packed[1], packed[2][0], packed[2][1:], packed[3] if len(packed) > 3 else None]
+
+
+# Compressed MusicXML (.mxl): a zip archive whose META-INF/container.xml points to the
+# score (the rootfile), optionally preceded by an uncompressed mimetype entry
+mxl_mimetype = 'application/vnd.recordare.musicxml'
+musicxml_media_type = 'application/vnd.recordare.musicxml+xml'
+mxl_container = '''<?xml version="1.0" encoding="UTF-8"?>
+<container>
+  <rootfiles>
+    <rootfile full-path="{}" media-type="{}"/>
+  </rootfiles>
+</container>
+'''
+
+def is_mxl_path(path):
+    return path.lower().endswith('.mxl')
+
+# Name of the MusicXML rootfile of an .mxl archive (a ZipFile): the first MusicXML
+# rootfile listed in META-INF/container.xml or, without one, the first MusicXML file at
+# the top of the archive
+def get_mxl_rootfile(zf):
+    try:
+        container = xmltodict.parse(zf.read('META-INF/container.xml'))
+    except KeyError:
+        container = None
+    if container:
+        rootfiles = ((container.get('container') or {}).get('rootfiles') or {}).get('rootfile') or []
+        if type(rootfiles) != list:
+            rootfiles = [rootfiles]
+        for rootfile in rootfiles:
+            if rootfile.get('@media-type', musicxml_media_type) == musicxml_media_type:
+                return rootfile['@full-path']
+    for name in zf.namelist():
+        if '/' not in name and name.lower().endswith(('.xml', '.musicxml')):
+            return name
+    raise zipfile.BadZipfile('no MusicXML rootfile in archive')
+
+# Open a score (a path or a file) for reading: MusicXML as it is or, for a compressed
+# MusicXML archive, its rootfile, decompressed as it's read rather than extracted
+@contextlib.contextmanager
+def open_score(path):
+    is_mxl = zipfile.is_zipfile(path)
+    if not isinstance(path, basestring):
+        path.seek(0) # is_zipfile() reads the file
+        if not is_mxl:
+            yield path
+            return
+    elif not is_mxl:
+        with open(path, 'rb') as f:
+            yield f
+        return
+    with contextlib.closing(zipfile.ZipFile(path)) as zf:
+        with contextlib.closing(zf.open(get_mxl_rootfile(zf))) as f:
+            yield f
+
+# Create a compressed MusicXML archive at path, with its mimetype and container entries
+# (entries get a fixed date so the same score always makes the same archive)
+# Returns the ZipFile and the name to write the score (the rootfile) as, which is named
+# after path (e.g. out.mxl -> out.xml)
+def create_mxl(path):
+    rootfile = os.path.splitext(os.path.basename(path))[0] + '.xml'
+    zf = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    zf.writestr(get_mxl_info('mimetype', zipfile.ZIP_STORED), mxl_mimetype)
+    zf.writestr(get_mxl_info('META-INF/container.xml'), mxl_container.format(rootfile, musicxml_media_type))
+    return zf, rootfile
+
+def get_mxl_info(name, compress_type=zipfile.ZIP_DEFLATED):
+    info = zipfile.ZipInfo(name, (1980, 1, 1, 0, 0, 0))
+    info.compress_type = compress_type
+    info.external_attr = 0644 << 16
+    return info
+
+# Write a score (MusicXML as a string) to path as compressed MusicXML
+def write_mxl(path, score_xml):
+    zf, rootfile = create_mxl(path)
+    with contextlib.closing(zf):
+        zf.writestr(get_mxl_info(rootfile), score_xml)
+
+# Open a file to write a score (MusicXML) to bit by bit (see MeasureStreamer),
+# compressed if path ends in .mxl. zipfile can only add whole files to an archive, so
+# an .mxl score goes to a temporary file next to it first, and is then archived as with
+# write_mxl() (so the archive doesn't depend on when it was written).
+@contextlib.contextmanager
+def create_score(path):
+    if not is_mxl_path(path):
+        with open(path, 'wb') as f:
+            yield f
+        return
+    f = tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), suffix='.xml.tmp', delete=False)
+    try:
+        with f:
+            yield f
+        with open(f.name, 'rb') as tmp:
+            write_mxl(path, tmp.read())
+    finally:
+        os.remove(f.name)
+
+
+# Persistent on-disk cache of analysis values, keyed by the content hash of a score and
+# bin_divisions. Values only depend on the notes and on how they are binned (not on
+# weights), so with a cache hit re-weighting a score only takes combining the cached
+# values. Each entry is a JSON file holding [d, s, c] for every bin of the score. When the
+# cache grows beyond max_size bytes the least recently used entries are evicted
+# (entries are touched whenever they are read).
+class AnalysisCache(object):
+    version = 3 # bump whenever binning or analysis changes, so old entries are ignored
+
+    def __init__(self, cache_dir, max_size=64*1024*1024):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def get_path(self, score_hash, bin_divisions):
+        return os.path.join(self.cache_dir, '{}-{}-v{}.json'.format(score_hash, bin_divisions, self.version))
+
+    # Returns the cached values (as from analyze_bins()) or None
+    def get(self, score_hash, bin_divisions):
+        path = self.get_path(score_hash, bin_divisions)
+        try:
+            with open(path, 'r') as f:
+                cached_values = json.load(f)
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return [{
+            'density': d,
+            'syncopation': s,
+            'coordination': c
+        } for d, s, c in cached_values]
+
+    def put(self, score_hash, bin_divisions, score_values):
+        path = self.get_path(score_hash, bin_divisions)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump([[values['density'], values['syncopation'], values['coordination']] for values in score_values], f)
+        os.rename(tmp_path, path)
+        self.evict()
+
+    # Remove least recently used entries until the cache fits in max_size
+    def evict(self):
+        entries = self.get_entries()
+        size = sum(entry_size for entry_mtime, entry_size, path in entries)
+        for entry_mtime, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= entry_size
+            self.evictions += 1
+
+    # (mtime, size, path) of every entry
+    def get_entries(self):
+        entries = []
+        for filename in os.listdir(self.cache_dir):
+            if filename.endswith('.json'):
+                path = os.path.join(self.cache_dir, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def stats(self):
+        entries = self.get_entries()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.,
+            'evictions': self.evictions,
+            'entries': len(entries),
+            'size': sum(entry_size for entry_mtime, entry_size, path in entries),
+            'max_size': self.max_size
         }
-    },
 
-    # quarter
-    252: {'type': 'quarter'}, # rounding
-    254: {'type': 'quarter'}, # rounding
-    256: {'type': 'quarter'},
 
-    # dotted quarter
-    384: {'type': 'quarter', 'dot': ''},
+# A parsed and binned score, kept on disk as columns of numbers (one .npy file each, in
+# a directory per snapshot) so that it can be memory-mapped instead of parsed again.
+# Works as a ScoreLevels: values are analyzed straight from the columns (see
+# calculate_values_for_notes()) and Notes are only made when bins are asked for. Notes
+# made from a snapshot don't have their OrderedDicts; their source is their index among
+# their measure's notes, and the measures that need to be written out are parsed from
+# their byte range in the score (see get_measure_offsets() and parse_measures_at()).
+#   - columns: name -> array (see note_columns and measure_columns)
+#   - meta: version, score hash and size, parts, and the instruments and noteheads that
+#     the instrument and notehead columns index into
+class ScoreSnapshot(ScoreLevels):
+    version = 2 # bump whenever the format (or parsing) changes, so old snapshots are ignored
+
+    # one value per note, measure after measure, in each measure's order:
+    #   onset, duration, instrument (into meta['instruments']), rest, chord (within the
+    #   measure), notehead (into meta['noteheads'], -1 for None) and index (among the
+    #   measure's xmltodict notes, see get_measure_notes())
+    note_columns = [('onset', np.int64), ('duration', np.int64), ('instrument', np.int32), ('rest', np.bool_), ('chord', np.int32), ('notehead', np.int32), ('index', np.int32)] if np else []
+    # one value per measure: first note (plus one past the last note of the score), byte
+    # range in the score, and meter (divisions, and length as numerator and denominator)
+    measure_columns = [('measure_notes', np.int64), ('measure_offsets', np.int64), ('divisions', np.int64), ('length', np.int64)] if np else []
+
+    def __init__(self, columns, meta):
+        self.columns = columns
+        self.meta = meta
+        self.parts = [tuple(part) for part in meta['parts']]
+        self.measure_offsets = columns['measure_offsets']
+        self.meters = [get_meter(divisions, fractions.Fraction(numerator, denominator)) for divisions, (numerator, denominator) in zip(columns['divisions'].tolist(), columns['length'].tolist())]
+        self.measure_bins = {}
+        self.bin_durations = {}
+        self.values = {}
+        self._measure_notes = None
+
+    # Notes of every measure, made from the columns when first asked for
+    @property
+    def measure_notes(self):
+        if self._measure_notes is None:
+            columns = self.columns
+            onsets, durations, rests, chords, indexes = [columns[name].tolist() for name in ['onset', 'duration', 'rest', 'chord', 'index']]
+            instrument_map = [get_instrument_id(step, octave) for step, octave in self.meta['instruments']]
+            instruments = [instrument_map[instrument] for instrument in columns['instrument'].tolist()]
+            notehead_map = self.meta['noteheads']
+            noteheads = [notehead_map[notehead] if notehead >= 0 else None for notehead in columns['notehead'].tolist()]
+            starts = columns['measure_notes'].tolist()
+            self._measure_notes = [[Note(onsets[ni], durations[ni], instruments[ni], rests[ni], chords[ni], noteheads[ni], indexes[ni]) for ni in xrange(start, end)] for start, end in zip(starts, starts[1:])]
+        return self._measure_notes
+
+    # Values of every bin at bin_divisions bins per measure, as from analyze_bins(), but
+    # straight from the columns. A note's bin is the last one starting at or before its
+    # onset, as in bin_notes_levels(): for bin starts duration*bi/bin_divisions, that's
+    # ((onset+1)*bin_divisions-1)/duration (at most the last bin).
+    def get_values(self, bin_divisions):
+        if bin_divisions not in self.values:
+            columns = self.columns
+            num_measures = len(self.meters)
+            measure_durations = np.array([max(meter.duration, 1) for meter in self.meters], dtype=np.int64)
+            note_measures = np.repeat(np.arange(num_measures), np.diff(columns['measure_notes']))
+            note_bins = np.minimum(((columns['onset'] + 1) * bin_divisions - 1) // measure_durations[note_measures], bin_divisions - 1)
+            note_bins += note_measures * bin_divisions
+            bin_lengths = np.bincount(note_bins, minlength=num_measures * bin_divisions)
+
+            # notes in the same bin and chord are simultaneous
+            chords = columns['chord']
+            chord_keys = note_bins * (int(chords.max()) + 1 if len(chords) else 1) + chords
+            unique_keys, chord_groups, chord_sizes = np.unique(chord_keys, return_inverse=True, return_counts=True)
+
+            starts = np.array([meter.get_bin_starts(bin_divisions) for meter in self.meters], dtype=np.int64).reshape(-1, bin_divisions)
+            ends = np.append(starts[:, 1:], measure_durations[:, None], axis=1) if num_measures else starts
+            bin_sizes = np.maximum(ends - starts, 1).ravel()
+            if bin_divisions not in self.bin_durations:
+                self.bin_durations[bin_divisions] = bin_sizes.tolist()
+
+            densities, syncopations, coordinations = calculate_values_for_notes(columns['duration'], columns['rest'], columns['instrument'], chord_sizes[chord_groups], bin_lengths, bin_sizes, bin_divisions)
+            self.values[bin_divisions] = [{
+                'density': d,
+                'syncopation': s,
+                'coordination': c
+            } for d, s, c in zip(densities.tolist(), syncopations.tolist(), coordinations.tolist())]
+        return self.values[bin_divisions]
+
+    # Columns and meta of a snapshot of a parsed score
+    #   - score_xml: the score (MusicXML), for the byte range of every measure
+    #   - measures, parts: as from get_score_measures()
+    #   - levels: ScoreLevels of the measures (made with keep_source)
+    @classmethod
+    def create(cls, score_hash, score_xml, measures, parts, levels):
+        measure_offsets = get_measure_offsets(score_xml)
+        if len(measure_offsets) != len(measures):
+            raise ValueError('found {} measures in the score but parsed {}'.format(len(measure_offsets), len(measures)))
+
+        instruments = {} # instrument id -> index into meta['instruments']
+        noteheads = {} # notehead (as JSON) -> index into meta['noteheads']
+        meta = {'version': cls.version, 'score_hash': score_hash, 'size': len(score_xml), 'parts': parts, 'instruments': [], 'noteheads': []}
+        note_values = dict((name, []) for name, dtype in cls.note_columns)
+        measure_notes = [0]
+        for mi, notes in enumerate(levels.measure_notes):
+            indexes = dict((id(source), i) for i, source in enumerate(get_measure_notes(measures[mi])))
+            for note in notes:
+                if note.instrument not in instruments:
+                    instruments[note.instrument] = len(meta['instruments'])
+                    meta['instruments'].append(instrument_names[note.instrument])
+                notehead = -1
+                if note.notehead is not None:
+                    notehead_json = json.dumps(note.notehead)
+                    if notehead_json not in noteheads:
+                        noteheads[notehead_json] = len(meta['noteheads'])
+                        meta['noteheads'].append(note.notehead)
+                    notehead = noteheads[notehead_json]
+                note_values['onset'].append(note.onset)
+                note_values['duration'].append(note.duration)
+                note_values['instrument'].append(instruments[note.instrument])
+                note_values['rest'].append(note.rest)
+                note_values['chord'].append(note.chord)
+                note_values['notehead'].append(notehead)
+                note_values['index'].append(indexes[id(note.source)])
+            measure_notes.append(measure_notes[-1] + len(notes))
+
+        columns = dict((name, np.array(note_values[name], dtype=dtype)) for name, dtype in cls.note_columns)
+        columns['measure_notes'] = np.array(measure_notes, dtype=np.int64)
+        columns['measure_offsets'] = np.array(measure_offsets, dtype=np.int64).reshape(-1, 2)
+        columns['divisions'] = np.array([meter.divisions for meter in levels.meters], dtype=np.int64)
+        columns['length'] = np.array([(meter.length.numerator, meter.length.denominator) for meter in levels.meters], dtype=np.int64).reshape(-1, 2)
+        return columns, meta
+
+# Directory of ScoreSnapshots, keyed by the content hash of a score (so a snapshot is
+# never used for a score that has changed since) and ScoreSnapshot.version. Snapshots
+# are written on a score's first load, and memory-mapped (not read) on later loads.
+# Needs numpy.
+class SnapshotStore(object):
+    def __init__(self, snapshot_dir):
+        self.snapshot_dir = snapshot_dir
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(snapshot_dir):
+            os.makedirs(snapshot_dir)
+
+    def get_path(self, score_hash):
+        return os.path.join(self.snapshot_dir, '{}-v{}'.format(score_hash, ScoreSnapshot.version))
+
+    # Returns the ScoreSnapshot of a score or None
+    def get(self, score_hash):
+        path = self.get_path(score_hash)
+        try:
+            with open(os.path.join(path, 'meta.json'), 'r') as f:
+                meta = json.load(f, object_pairs_hook=collections.OrderedDict)
+            columns = dict((name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r')) for name, dtype in ScoreSnapshot.note_columns + ScoreSnapshot.measure_columns)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return ScoreSnapshot(columns, meta)
+
+    # Write the snapshot of a parsed score (arguments as with ScoreSnapshot.create())
+    def put(self, score_hash, score_xml, measures, parts, levels):
+        path = self.get_path(score_hash)
+        if os.path.isdir(path):
+            return
+        columns, meta = ScoreSnapshot.create(score_hash, score_xml, measures, parts, levels)
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        os.makedirs(tmp_path)
+        for name, column in columns.iteritems():
+            np.save(os.path.join(tmp_path, name + '.npy'), column)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp_path, path)
+        except OSError: # written by another process in the meantime
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': float(self.hits) / lookups if lookups else 0.
+        }
 
-    # half
-    512: {'type': 'half'},
 
-    # dotted half
-    768: {'type': 'half', 'dot': ''},
+# Instrumentation for a run: wall-clock time spent per stage (parse, binning, analysis,
+# generation, serialize) and counts of what adjust_bin() did. If profiles is a dict,
+# each stage is also run under its own cProfile.Profile (stage -> profile).
+class Metrics(object):
+    def __init__(self):
+        self.stages = collections.OrderedDict() # stage -> seconds
+        self.counters = collections.Counter() # bins_adjusted, iterations, iteration_cap_hits
+        self.mutations = collections.Counter() # change type (see Bin) -> count
+        self.iterations_per_bin = collections.Counter() # iterations -> number of bins
+        self.evaluations_per_bin = collections.Counter() # metric evaluations -> number of bins
+        self.profiles = None
+        self.cur_stage = None
+
+    # Time (and profile) the enclosed code as part of stage. Stages don't nest: inside
+    # a stage, any other stage counts towards the outer one.
+    @contextlib.contextmanager
+    def stage(self, name):
+        if self.cur_stage is not None:
+            yield
+            return
+        self.cur_stage = name
+        profile = None
+        if self.profiles is not None:
+            profile = self.profiles.setdefault(name, cProfile.Profile())
+            profile.enable()
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.) + time.time() - start
+            if profile is not None:
+                profile.disable()
+            self.cur_stage = None
+
+    # Count a bin adjust_bin() (or search_bin()) is done with
+    #   - iterations: number of adjustment runs (search steps)
+    #   - changes: the bin's change log (see Bin)
+    #   - capped: whether it gave up without reaching its target difficulty
+    #   - evaluations: number of times the bin's values were calculated
+    def count_bin(self, iterations, changes, capped, evaluations):
+        if iterations > 0:
+            self.counters['bins_adjusted'] += 1
+        self.counters['iterations'] += iterations
+        self.counters['evaluations'] += evaluations
+        self.iterations_per_bin[iterations] += 1
+        self.evaluations_per_bin[evaluations] += 1
+        if capped:
+            self.counters['iteration_cap_hits'] += 1
+        for change in changes:
+            self.mutations[change[0]] += 1
+
+    # Return and reset the counts (e.g. to send them from a worker process)
+    def take_counts(self):
+        counts = (self.counters, self.mutations, self.iterations_per_bin, self.evaluations_per_bin)
+        self.counters = collections.Counter()
+        self.mutations = collections.Counter()
+        self.iterations_per_bin = collections.Counter()
+        self.evaluations_per_bin = collections.Counter()
+        return counts
+
+    # Add counts from take_counts()
+    def merge(self, counts):
+        counters, mutations, iterations_per_bin, evaluations_per_bin = counts
+        self.counters.update(counters)
+        self.mutations.update(mutations)
+        self.iterations_per_bin.update(iterations_per_bin)
+        self.evaluations_per_bin.update(evaluations_per_bin)
+
+    def to_dict(self):
+        counters = dict((name, self.counters[name]) for name in ['bins_adjusted', 'iterations', 'evaluations', 'iteration_cap_hits'])
+        counters['mutations'] = dict(self.mutations)
+        return {
+            'stages': self.stages,
+            'total_time': sum(self.stages.values()),
+            'counters': counters,
+            'iterations_per_bin': dict((str(k), v) for k, v in sorted(self.iterations_per_bin.items())),
+            'evaluations_per_bin': dict((str(k), v) for k, v in sorted(self.evaluations_per_bin.items()))
+        }
 
-    # whole
-    1024: {'type': 'whole'}
-}
+    # Write each stage's profile to profile_dir/<stage>.pstats
+    def dump_profiles(self, profile_dir):
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        for name, profile in (self.profiles or {}).iteritems():
+            profile.dump_stats(os.path.join(profile_dir, '{}.pstats'.format(name)))
+
+metrics = Metrics()
+
+
+# Note types from longest to shortest, each half as long as the one before
+note_types = ['whole', 'half', 'quarter', 'eighth', '16th', '32nd', '64th', '128th']
+
+# Tuplets notes can be written in, as (actual-notes, normal-notes)
+tuplets = [(3, 2), (5, 4), (7, 4)]
+
+# Quantization lattice for divisions (ticks per quarter note): every duration a note can
+# be written as (type, up to two dots, or a tuplet), sorted by duration. Where two of
+# them come out the same the plainer one is kept.
+# Returns the durations (in ticks, not rounded) and the note_attrs for each
+note_lattices = {}
+
+def get_note_lattice(divisions):
+    lattice = note_lattices.get(divisions)
+    if lattice is not None:
+        return lattice
+    points = {}
+    for ti, note_type in enumerate(note_types):
+        base = fractions.Fraction(divisions * 4, 2**ti)
+        for dots in xrange(3):
+            duration = base * (2 - fractions.Fraction(1, 2**dots))
+            note_attrs = {'type': note_type}
+            if dots:
+                note_attrs['dot'] = '' if dots == 1 else ['', '']
+            points.setdefault(duration, note_attrs)
+        for actual_notes, normal_notes in tuplets:
+            points.setdefault(base * normal_notes / actual_notes, {
+                'type': note_type,
+                'time-modification': {
+                    'actual-notes': actual_notes,
+                    'normal-notes': normal_notes,
+                    'normal-type': note_type
+                }
+            })
+    durations = sorted(points)
+    lattice = note_lattices[divisions] = ([float(duration) for duration in durations], [points[duration] for duration in durations])
+    return lattice
+
+# note_attrs (type, dot and time-modification) for a duration in ticks, from the point of
+# the lattice closest to it (so durations rounded to whole ticks, e.g. 85 and 86 for
+# eighth triplets at 256 divisions, come out right)
+def get_note_attrs(duration, divisions=256):
+    durations, note_attrs = get_note_lattice(divisions)
+    i = bisect.bisect_left(durations, duration)
+    if i == len(durations) or (i > 0 and duration - durations[i-1] < durations[i] - duration):
+        i -= 1
+    return note_attrs[i]
 
 
 # The main method, to be run with each generation of a new score
@@ -651,14 +3021,34 @@ if __name__ == '__main__':
 
     # Setup command-line arguments
     parser = argparse.ArgumentParser(description = 'SCATLAVA: Software for Computer-Assisted Transcription Learning through Algorithmic Variation and Analysis')
-    parser.add_argument('score_xml_in_path', help='the original transcription')
-    parser.add_argument('score_xml_out_path', help='the generated modified score', nargs='?', default='scatlava_out.xml')
+    parser.add_argument('score_xml_in_path', help='the original transcription (MusicXML, or compressed .mxl)')
+    parser.add_argument('score_xml_out_path', help='the generated modified score (compressed if it ends in .mxl)', nargs='?', default='scatlava_out.xml')
     parser.add_argument('-t', '--target_difficulty', help='0 to 1, as a ratio of original transcription\'s difficulty', default=0.5, type=float)
+    parser.add_argument('-T', '--targets', help='comma-separated target difficulties to generate one variation each for from a single analysis, e.g. 0.2,0.4,0.6,0.8', default=None)
     parser.add_argument('-w', '--weights', help='comma-separated d,s,c. e.g. 0.2,0.1,0.7', default='0.33,0.33,0.34')
     parser.add_argument('-g', '--gradients', help='comma-separated d,s,c. e.g. 0.2,0.1,0.7', default='0.33,0.33,0.34')
     parser.add_argument('-b', '--bin_divisions', help='number of bins to divide a measure into', default=4, type=int)
     parser.add_argument('-f', '--stochastic_modifier', help='0 to 1', default=0.5, type=float)
+    parser.add_argument('-i', '--max_iterations', help='number of adjustment runs per bin before giving up', default=11, type=int)
+    parser.add_argument('-S', '--strategy', help='how to adjust bins: stochastic (random adjustment runs), greedy or beam (search through candidate edits per bin), plan (fewest edits across each whole part), or retrieve (swap in the most similar easier bin from a corpus, see --bank)', default='stochastic', choices=['stochastic', 'greedy', 'beam', 'plan', 'retrieve'])
+    parser.add_argument('--budget', help='with greedy, beam or plan: maximum number of candidate bins to evaluate per bin (with plan, for each edit of a bin)', default=64, type=int)
+    parser.add_argument('--bank', help='with retrieve: corpus index (see scatlava_index.py) to retrieve bins from', default=None)
+    parser.add_argument('-P', '--parts', help='comma-separated ids of the parts to generate variations of (all by default); the others are written back as they are', default=None)
+    parser.add_argument('-r', '--seed', help='master random seed; a given seed always generates the same score', default=None, type=int)
+    parser.add_argument('-j', '--jobs', help='number of processes to generate with', default=1, type=int)
+    parser.add_argument('-c', '--cache_dir', help='directory for the persistent analysis cache (off if not given)', default=None)
+    parser.add_argument('--cache_size', help='maximum size of the analysis cache in MB', default=64, type=float)
+    parser.add_argument('--cache_stats', help='print analysis cache and bin memo statistics', action='store_true')
+    parser.add_argument('--snapshot_dir', help='directory for binary snapshots of parsed scores, memory-mapped instead of parsing a score again (needs numpy)', default=None)
+    parser.add_argument('--memo_size', help='maximum number of bin signatures to memoize values for', default=16384, type=int)
+    parser.add_argument('-v', '--verbose', help='log every measure generated (-v), down to every adjustment run (-vv)', default=0, action='count')
+    parser.add_argument('--metrics_out', '--metrics-out', help='write stage timings and generation counters to this JSON file', default=None)
+    parser.add_argument('--profile', help='directory to write a cProfile dump per stage to (<stage>.pstats)', default=None)
+    parser.add_argument('-R', '--resolutions', help='comma-separated numbers of bins per measure to print a per-measure difficulty table for, e.g. 1,2,4,8', default=None)
     parser.add_argument('-a', '--analysis_only', help='flag to set analysis mode on or off', action='store_true')
+    parser.add_argument('-E', '--edits_out', help='also write the edit log of the variation (the edits that make it out of the original) to this file', default=None)
+    parser.add_argument('--apply', help='write the variation an edit log (see --edits_out) makes out of the original transcription, instead of generating one', default=None)
+    parser.add_argument('-s', '--stream', help='parse, generate and write one measure at a time (flat memory on long scores)', action='store_true')
 
     args = parser.parse_args()
 
@@ -668,11 +3058,78 @@ if __name__ == '__main__':
     # minimum_difficulty = sys.argv[4]
     # target_difficulty = minimum_difficulty + difficulty_gradient
     target_difficulty = args.target_difficulty
+    targets = [target_difficulty]
+    if args.targets:
+        targets = [float(t) for t in args.targets.split(',')]
     weights_str = args.weights
     gradients_str = args.gradients
     bin_divisions = args.bin_divisions
     stochastic_modifier = args.stochastic_modifier
+    max_iterations = args.max_iterations
+    strategy = args.strategy
+    budget = args.budget
+    seed = args.seed
+    jobs = args.jobs
+    cache_dir = args.cache_dir
+    cache_size = args.cache_size
+    cache_stats = args.cache_stats
+    snapshot_dir = args.snapshot_dir
+    if snapshot_dir and np is None:
+        log.warning('snapshots need numpy; parsing without them')
+        snapshot_dir = None
+    bin_memo.max_size = args.memo_size
+    metrics_out = args.metrics_out
+    part_ids = None
+    if args.parts:
+        part_ids = args.parts.split(',')
+    resolutions = []
+    if args.resolutions:
+        resolutions = [int(b) for b in args.resolutions.split(',')]
+    profile_dir = args.profile
     analysis_only = args.analysis_only
+    edits_out = args.edits_out
+    stream = args.stream
+
+    logging.basicConfig(format='%(message)s', level=max(logging.WARNING - 10*args.verbose, logging.DEBUG))
+    if profile_dir:
+        metrics.profiles = {}
+
+    # Write out stage timings, counters and profiles if asked to
+    def write_metrics(cache=None):
+        if metrics_out:
+            metrics_dict = metrics.to_dict()
+            metrics_dict['bin_memo'] = bin_memo.stats()
+            if cache is not None:
+                metrics_dict['analysis_cache'] = cache.stats()
+            with open(metrics_out, 'w') as f:
+                json.dump(metrics_dict, f, indent=2)
+        if profile_dir:
+            metrics.dump_profiles(profile_dir)
+
+    # Print the difficulty of every part (for scores with more than one)
+    def print_parts(part_reports):
+        if len(part_reports) < 2:
+            return
+        for report in part_reports:
+            print 'part {part} ({measures} measures): by bins {overall_difficulty} -> {new_overall_difficulty}, by measures {overall_difficulty_by_measure} -> {new_overall_difficulty_by_measure}'.format(**report)
+
+    # Materialize a variation from its edit log
+    if args.apply:
+        with open_score(score_xml_in_path) as f:
+            score_xml = f.read()
+        with open(args.apply, 'rb') as f:
+            edit_log = EditLog.loads(f.read())
+        with metrics.stage('serialize'):
+            variant_xml = edit_log.apply(score_xml)
+        if is_mxl_path(score_xml_out_path):
+            write_mxl(score_xml_out_path, variant_xml)
+        else:
+            with open(score_xml_out_path, 'wb') as f:
+                f.write(variant_xml)
+        print 'edits to {} bins in {} measures'.format(len(edit_log.edits), len(edit_log.meters))
+        print 'wrote to {}'.format(score_xml_out_path)
+        write_metrics()
+        sys.exit(0)
 
     # Put weights in {'d': n, 's': n, 'c': n} format
     weights_arr = [float(w) for w in weights_str.split(',')]
@@ -691,167 +3148,244 @@ if __name__ == '__main__':
         'c': gradients_arr[2]
     }
 
-    # Load input score as json
-    score_xml = ''
-    with open(score_xml_in_path, 'r') as f:
-        score_xml = f.read()
-
-    score_json = xmltodict.parse(score_xml)
-    measures = score_json['score-partwise']['part']['measure'] # a list
-    # print measures[3]
-    if type(measures) != list: # 0 or 1 measures
-        measures = [measures]
-
-    duration_min = 128 # rhythmic granularity of the output score we want
-
-    # Difficulty tracking!
-    overall_difficulty_original = 0
-    overall_difficulty_new = 0
-    
-    overall_difficulty_original_by_measure = calculate_overall_difficulty(measures, weights)
-    overall_difficulty_new_by_measure = 0
-
-    # Iterate through measures
-    for mi, measure in enumerate(measures):
-        # Print measure
-        notes = measure['note']
-        prev_note_dur = 0
-        prev_note = {
-            'duration': '0',
-            'unpitched': {
-                'display-step': 'X',
-                'display-octave': '-1'
-            }
-        }
-        duration_left = 1024 # default measure length in 4/4
-        # print 'num notes before: {}'.format(len(notes))
-
-        # Measure values
-        measure_density = 0
-        measure_syncopation = 0
-        measure_coordination = 0
-        measure_difficulty_original = 0
-        measure_difficulty_new = 0
-
-        # Bin setup
-        bin_duration = duration_left / bin_divisions
-        cur_bin_duration = bin_duration
-        bin_i = 0
-        bins = [ [] for i in xrange(bin_divisions) ]
-
-        # Separate notes into bins by beat
-        prev_x = 0
-        for ni, note in enumerate(notes):
-            if is_valid_note(note) and 'duration' in note:
-                if ni < len(notes)-1 and note['@default-x'] != notes[ni+1]['@default-x']: # don't increment duration if it's simultaneous onset
-                    cur_bin_duration -= int(note['duration'])
-                bins[bin_i].append(note)
-                prev_x = note['@default-x']
-            if cur_bin_duration <= 0:
-                # print cur_bin_duration
-                bin_i = min(bin_i+1, len(bins)-1)
-
-                while cur_bin_duration < 0: # in cases where a note is longer than a bin size
-                    bin_i = min(bin_i+1, len(bins)-1)
-                    cur_bin_duration += bin_duration
-
-                cur_bin_duration = bin_duration
-
-        # Output analysis to validate correct binning
-        for bi, bin in enumerate(bins):
-            total_duration = get_total_bin_duration(bin)
-            bin_density = calculate_value_for_bin(bin, 'DENSITY', bin_duration, bin_divisions)
-            bin_keith = calculate_value_for_bin(bin, 'SYNCOPATION_KEITH', bin_duration, bin_divisions)
-            bin_coordination = calculate_value_for_bin(bin, 'COORDINATION', bin_duration, bin_divisions)
-            difficulty = calculate_difficulty_from_values(bin_density, bin_keith, bin_coordination, weights)
-
-            measure_density += bin_density / bin_divisions
-            measure_syncopation += bin_keith / bin_divisions
-            measure_coordination += bin_coordination / bin_divisions
-            measure_difficulty_original += difficulty / bin_divisions
-
-            # print 'measure {} beat {}: {} notes, total_duration={}, bin_density={}, bin_keith={}, bin_coordination={}, difficulty={}'.format(mi+1, bi+1, len(bin), total_duration, bin_density, bin_keith, bin_coordination, difficulty)
-
-        # print 'measure {} overall d={}, s={}, c={}, D={} (b={})'.format(mi+1, measure_density, measure_syncopation, measure_coordination, measure_difficulty_original, bin_divisions)
-        # exit(0)
-
-        # Create new phrase based on parameters
+    # Every bin gets its own random number generator derived from the seed, so the
+    # generated score is the same no matter how many jobs there are
+    if seed is None:
+        seed = random.randint(0, sys.maxint)
+    print 'seed: {}'.format(seed)
+
+    # Corpus bins to retrieve from (before any worker processes are started, so that
+    # they have it too)
+    if strategy == 'retrieve':
+        if not args.bank:
+            print 'the retrieve strategy needs a corpus index to retrieve bins from; see --bank'
+            sys.exit(1)
+        with metrics.stage('bank'):
+            bin_bank.load(args.bank, bin_divisions)
+
+    # Streaming mode: parse, generate and write measure by measure
+    if stream and len(targets) > 1:
+        print 'streaming mode only generates one variation; use it without --targets'
+        sys.exit(1)
+    if stream and edits_out:
+        print 'streaming mode doesn\'t write edit logs; use it without --edits_out'
+        sys.exit(1)
+    if stream:
+        part_totals = collections.OrderedDict() # part id -> difficulty totals and number of measures
+        cur_meter = [None] # carried from measure to measure within a part
+
+        def process_measure(measure, mi, part_id):
+            if part_id not in part_totals:
+                part_totals[part_id] = {
+                    'original': 0,
+                    'new': 0,
+                    'original_by_measure': 0,
+                    'new_by_measure': 0,
+                    'measures': 0
+                }
+                cur_meter[0] = None
+            totals = part_totals[part_id]
+            totals['measures'] += 1
+            meter = cur_meter[0] = get_measure_meter(measure, cur_meter[0])
+            with metrics.stage('analysis'):
+                measure_difficulty_by_measure = calculate_measure_difficulty(measure, weights, meter=meter)
+            totals['original_by_measure'] += measure_difficulty_by_measure
+
+            # parts that aren't generated are copied through as they are
+            if part_ids is not None and part_id not in part_ids:
+                measure_difficulty_original = generate_measure(measure, mi, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, True, meter=meter)[0]
+                totals['original'] += measure_difficulty_original
+                if not analysis_only:
+                    totals['new'] += measure_difficulty_original
+                totals['new_by_measure'] += measure_difficulty_by_measure
+                return None
+
+            measure_difficulty_original, measure_difficulty_new, changed = generate_measure(measure, mi, bin_divisions, target_difficulty, weights, gradients, stochastic_modifier, analysis_only, max_iterations, seed, strategy, budget, meter)
+            totals['original'] += measure_difficulty_original
+            totals['new'] += measure_difficulty_new
+            if not changed: # copied through as it is
+                totals['new_by_measure'] += measure_difficulty_by_measure
+                return None
+            with metrics.stage('analysis'):
+                totals['new_by_measure'] += calculate_measure_difficulty(measure, weights, meter=meter)
+            return measure
+
+        with open_score(score_xml_in_path) as f_in:
+            if analysis_only:
+                num_measures = MeasureStreamer(f_in, None, process_measure).run()
+            else:
+                with create_score(score_xml_out_path) as f_out:
+                    num_measures = MeasureStreamer(f_in, f_out, process_measure).run()
+
+        num_measures = max(num_measures, 1)
+        overall_difficulty_original = sum(totals['original'] for totals in part_totals.values()) / num_measures
+        overall_difficulty_new = sum(totals['new'] for totals in part_totals.values()) / num_measures
+        overall_difficulty_original_by_measure = sum(totals['original_by_measure'] for totals in part_totals.values()) / num_measures
+        overall_difficulty_new_by_measure = sum(totals['new_by_measure'] for totals in part_totals.values()) / num_measures
+
+        print '\n\nusing: {}'.format(args)
+        print_parts([{
+            'part': part_id,
+            'measures': totals['measures'],
+            'overall_difficulty': totals['original'] / totals['measures'],
+            'new_overall_difficulty': totals['new'] / totals['measures'],
+            'overall_difficulty_by_measure': totals['original_by_measure'] / totals['measures'],
+            'new_overall_difficulty_by_measure': totals['new_by_measure'] / totals['measures']
+        } for part_id, totals in part_totals.iteritems()])
+        print 'overall difficulty (by bins): {} -> {} (ratio of {})'.format(overall_difficulty_original, overall_difficulty_new, float(overall_difficulty_new)/overall_difficulty_original)
+        print 'overall difficulty (by measures): {} -> {} (ratio of {})'.format(overall_difficulty_original_by_measure, overall_difficulty_new_by_measure, float(overall_difficulty_new_by_measure)/overall_difficulty_original_by_measure)
+        print 'target_difficulty was {}'.format(target_difficulty)
         if not analysis_only:
-            print '\n\n...\nCreating new phrase\n...\n'
-            for bi, bin in enumerate(bins):
-                values = calculate_values_for_bin(bin, bin_duration, bin_divisions)
-                difficulty = calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights)
-
-                print '\n=== measure {} beat {} ==='.format(mi+1, bi+1)
-
-                if difficulty > 0:
-                    bin = adjust_bin(bin, bin_duration, bin_divisions, target_difficulty*difficulty, weights, gradients, stochastic_modifier)
-                bins[bi] = bin
-
-                # recalculate difficulty
-                values = calculate_values_for_bin(bin, bin_duration, bin_divisions)
-                difficulty = calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights)
-                measure_difficulty_new += difficulty / bin_divisions
-        # else:
-        #     print 'analysis mode only: not generating new phrase'
-
-        # New notes
-        notes = []
-        for bin in bins:
-            notes += bin
-
-
-        # # Iterate through notes and adjust durations (or delete note) using parse_note()
-        # for ni, note in enumerate(notes):
-        #     print 'note {}:'.format(ni)
-        #     # note = parse_note(note, prev_note)
-        #     note = parse_note(note, {'duration': prev_note_dur}, duration_min, duration_left)
-
-        #     if is_valid_note(note): # otherwise it's a rest and we ignore it
-        #         duration = int(note['duration'])
-        #         prev_note_dur = duration
-        #         duration_left -= duration
-        #         prev_note = note
-        #     else:
-        #         # print note
-        #         prev_note_dur = 0
-        #         # duration_left -= note
-        #         # prev_note['duration'] = 0
-
-        #     notes[ni] = note
-
-        # # notes = filter(remove_rests, notes)
-        # notes = [note for note in notes if (is_valid_note(note))]
-
-        # Update difficulty values
-        overall_difficulty_original += measure_difficulty_original/len(measures)
-        overall_difficulty_new += measure_difficulty_new/len(measures)
-
-        # print 'measure difficulty: {} -> {}'.format(measure_difficulty_original, measure_difficulty_new)
-
-        # print 'num notes after: {}'.format(len(notes))
-        # print notes
-
-        # Update measure
-        measures[mi]['note'] = notes
+            print 'wrote to {}'.format(score_xml_out_path)
+        write_metrics()
+        sys.exit(0)
 
+    # Load input score
+    score_xml = ''
+    with metrics.stage('parse'):
+        with open_score(score_xml_in_path) as f:
+            score_xml = f.read()
+
+    # Analysis cache lookup (values per measure, and per bin)
+    cache = None
+    measure_values = None
+    score_values = None
+    with metrics.stage('analysis'):
+        score_hash = hashlib.sha1(score_xml).hexdigest()
+        if cache_dir:
+            cache = AnalysisCache(cache_dir, int(cache_size * 1024 * 1024))
+            measure_values = cache.get(score_hash, 1)
+            score_values = cache.get(score_hash, bin_divisions)
+
+    # Parse (unless the analysis is all we need and it's cached), all parts' measures
+    # one part after another, or load the score's snapshot instead
+    snapshots = None
+    measures = []
+    parts = []
+    measure_bins = []
+    levels = None
+    if not analysis_only or measure_values is None or score_values is None or resolutions:
+        if snapshot_dir:
+            snapshots = SnapshotStore(snapshot_dir)
+            with metrics.stage('parse'):
+                levels = snapshots.get(score_hash)
+        if levels is not None:
+            parts = levels.parts
+        else:
+            with metrics.stage('parse'):
+                score_json = parse_musicxml(score_xml)
+                measures, parts = get_score_measures(score_json)
+                # print measures[3]
+
+            # Bin all measures, at every resolution needed, in one pass
+            with metrics.stage('binning'):
+                levels = ScoreLevels(measures, [1, bin_divisions] + resolutions, meter=get_measure_meters(measures, parts))
+            if snapshots is not None:
+                with metrics.stage('snapshot'):
+                    snapshots.put(score_hash, score_xml, measures, parts, levels)
 
+        if not analysis_only:
+            with metrics.stage('binning'):
+                measure_bins = levels.get_bins(bin_divisions)
+                bin_durations = levels.bin_durations[bin_divisions]
+
+
+    # Analyze the whole score at once
+    with metrics.stage('analysis'):
+        if measure_values is None:
+            measure_values = levels.get_values(1)
+            if cache is not None:
+                cache.put(score_hash, 1, measure_values)
+        if score_values is None:
+            score_values = levels.get_values(bin_divisions)
+            if cache is not None:
+                cache.put(score_hash, bin_divisions, score_values)
+        if resolutions:
+            table = levels.get_table(weights, resolutions)
 
-    # print '\n\n'
-    # print score_json['score-partwise']['part']['measure'][0]['note']
+    # Difficulty tracking!
+    overall_difficulty_original = calculate_overall_difficulty_from_values(score_values, weights, bin_divisions)
+    overall_difficulty_original_by_measure = calculate_overall_difficulty_from_values(measure_values, weights, 1)
 
-    # Print final statistics
-    # score_json['credit']
     print '\n\nusing: {}'.format(args)
-    overall_difficulty_new_by_measure = calculate_overall_difficulty(measures, weights)
-    print 'overall difficulty (by bins): {} -> {} (ratio of {})'.format(overall_difficulty_original, overall_difficulty_new, float(overall_difficulty_new)/overall_difficulty_original)
-    print 'overall difficulty (by measures): {} -> {} (ratio of {})'.format(overall_difficulty_original_by_measure, overall_difficulty_new_by_measure, float(overall_difficulty_new_by_measure)/overall_difficulty_original_by_measure)
-    # print 'ratio to 1_original is {}; target difficulty was {}'.format(overall_difficulty_new_by_measure/0.567598824786, target_difficulty)
-    print 'target_difficulty was {}'.format(target_difficulty)
-
-    # print debug_unparse(measures[0]['note'][0], 'note')
-
-    if not analysis_only:
-        with open(score_xml_out_path, 'w') as f:
-            xmltodict.unparse(score_json, output=f, pretty=True)
-        print 'wrote to {}'.format(score_xml_out_path)
\ No newline at end of file
+
+    if resolutions:
+        print '\n{:>7} {:>5} {:>10} {:>12} {:>13} {:>11}'.format('measure', 'bins', 'density', 'syncopation', 'coordination', 'difficulty')
+        for row in table:
+            print '{measure:>7} {bin_divisions:>5} {density:>10.4f} {syncopation:>12.4f} {coordination:>13.4f} {difficulty:>11.4f}'.format(**row)
+        print
+
+    if analysis_only:
+        part_reports = report_parts(parts, weights, {
+            'overall_difficulty': (score_values, bin_divisions),
+            'overall_difficulty_by_measure': (measure_values, 1)
+        })
+        for report in part_reports:
+            report['new_overall_difficulty'] = 0
+            report['new_overall_difficulty_by_measure'] = report['overall_difficulty_by_measure']
+        print_parts(part_reports)
+        print 'overall difficulty (by bins): {} -> {} (ratio of {})'.format(overall_difficulty_original, 0, 0.)
+        print 'overall difficulty (by measures): {} -> {} (ratio of {})'.format(overall_difficulty_original_by_measure, overall_difficulty_original_by_measure, 1.)
+        print 'target_difficulty was {}'.format(target_difficulty)
+        if cache is not None and cache_stats:
+            print 'analysis cache: {}'.format(cache.stats())
+        if snapshots is not None and cache_stats:
+            print 'snapshots: {}'.format(snapshots.stats())
+        if cache_stats:
+            print 'bin memo: {}'.format(bin_memo.stats())
+        write_metrics(cache)
+        sys.exit(0)
+    pool = None
+    map_tasks = map
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        map_tasks = lambda function, tasks: pool.map(function, tasks, chunksize=max(1, len(tasks) / (jobs*4)))
+
+    # The analyzed score to generate from; with a snapshot, only the measures that
+    # generation changes are parsed (from the score)
+    snapshot = isinstance(levels, ScoreSnapshot)
+    score = AnalyzedScore(score_hash, score_xml, None if snapshot else measures, parts, levels.meters, measure_bins, bin_durations, bin_divisions, measure_values, score_values)
+    if snapshot:
+        score.measure_offsets = levels.measure_offsets
+
+    # Generate one variation per target difficulty, all from the same original bins
+    # (adjust_bin() only copies the bins it changes, so the original bins are shared)
+    for target_difficulty in targets:
+        session = ScatlavaSession(score, target_difficulty, weights, gradients, stochastic_modifier, max_iterations, seed, strategy, budget, part_ids, map_tasks)
+
+        # Print final statistics
+        report = session.report()
+        print_parts(report['parts'])
+        print 'overall difficulty (by bins): {} -> {} (ratio of {})'.format(report['overall_difficulty'], report['new_overall_difficulty'], float(report['new_overall_difficulty'])/report['overall_difficulty'])
+        print 'overall difficulty (by measures): {} -> {} (ratio of {})'.format(report['overall_difficulty_by_measure'], report['new_overall_difficulty_by_measure'], float(report['new_overall_difficulty_by_measure'])/report['overall_difficulty_by_measure'])
+        print 'target_difficulty was {}'.format(target_difficulty)
+
+        variant_xml_out_path = score_xml_out_path
+        if len(targets) > 1:
+            variant_xml_out_path = get_variant_path(score_xml_out_path, target_difficulty)
+        variant_xml = session.variant()
+        with metrics.stage('serialize'):
+            with create_score(variant_xml_out_path) as f:
+                f.write(variant_xml)
+        print 'wrote to {}'.format(variant_xml_out_path)
+
+        if edits_out:
+            edits_out_path = edits_out
+            if len(targets) > 1:
+                edits_out_path = get_variant_path(edits_out, target_difficulty)
+            edit_log = session.edit_log()
+            with open(edits_out_path, 'w') as f:
+                f.write(edit_log.dumps())
+            print 'wrote edits to {} bins to {}'.format(len(edit_log.edits), edits_out_path)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if cache is not None and cache_stats:
+        print 'analysis cache: {}'.format(cache.stats())
+    if snapshots is not None and cache_stats:
+        print 'snapshots: {}'.format(snapshots.stats())
+    if cache_stats:
+        print 'bin memo: {}'.format(bin_memo.stats())
+    write_metrics(cache)
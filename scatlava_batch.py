@@ -0,0 +1,268 @@
+# SCATLAVA batch mode: analyze (and optionally generate from) a whole corpus
+#
+# Runs every score found in the given directories or glob patterns through a process
+# pool, one file per task (so only the scores being worked on are in memory), and
+# appends a record per file to an NDJSON or CSV summary. Files that are in the summary
+# already (same content hash, weights, bin_divisions and, if generating, the same
+# generation options, see record_key_columns) are skipped, so an interrupted run picks
+# up where it left off. A file that fails gets an error record and doesn't stop the
+# others.
+
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+import scatlava
+
+score_extensions = ('.xml', '.musicxml', '.mxl')
+
+csv_columns = ['path', 'score', 'weights', 'bin_divisions', 'measures', 'overall_difficulty', 'overall_difficulty_by_measure', 'target_difficulty', 'seed', 'strategy', 'gradients', 'part_ids', 'edits', 'budget', 'stochastic_modifier', 'max_iterations', 'bank', 'new_overall_difficulty', 'new_overall_difficulty_by_measure', 'out', 'error', 'parts', 'measure_difficulties']
+
+# Columns of a record that make up its key (see get_record_key()), along with their
+# types; the generation options are only in records of generated variations
+record_key_columns = [('weights', str), ('bin_divisions', int), ('target_difficulty', float), ('seed', int), ('strategy', str), ('gradients', str), ('part_ids', str), ('edits', bool), ('budget', int), ('stochastic_modifier', float), ('max_iterations', int), ('bank', str)]
+
+# Engine of a worker process; keeps no scores around, as every file comes up only once
+engine = None
+
+# Score files in the given directories (searched recursively), glob patterns and files
+def find_scores(inputs):
+    paths = set()
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, filenames in os.walk(path):
+                for filename in filenames:
+                    if filename.lower().endswith(score_extensions):
+                        paths.add(os.path.join(root, filename))
+        elif os.path.isfile(path):
+            paths.add(path)
+        else:
+            paths.update([match for match in glob.glob(path) if os.path.isfile(match)])
+    return sorted(paths)
+
+# Content hash of a file, read in chunks
+def hash_file(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), ''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+# The options a file's record is computed with (see process_score()), as they are
+# written to records (e.g. weights as 'd,s,c')
+def get_record_options(options):
+    record = {
+        'weights': '{d},{s},{c}'.format(**options['weights']),
+        'bin_divisions': options['bin_divisions']
+    }
+    if options['out_dir']:
+        record.update({
+            'target_difficulty': options['target_difficulty'],
+            'seed': options['seed'],
+            'strategy': options['strategy'],
+            'gradients': '{d},{s},{c}'.format(**options['gradients']),
+            'part_ids': ','.join(options['part_ids']) if options['part_ids'] else None,
+            'edits': options['edits'],
+            'budget': options['budget'],
+            'stochastic_modifier': options['stochastic_modifier'],
+            'max_iterations': options['max_iterations'],
+            'bank': options['bank']
+        })
+    return record
+
+# What a record was computed with: files are only skipped if it's the same
+#   - record: a record, as written or as read back from a CSV summary (all strings)
+def get_record_key(record):
+    key = [record['score']]
+    for column, column_type in record_key_columns:
+        value = record.get(column)
+        if value in (None, ''):
+            value = None
+        elif column_type is bool:
+            value = value in (True, 'True')
+        else:
+            value = column_type(value)
+        key.append(value)
+    return tuple(key)
+
+# Keys of the records (without errors) in an existing summary
+def read_done(out_path, out_format):
+    done = set()
+    if not os.path.exists(out_path):
+        return done
+    with open(out_path, 'rb') as f:
+        if out_format == 'csv':
+            records = list(csv.DictReader(f))
+        else:
+            records = []
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError: # cut off by an interrupted run
+                    continue
+    for record in records:
+        if not record.get('error') and record.get('score'):
+            done.add(get_record_key(record))
+    return done
+
+# Analyze (and, if options['out_dir'], generate from) one score in a worker process
+#   - task: (path, score_hash, options), score_hash being the file's (see hash_file());
+#     for .mxl files, the engine hashes the MusicXML in the archive itself, so that edit
+#     logs are tied to the score they apply to
+# Returns the file's record; exceptions end up in record['error']
+def process_score(task):
+    global engine
+    if engine is None:
+        engine = scatlava.ScatlavaEngine(max_scores=0, bank=task[2]['bank'])
+    path, score_hash, options = task
+    weights = options['weights']
+    record = {'path': path, 'score': score_hash}
+    record.update(get_record_options(options))
+    try:
+        with scatlava.open_score(path) as f:
+            score_xml = f.read()
+        content_hash = None if scatlava.is_mxl_path(path) else score_hash
+        if options['out_dir']:
+            variant_xml, report = engine.generate(score_xml, options['target_difficulty'], weights, options['gradients'], options['stochastic_modifier'], options['max_iterations'], options['seed'], options['bin_divisions'], content_hash, options['strategy'], options['budget'], options['part_ids'], options['edits'])
+            root, ext = os.path.splitext(os.path.basename(path))
+            if options['edits']:
+                ext = '.edits'
+            out_path = os.path.join(options['out_dir'], '{}-{}{}'.format(root, score_hash[:8], ext))
+            if scatlava.is_mxl_path(out_path):
+                scatlava.write_mxl(out_path, variant_xml)
+            else:
+                with open(out_path, 'wb') as f:
+                    f.write(variant_xml)
+            record['out'] = out_path
+        else:
+            report = engine.analyze(score_xml, weights, options['bin_divisions'], content_hash)
+        report.pop('score')
+        record.update(report)
+    except Exception as e:
+        record['error'] = '{}: {}'.format(type(e).__name__, e)
+    return record
+
+# Appends records to a summary, flushing after each so that a run can be resumed
+class SummaryWriter(object):
+    def __init__(self, out_path, out_format):
+        self.out_format = out_format
+        new = not os.path.exists(out_path) or os.path.getsize(out_path) == 0
+        self.f = open(out_path, 'ab')
+        if out_format == 'csv':
+            self.writer = csv.DictWriter(self.f, csv_columns)
+            if new:
+                self.writer.writeheader()
+
+    def write(self, record):
+        if self.out_format == 'csv':
+            row = dict(record)
+            row['measure_difficulties'] = ' '.join(str(d) for d in record.get('measure_difficulties', []))
+            if 'parts' in record:
+                row['parts'] = json.dumps(record['parts'], sort_keys=True)
+            self.writer.writerow(row)
+        else:
+            self.f.write(json.dumps(record, sort_keys=True) + '\n')
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+if __name__ == '__main__':
+
+    # Setup command-line arguments
+    parser = argparse.ArgumentParser(description = 'SCATLAVA batch mode: analyze (and optionally generate from) a whole corpus')
+    parser.add_argument('inputs', help='directories (searched recursively for .xml/.musicxml/.mxl), glob patterns or files', nargs='+')
+    parser.add_argument('-o', '--out', help='summary to append to (.csv for CSV, NDJSON otherwise)', default='scatlava_batch.ndjson')
+    parser.add_argument('-w', '--weights', help='comma-separated d,s,c. e.g. 0.2,0.1,0.7', default='0.33,0.33,0.34')
+    parser.add_argument('-b', '--bin_divisions', help='number of bins to divide a measure into', default=4, type=int)
+    parser.add_argument('-G', '--generate', help='also generate a variation of every score into this directory', default=None)
+    parser.add_argument('-t', '--target_difficulty', help='0 to 1, as a ratio of original transcription\'s difficulty', default=0.5, type=float)
+    parser.add_argument('-g', '--gradients', help='comma-separated d,s,c. e.g. 0.2,0.1,0.7', default='0.33,0.33,0.34')
+    parser.add_argument('-f', '--stochastic_modifier', help='0 to 1', default=0.5, type=float)
+    parser.add_argument('-i', '--max_iterations', help='number of adjustment runs per bin before giving up', default=11, type=int)
+    parser.add_argument('-S', '--strategy', help='how to adjust bins: stochastic, greedy, beam, plan or retrieve (see scatlava.py)', default='stochastic', choices=['stochastic', 'greedy', 'beam', 'plan', 'retrieve'])
+    parser.add_argument('--budget', help='with greedy, beam or plan: maximum number of candidate bins to evaluate per bin', default=64, type=int)
+    parser.add_argument('--bank', help='with retrieve: corpus index (see scatlava_index.py) to retrieve bins from', default=None)
+    parser.add_argument('-P', '--parts', help='comma-separated ids of the parts to generate variations of (all by default)', default=None)
+    parser.add_argument('-E', '--edits', help='with --generate: write every variation as an edit log (.edits, see scatlava.py --apply) instead of MusicXML', action='store_true')
+    parser.add_argument('-r', '--seed', help='master random seed; a given seed always generates the same scores', default=None, type=int)
+    parser.add_argument('-j', '--jobs', help='number of processes (all cores by default)', default=multiprocessing.cpu_count(), type=int)
+
+    args = parser.parse_args()
+    if args.generate and args.strategy == 'retrieve' and not args.bank:
+        parser.error('the retrieve strategy needs --bank')
+
+    weights_arr = [float(w) for w in args.weights.split(',')]
+    weights = {'d': weights_arr[0], 's': weights_arr[1], 'c': weights_arr[2]}
+    gradients_arr = [float(g) for g in args.gradients.split(',')]
+    gradients = {'d': gradients_arr[0], 's': gradients_arr[1], 'c': gradients_arr[2]}
+    out_format = 'csv' if args.out.lower().endswith('.csv') else 'ndjson'
+    seed = args.seed
+    if args.generate:
+        if seed is None:
+            seed = random.randint(0, sys.maxint)
+        print 'seed: {}'.format(seed)
+        if not os.path.isdir(args.generate):
+            os.makedirs(args.generate)
+
+    options = {
+        'weights': weights,
+        'bin_divisions': args.bin_divisions,
+        'out_dir': args.generate,
+        'target_difficulty': args.target_difficulty,
+        'gradients': gradients,
+        'stochastic_modifier': args.stochastic_modifier,
+        'max_iterations': args.max_iterations,
+        'seed': seed,
+        'strategy': args.strategy,
+        'budget': args.budget,
+        'part_ids': args.parts.split(',') if args.parts else None,
+        'edits': args.edits,
+        'bank': args.bank
+    }
+
+    # Skip what's been done already
+    paths = find_scores(args.inputs)
+    done = read_done(args.out, out_format)
+    record_options = get_record_options(options)
+    tasks = []
+    for path in paths:
+        score_hash = hash_file(path)
+        record_options['score'] = score_hash
+        if get_record_key(record_options) not in done:
+            tasks.append((path, score_hash, options))
+    print '{} scores, {} done already, {} to go'.format(len(paths), len(paths) - len(tasks), len(tasks))
+
+    writer = SummaryWriter(args.out, out_format)
+    pool = multiprocessing.Pool(max(args.jobs, 1))
+    start = time.time()
+    num_done = num_errors = num_measures = 0
+    try:
+        for record in pool.imap_unordered(process_score, tasks):
+            writer.write(record)
+            num_done += 1
+            if 'error' in record:
+                num_errors += 1
+                sys.stderr.write('\n{}: {}\n'.format(record['path'], record['error']))
+            num_measures += record.get('measures', 0)
+            elapsed = max(time.time() - start, 1e-6)
+            sys.stderr.write('\r{}/{} scores, {} errors, {:.1f} scores/s, {:.0f} measures/s'.format(num_done, len(tasks), num_errors, num_done / elapsed, num_measures / elapsed))
+        pool.close()
+    except KeyboardInterrupt:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+        writer.close()
+    if tasks:
+        sys.stderr.write('\n')
+    print 'wrote to {}'.format(args.out)
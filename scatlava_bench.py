@@ -0,0 +1,289 @@
+# SCATLAVA benchmarks: synthetic drum scores and stage timings
+#
+# Writes single-part drum set MusicXML scores of any length and rhythmic makeup, and
+# times scatlava.py's stages (parse, binning, analysis, generation, serialize) on them
+# across score sizes and bin_divisions.
+
+
+import argparse
+import cStringIO
+import collections
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import time
+import xmltodict
+
+import scatlava
+
+# (display-step, display-octave, notehead) of the drum set's instruments
+drum_instruments = [
+    ('F', '4', None), # kick
+    ('C', '5', None), # snare
+    ('E', '5', None), # high tom
+    ('A', '4', None), # floor tom
+    ('G', '5', 'x'), # hi-hat
+    ('F', '5', 'x'), # ride
+    ('A', '5', 'x') # crash
+]
+
+# Durations a beat (quarter note, 256) can be subdivided into
+beat_subdivisions = {
+    'quarter': [256],
+    'eighths': [128, 128],
+    'sixteenths': [64, 64, 64, 64],
+    'triplets': [85, 85, 86]
+}
+
+# Generate a synthetic single-part drum set score in 4/4 (divisions of 256)
+#   - num_measures: number of measures
+#   - density: 0 to 1, how busy beats are (0 = quarter notes only, 1 = 16ths only)
+#   - polyphony: maximum number of simultaneous notes (chord size)
+#   - tuplet_ratio: 0 to 1, share of beats played as 8th note triplets
+#   - rest_ratio: 0 to 1, share of rests among the other notes
+#   - seed: random seed; a given seed always generates the same score
+# Returns the score as MusicXML (a string)
+def generate_score(num_measures, density=0.5, polyphony=2, tuplet_ratio=0.1, rest_ratio=0.1, seed=None):
+    rng = random.Random(seed)
+    measures = []
+    for mi in xrange(num_measures):
+        measure = collections.OrderedDict([('@number', str(mi+1))])
+        if mi == 0:
+            measure['attributes'] = collections.OrderedDict([
+                ('divisions', '256'),
+                ('time', collections.OrderedDict([('beats', '4'), ('beat-type', '4')])),
+                ('clef', collections.OrderedDict([('sign', 'percussion'), ('line', '2')]))
+            ])
+        measure['note'] = generate_measure_notes(rng, density, polyphony, tuplet_ratio, rest_ratio)
+        measures.append(measure)
+
+    score = collections.OrderedDict([('score-partwise', collections.OrderedDict([
+        ('@version', '3.0'),
+        ('part-list', {'score-part': collections.OrderedDict([
+            ('@id', 'P1'),
+            ('part-name', 'Drum Set'),
+            ('score-instrument', collections.OrderedDict([('@id', 'P1-I1'), ('instrument-name', 'Drum Set')]))
+        ])}),
+        ('part', collections.OrderedDict([('@id', 'P1'), ('measure', measures)]))
+    ]))])
+    return xmltodict.unparse(score, pretty=True)
+
+# Notes (as xmltodict dicts) for one measure of generate_score()
+def generate_measure_notes(rng, density, polyphony, tuplet_ratio, rest_ratio):
+    notes = []
+    default_x = 0
+    for beat in xrange(4):
+        if rng.random() < tuplet_ratio:
+            subdivision = 'triplets'
+        else: # busier beats the higher the density
+            r = rng.random()
+            if r < density**2:
+                subdivision = 'sixteenths'
+            elif r < density**2 + 2*density*(1-density):
+                subdivision = 'eighths'
+            else:
+                subdivision = 'quarter'
+
+        for duration in beat_subdivisions[subdivision]:
+            default_x += 20
+            if rng.random() < rest_ratio:
+                notes.append(make_note(duration, default_x))
+                continue
+            chord_size = 1
+            while chord_size < min(polyphony, len(drum_instruments)) and rng.random() < 0.5:
+                chord_size += 1
+            for ci, instrument in enumerate(rng.sample(drum_instruments, chord_size)):
+                notes.append(make_note(duration, default_x, instrument, chord=ci > 0))
+    return notes
+
+# A note (or a rest, if instrument is None) as an xmltodict dict
+def make_note(duration, default_x, instrument=None, chord=False):
+    note = collections.OrderedDict([('@default-x', str(default_x))])
+    if chord:
+        note['chord'] = None
+    if instrument is None:
+        note['rest'] = None
+    else:
+        step, octave, notehead = instrument
+        note['unpitched'] = collections.OrderedDict([('display-step', step), ('display-octave', octave)])
+    note['duration'] = str(duration)
+    note['instrument'] = {'@id': 'P1-I1'}
+    note['voice'] = '1'
+    note_attrs = scatlava.get_note_attrs(duration)
+    note['type'] = note_attrs['type']
+    if 'time-modification' in note_attrs:
+        note['time-modification'] = collections.OrderedDict([
+            (key, str(value)) for key, value in sorted(note_attrs['time-modification'].items())
+        ])
+    if instrument is not None:
+        note['stem'] = 'up'
+        if notehead is not None:
+            note['notehead'] = notehead
+    return note
+
+
+# Time scatlava.py's stages on one synthetic score (see generate_score()), best of
+# repeat runs. Each run starts from a cold bin memo. Meant to run in a process of its
+# own (see run_benchmarks()) so that peak RSS is the benchmark's.
+#   - config: dict with num_measures, bin_divisions, repeat and generate_score()'s
+#     and generation's parameters
+# Returns a dict of results
+def run_benchmark(config):
+    score_xml = generate_score(config['num_measures'], config['density'], config['polyphony'], config['tuplet_ratio'], config['rest_ratio'], config['seed']).encode('utf-8')
+    bin_divisions = config['bin_divisions']
+    weights = config['weights']
+
+    best = None
+    for run in xrange(config['repeat']):
+        scatlava.bin_memo = scatlava.BinMemo(scatlava.bin_memo.max_size)
+        scatlava.metrics = metrics = scatlava.Metrics()
+
+        with metrics.stage('parse'):
+            score_json = scatlava.parse_musicxml(score_xml)
+            measures = score_json['score-partwise']['part']['measure']
+            if type(measures) != list:
+                measures = [measures]
+
+        with metrics.stage('binning'):
+            measure_bins = []
+            bin_durations = []
+            meters = []
+            meter = None
+            for measure in measures:
+                meter = scatlava.get_measure_meter(measure, meter)
+                meters.append(meter)
+                bins, durations = scatlava.bin_measure(measure, bin_divisions, meter=meter)
+                measure_bins.append(bins)
+                bin_durations.extend(durations)
+
+        with metrics.stage('analysis'):
+            overall_difficulty = scatlava.calculate_overall_difficulty(measures, weights)
+            score_values = scatlava.analyze_bins([bin for bins in measure_bins for bin in bins], bin_durations, bin_divisions)
+
+        with metrics.stage('generation'):
+            new_measure_bins = []
+            for mi, bins in enumerate(measure_bins):
+                bin_values = score_values[mi*bin_divisions:(mi+1)*bin_divisions]
+                new_measure_bins.append(scatlava.generate_bins(bins, bin_values, mi, bin_durations[mi*bin_divisions:(mi+1)*bin_divisions], bin_divisions, config['target_difficulty'], weights, config['gradients'], config['stochastic_modifier'], config['max_iterations'], config['seed']))
+
+        with metrics.stage('serialize'):
+            new_measures = {}
+            for mi in scatlava.get_dirty_measures(measure_bins, new_measure_bins):
+                new_measures[mi] = measures[mi]
+                scatlava.set_measure_bins(measures[mi], new_measure_bins[mi], meters[mi])
+            scatlava.splice_measures(score_xml, scatlava.get_measure_offsets(score_xml), new_measures, cStringIO.StringIO())
+
+        if best is None:
+            best = metrics
+        else:
+            for stage, seconds in metrics.stages.iteritems():
+                best.stages[stage] = min(best.stages[stage], seconds)
+
+    total_time = sum(best.stages.values())
+    num_measures = config['num_measures']
+    metrics_dict = best.to_dict()
+    return {
+        'num_measures': num_measures,
+        'bin_divisions': bin_divisions,
+        'num_notes': sum(len(bin) for bins in measure_bins for bin in bins),
+        'score_size': len(score_xml),
+        'overall_difficulty': overall_difficulty,
+        'stages': best.stages,
+        'total_time': total_time,
+        'measures_per_sec': dict([(stage, num_measures / seconds if seconds else None) for stage, seconds in best.stages.iteritems()] + [('total', num_measures / total_time if total_time else None)]),
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'counters': metrics_dict['counters'],
+        'bin_memo': scatlava.bin_memo.stats()
+    }
+
+# Run a benchmark per configuration, each in a fresh process
+def run_benchmarks(configs):
+    results = []
+    for config in configs:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        results.append(pool.apply(run_benchmark, (config,)))
+        pool.close()
+        pool.join()
+        print_result(results[-1])
+    return results
+
+def print_result(result):
+    stages = result['stages']
+    print '{:>8} {:>3} {:>8} | {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} {:>8.3f} | {:>8.3f} {:>10.1f} {:>9.1f}'.format(
+        result['num_measures'], result['bin_divisions'], result['num_notes'],
+        stages['parse'], stages['binning'], stages['analysis'], stages['generation'], stages['serialize'],
+        result['total_time'], result['measures_per_sec']['total'] or 0., result['peak_rss_kb'] / 1024.)
+
+
+if __name__ == '__main__':
+
+    # Setup command-line arguments
+    parser = argparse.ArgumentParser(description = 'SCATLAVA benchmarks: synthetic drum scores and stage timings')
+    subparsers = parser.add_subparsers(dest='command')
+
+    score_parser = argparse.ArgumentParser(add_help=False)
+    score_parser.add_argument('--density', help='0 to 1, how busy beats are (0 = quarter notes only, 1 = 16ths only)', default=0.5, type=float)
+    score_parser.add_argument('--polyphony', help='maximum number of simultaneous notes', default=2, type=int)
+    score_parser.add_argument('--tuplet_ratio', help='0 to 1, share of beats played as 8th note triplets', default=0.1, type=float)
+    score_parser.add_argument('--rest_ratio', help='0 to 1, share of rests among notes', default=0.1, type=float)
+    score_parser.add_argument('-r', '--seed', help='random seed for the score (and generation)', default=1, type=int)
+
+    generate_parser = subparsers.add_parser('generate', parents=[score_parser], help='write a synthetic score')
+    generate_parser.add_argument('score_xml_out_path', help='the generated score')
+    generate_parser.add_argument('-m', '--measures', help='number of measures', default=64, type=int)
+
+    run_parser = subparsers.add_parser('run', parents=[score_parser], help='time scatlava.py\'s stages on synthetic scores')
+    run_parser.add_argument('-m', '--measures', help='comma-separated score sizes in measures', default='16,64,256,1024')
+    run_parser.add_argument('-b', '--bin_divisions', help='comma-separated numbers of bins to divide a measure into', default='1,2,4')
+    run_parser.add_argument('-n', '--repeat', help='number of runs per configuration (the best time per stage is kept)', default=3, type=int)
+    run_parser.add_argument('-t', '--target_difficulty', help='0 to 1, as a ratio of original difficulty', default=0.5, type=float)
+    run_parser.add_argument('-w', '--weights', help='comma-separated d,s,c. e.g. 0.2,0.1,0.7', default='0.33,0.33,0.34')
+    run_parser.add_argument('-g', '--gradients', help='comma-separated d,s,c. e.g. 0.2,0.1,0.7', default='0.33,0.33,0.34')
+    run_parser.add_argument('-f', '--stochastic_modifier', help='0 to 1', default=0.5, type=float)
+    run_parser.add_argument('-i', '--max_iterations', help='number of adjustment runs per bin before giving up', default=11, type=int)
+    run_parser.add_argument('-o', '--out', help='JSON file to write results to', default='bench_output.json')
+
+    args = parser.parse_args()
+
+    if args.command == 'generate':
+        with open(args.score_xml_out_path, 'w') as f:
+            f.write(generate_score(args.measures, args.density, args.polyphony, args.tuplet_ratio, args.rest_ratio, args.seed).encode('utf-8'))
+        print 'wrote to {}'.format(args.score_xml_out_path)
+
+    else:
+        weights_arr = [float(w) for w in args.weights.split(',')]
+        gradients_arr = [float(g) for g in args.gradients.split(',')]
+        configs = []
+        for num_measures in [int(m) for m in args.measures.split(',')]:
+            for bin_divisions in [int(b) for b in args.bin_divisions.split(',')]:
+                configs.append({
+                    'num_measures': num_measures,
+                    'bin_divisions': bin_divisions,
+                    'repeat': args.repeat,
+                    'density': args.density,
+                    'polyphony': args.polyphony,
+                    'tuplet_ratio': args.tuplet_ratio,
+                    'rest_ratio': args.rest_ratio,
+                    'seed': args.seed,
+                    'target_difficulty': args.target_difficulty,
+                    'weights': {'d': weights_arr[0], 's': weights_arr[1], 'c': weights_arr[2]},
+                    'gradients': {'d': gradients_arr[0], 's': gradients_arr[1], 'c': gradients_arr[2]},
+                    'stochastic_modifier': args.stochastic_modifier,
+                    'max_iterations': args.max_iterations
+                })
+
+        print '{:>8} {:>3} {:>8} | {:>8} {:>8} {:>8} {:>8} {:>8} | {:>8} {:>10} {:>9}'.format(
+            'measures', 'b', 'notes', 'parse', 'binning', 'analysis', 'generate', 'serial.', 'total', 'measures/s', 'RSS (MB)')
+        results = run_benchmarks(configs)
+
+        with open(args.out, 'w') as f:
+            json.dump({
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python': platform.python_version(),
+                'numpy': scatlava.np is not None,
+                'args': vars(args),
+                'results': results
+            }, f, indent=2)
+        print 'wrote to {}'.format(args.out)
@@ -0,0 +1,391 @@
+# SCATLAVA index: a queryable SQLite database of per-measure and per-bin difficulty
+#
+# Ingests a corpus (directories, glob patterns, files) on all cores, storing the d, s
+# and c of every measure and every bin (as analyzed by scatlava.py) and their
+# difficulty, so that questions like "measures with coordination > 0.6 and density <
+# 0.3" or "the 50 easiest 4-bar phrases in this tune" are answered by an indexed query
+# instead of analyzing the library again. Ingestion is incremental: files are known by
+# path, size and mtime, and scores by content hash, so only new and changed scores get
+# analyzed. Every distinct bin rhythm is kept as a pattern too, for scatlava.py's
+# retrieve strategy to swap in (see scatlava.BinBank).
+#
+#   python scatlava_index.py ingest transcriptions/ --index=library.db
+#   python scatlava_index.py query --where 'coordination>0.6' --where 'density<0.3'
+#   python scatlava_index.py query --phrase=4 --top=50 --file=transcriptions/tune.xml
+
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sqlite3
+import sys
+import time
+
+
+import scatlava
+from scatlava_batch import find_scores, hash_file
+
+schema = '''
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    score TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS files_score ON files (score);
+CREATE TABLE IF NOT EXISTS scores (
+    score TEXT,
+    bin_divisions INTEGER,
+    measures INTEGER,
+    parts TEXT,
+    PRIMARY KEY (score, bin_divisions)
+);
+CREATE TABLE IF NOT EXISTS measures (
+    score TEXT,
+    bin_divisions INTEGER,
+    part TEXT,
+    measure INTEGER,
+    number TEXT,
+    density REAL,
+    syncopation REAL,
+    coordination REAL,
+    difficulty REAL,
+    PRIMARY KEY (score, bin_divisions, part, measure)
+);
+CREATE TABLE IF NOT EXISTS bins (
+    score TEXT,
+    bin_divisions INTEGER,
+    part TEXT,
+    measure INTEGER,
+    number TEXT,
+    bin INTEGER,
+    density REAL,
+    syncopation REAL,
+    coordination REAL,
+    difficulty REAL,
+    pattern INTEGER,
+    PRIMARY KEY (score, bin_divisions, part, measure, bin)
+);
+CREATE TABLE IF NOT EXISTS patterns (
+    id INTEGER PRIMARY KEY,
+    bin_divisions INTEGER,
+    pattern TEXT,
+    density REAL,
+    syncopation REAL,
+    coordination REAL,
+    UNIQUE (bin_divisions, pattern)
+);
+''' + ''.join('''
+CREATE INDEX IF NOT EXISTS {table}_{column} ON {table} (bin_divisions, {column});'''.format(table=table, column=column) for table in ['measures', 'bins'] for column in ['density', 'syncopation', 'coordination', 'difficulty'])
+
+value_columns = ['density', 'syncopation', 'coordination', 'difficulty']
+
+# A filter such as 'coordination>0.6' (see parse_filter())
+filter_pattern = re.compile(r'^\s*(density|syncopation|coordination|difficulty)\s*(<=|>=|<|>|=)\s*([-+]?[0-9]*\.?[0-9]+)\s*$')
+
+# (column, operator, value) of a filter such as 'coordination>0.6'
+def parse_filter(text):
+    match = filter_pattern.match(text)
+    if match is None:
+        raise ValueError('invalid filter: {} (expected e.g. coordination>0.6)'.format(text))
+    return match.group(1), match.group(2), float(match.group(3))
+
+# Analyze one score in a worker process
+#   - task: (path, score_hash, levels), levels being the numbers of bins per measure to
+#     analyze at
+# Returns (path, score_hash, parts, measure rows, bin rows, error); rows are without
+# score and difficulty, as (bin_divisions, part, measure, number, d, s, c) and
+# (bin_divisions, part, measure, number, bin, d, s, c, pattern), measures numbered from
+# 1 within a part and patterns as JSON (see scatlava.get_bin_pattern())
+def analyze_score(task):
+    path, score_hash, levels = task
+    try:
+        with scatlava.open_score(path) as f:
+            score_json = scatlava.parse_musicxml(f.read())
+        measures, parts = scatlava.get_score_measures(score_json)
+        score_levels = scatlava.ScoreLevels(measures, levels, keep_source=False, meter=scatlava.get_measure_meters(measures, parts))
+        measure_rows = []
+        bin_rows = []
+        for bin_divisions in levels:
+            score_values = score_levels.get_values(bin_divisions)
+            measure_bins = score_levels.get_bins(bin_divisions)
+            for part_id, start, end in parts:
+                for mi in xrange(start, end):
+                    bin_values = score_values[mi*bin_divisions:(mi+1)*bin_divisions]
+                    measure = mi - start + 1
+                    measure_rows.append((bin_divisions, part_id, measure, measures[mi].get('@number')) + tuple(sum(values[key] for values in bin_values) / bin_divisions for key in ['density', 'syncopation', 'coordination']))
+                    meter = score_levels.meters[mi]
+                    bin_starts, bin_sizes = meter.get_bin_starts(bin_divisions), meter.get_bin_durations(bin_divisions)
+                    for bi, values in enumerate(bin_values):
+                        pattern = scatlava.get_bin_pattern(measure_bins[mi][bi], bin_starts[bi], bin_sizes[bi], meter.divisions)
+                        bin_rows.append((bin_divisions, part_id, measure, measures[mi].get('@number'), bi+1, values['density'], values['syncopation'], values['coordination'], json.dumps(pattern, separators=(',', ':')) if pattern else None))
+        return path, score_hash, parts, measure_rows, bin_rows, None
+    except Exception as e:
+        return path, score_hash, None, None, None, '{}: {}'.format(type(e).__name__, e)
+
+# The index database, with difficulties stored for the weights it was ingested with
+# (queries can ask for other weights; difficulty is linear in d, s and c, see
+# scatlava.calculate_difficulty_from_values())
+class ScoreIndex(object):
+    version = 2 # bump whenever the schema changes
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(schema)
+        version = self.get_meta('version')
+        if version is None:
+            self.set_meta('version', self.version)
+        elif int(version) != self.version:
+            raise ValueError('{} is a version {} index; this is version {} (ingest into a new index)'.format(path, version, self.version))
+        self.db.commit()
+
+    def get_meta(self, key):
+        row = self.db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        self.db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, json.dumps(value)))
+
+    # Weights stored difficulties are for
+    def get_weights(self):
+        return self.get_meta('weights') or {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+    # Recompute every stored difficulty for new weights
+    def set_weights(self, weights):
+        if weights == self.get_weights():
+            return
+        for table in ['measures', 'bins']:
+            self.db.execute('UPDATE {} SET difficulty = density * ? + syncopation * ? + coordination * ?'.format(table), (weights['d'], weights['s'], weights['c']))
+        self.set_meta('weights', weights)
+        self.db.commit()
+
+    # Ingest score files, analyzing new and changed ones only
+    #   - paths: score files (see scatlava_batch.find_scores())
+    #   - levels: numbers of bins per measure to analyze at
+    #   - progress: called with (done, total, path, error) as scores are analyzed
+    # Returns the number of files analyzed, skipped (unchanged) and failed
+    def ingest(self, paths, levels, weights, jobs=1, progress=None):
+        self.set_weights(weights)
+        levels = sorted(set(levels))
+
+        # which files changed, and which of their scores aren't in the index
+        tasks = []
+        num_skipped = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            stat = os.stat(path)
+            row = self.db.execute('SELECT score, size, mtime FROM files WHERE path = ?', (path,)).fetchone()
+            if row and row[1] == stat.st_size and row[2] == stat.st_mtime:
+                score_hash = row[0]
+            else:
+                score_hash = hash_file(path)
+                self.set_file(path, score_hash, stat, row[0] if row else None)
+            done_levels = set(level for level, in self.db.execute('SELECT bin_divisions FROM scores WHERE score = ?', (score_hash,)))
+            missing = [level for level in levels if level not in done_levels]
+            if missing:
+                tasks.append((path, score_hash, missing))
+            else:
+                num_skipped += 1
+        self.db.commit()
+
+        num_failed = 0
+        pool = multiprocessing.Pool(max(jobs, 1))
+        try:
+            for di, (path, score_hash, parts, measure_rows, bin_rows, error) in enumerate(pool.imap_unordered(analyze_score, tasks)):
+                if error:
+                    num_failed += 1
+                else:
+                    self.add_score(score_hash, parts, measure_rows, bin_rows, weights)
+                if progress:
+                    progress(di+1, len(tasks), path, error)
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+        return len(tasks) - num_failed, num_skipped, num_failed
+
+    # Record a file's content hash, dropping the score it had before if no other file has
+    # it any more
+    def set_file(self, path, score_hash, stat, old_score_hash=None):
+        self.db.execute('INSERT OR REPLACE INTO files (path, score, size, mtime) VALUES (?, ?, ?, ?)', (path, score_hash, stat.st_size, stat.st_mtime))
+        if old_score_hash and old_score_hash != score_hash and not self.db.execute('SELECT 1 FROM files WHERE score = ?', (old_score_hash,)).fetchone():
+            for table in ['scores', 'measures', 'bins']:
+                self.db.execute('DELETE FROM {} WHERE score = ?'.format(table), (old_score_hash,))
+            self.db.execute('DELETE FROM patterns WHERE id NOT IN (SELECT pattern FROM bins WHERE pattern IS NOT NULL)')
+
+    # Store the analysis of a score (as from analyze_score())
+    def add_score(self, score_hash, parts, measure_rows, bin_rows, weights):
+        def difficulty(d, s, c):
+            return scatlava.calculate_difficulty_from_values(d, s, c, weights)
+        levels = sorted(set(row[0] for row in measure_rows))
+        num_measures = sum(end - start for part_id, start, end in parts)
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO measures VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', [(score_hash,) + row + (difficulty(*row[4:]),) for row in measure_rows])
+            pattern_ids = {}
+            for row in bin_rows:
+                key = (row[0], row[-1])
+                if row[-1] is not None and key not in pattern_ids:
+                    self.db.execute('INSERT OR IGNORE INTO patterns (bin_divisions, pattern, density, syncopation, coordination) VALUES (?, ?, ?, ?, ?)', key + row[5:8])
+                    pattern_ids[key] = self.db.execute('SELECT id FROM patterns WHERE bin_divisions = ? AND pattern = ?', key).fetchone()[0]
+            self.db.executemany('INSERT OR REPLACE INTO bins VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', [(score_hash,) + row[:-1] + (difficulty(*row[5:8]), pattern_ids.get((row[0], row[-1]))) for row in bin_rows])
+            self.db.executemany('INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?)', [(score_hash, level, num_measures, json.dumps(parts)) for level in levels])
+
+    # Measures, bins or phrases (runs of consecutive measures of a part, with the mean
+    # values of their measures) matching every filter, easiest first (or hardest, with
+    # descending)
+    #   - filters: (column, operator, value) tuples (see parse_filter())
+    #   - bins: query bins instead of measures
+    #   - phrase: number of measures per phrase (1 for single measures)
+    #   - path: only this file's measures
+    #   - weights: difficulty weights, if not the ones the index was ingested with
+    #   - limit: number of results (all if None)
+    # Returns a dict per result with its file, score hash, part, measure (and bin), d, s,
+    # c and difficulty
+    def query(self, filters=(), bin_divisions=4, bins=False, phrase=1, path=None, weights=None, order='difficulty', descending=False, limit=None):
+        table = 'bins' if bins else 'measures'
+        keys = ['score', 'part', 'measure', 'number'] + (['bin'] if bins else [])
+        params = []
+        columns = dict((column, 'a.' + column) for column in value_columns)
+        if weights is not None and weights != self.get_weights():
+            columns['difficulty'] = '(a.density * {d!r} + a.syncopation * {s!r} + a.coordination * {c!r})'.format(**weights)
+        if phrase > 1:
+            # keep a phrase's measures together: measures are joined with the ones after them
+            columns = dict((column, 'AVG({})'.format(expression.replace('a.', 'b.'))) for column, expression in columns.iteritems())
+            sql = 'SELECT {}, {} FROM measures a JOIN measures b ON b.score = a.score AND b.bin_divisions = a.bin_divisions AND b.part = a.part AND b.measure BETWEEN a.measure AND a.measure + ?'.format(
+                ', '.join('a.' + key for key in keys), ', '.join('{} AS {}'.format(columns[column], column) for column in value_columns))
+            params.append(phrase - 1)
+        else:
+            sql = 'SELECT {}, {} FROM {} a'.format(', '.join('a.' + key for key in keys), ', '.join('{} AS {}'.format(columns[column], column) for column in value_columns), table)
+        sql += ' WHERE a.bin_divisions = ?'
+        params.append(bin_divisions)
+        if path is not None:
+            sql += ' AND a.score IN (SELECT score FROM files WHERE path = ?)'
+            params.append(os.path.abspath(path))
+        conditions = []
+        for column, operator, value in filters:
+            conditions.append('{} {} ?'.format(columns[column], operator))
+            params.append(value)
+        if phrase > 1:
+            sql += ' GROUP BY a.score, a.part, a.measure HAVING COUNT(*) = ?'
+            params.append(phrase)
+            if conditions:
+                sql += ' AND ' + ' AND '.join(conditions)
+        elif conditions:
+            sql += ' AND ' + ' AND '.join(conditions)
+        sql += ' ORDER BY {} {}'.format(columns[order], 'DESC' if descending else 'ASC')
+        if limit is not None:
+            sql += ' LIMIT ?'
+            params.append(limit)
+
+        results = []
+        for row in self.db.execute(sql, params):
+            result = dict(zip(keys + value_columns, row))
+            file_row = self.db.execute('SELECT path FROM files WHERE score = ? LIMIT 1', (result['score'],)).fetchone()
+            result['path'] = file_row[0] if file_row else None
+            if phrase > 1:
+                result['measures'] = phrase
+            results.append(result)
+        return results
+
+    def stats(self):
+        return {
+            'files': self.db.execute('SELECT COUNT(*) FROM files').fetchone()[0],
+            'scores': self.db.execute('SELECT COUNT(DISTINCT score) FROM scores').fetchone()[0],
+            'measures': self.db.execute('SELECT COUNT(*) FROM measures').fetchone()[0],
+            'bins': self.db.execute('SELECT COUNT(*) FROM bins').fetchone()[0],
+            'patterns': self.db.execute('SELECT COUNT(*) FROM patterns').fetchone()[0],
+            'weights': self.get_weights()
+        }
+
+    def close(self):
+        self.db.close()
+
+
+# Path relative to the working directory, unless it's outside of it
+def get_display_path(path):
+    relpath = os.path.relpath(path)
+    return path if relpath.startswith(os.pardir) else relpath
+
+def parse_weights(text):
+    weights_arr = [float(w) for w in text.split(',')]
+    return {'d': weights_arr[0], 's': weights_arr[1], 'c': weights_arr[2]}
+
+
+if __name__ == '__main__':
+
+    # Setup command-line arguments
+    parser = argparse.ArgumentParser(description = 'SCATLAVA index: a queryable SQLite database of per-measure and per-bin difficulty')
+    parser.add_argument('-x', '--index', help='the index database', default='scatlava_index.db')
+    subparsers = parser.add_subparsers(dest='command')
+
+    ingest_parser = subparsers.add_parser('ingest', help='analyze new and changed scores into the index')
+    ingest_parser.add_argument('inputs', help='directories (searched recursively for .xml/.musicxml/.mxl), glob patterns or files', nargs='+')
+    ingest_parser.add_argument('-b', '--bin_divisions', help='comma-separated numbers of bins per measure to analyze at', default='4')
+    ingest_parser.add_argument('-w', '--weights', help='comma-separated d,s,c to store difficulties for (stored ones are recomputed if they change)', default='0.33,0.33,0.34')
+    ingest_parser.add_argument('-j', '--jobs', help='number of processes (all cores by default)', default=multiprocessing.cpu_count(), type=int)
+
+    query_parser = subparsers.add_parser('query', help='find measures, bins or phrases')
+    query_parser.add_argument('-W', '--where', help='filter on density, syncopation, coordination or difficulty, e.g. \'coordination>0.6\' (can be repeated)', action='append', default=[])
+    query_parser.add_argument('-b', '--bin_divisions', help='number of bins per measure the values are for', default=4, type=int)
+    query_parser.add_argument('--bins', help='find bins instead of measures', action='store_true')
+    query_parser.add_argument('-p', '--phrase', help='find phrases of this many consecutive measures (with their mean values) instead of single measures', default=1, type=int)
+    query_parser.add_argument('-f', '--file', help='only look in this score file', default=None)
+    query_parser.add_argument('-w', '--weights', help='comma-separated d,s,c to rank difficulty by (the ingested ones by default)', default=None)
+    query_parser.add_argument('-o', '--order', help='value to sort by', default='difficulty', choices=value_columns)
+    query_parser.add_argument('-d', '--descending', help='highest values first (e.g. hardest first)', action='store_true')
+    query_parser.add_argument('-k', '--top', help='number of results', default=20, type=int)
+    query_parser.add_argument('--json', help='print one JSON object per result', action='store_true')
+
+    subparsers.add_parser('stats', help='print what the index holds')
+
+    args = parser.parse_args()
+
+    index = ScoreIndex(args.index)
+    try:
+        if args.command == 'ingest':
+            paths = find_scores(args.inputs)
+            levels = [int(b) for b in args.bin_divisions.split(',')]
+            start = time.time()
+
+            def progress(done, total, path, error):
+                if error:
+                    sys.stderr.write('\n{}: {}\n'.format(path, error))
+                sys.stderr.write('\r{}/{} scores, {:.1f} scores/s'.format(done, total, done / max(time.time() - start, 1e-6)))
+
+            num_analyzed, num_skipped, num_failed = index.ingest(paths, levels, parse_weights(args.weights), args.jobs, progress)
+            if num_analyzed or num_failed:
+                sys.stderr.write('\n')
+            print '{} scores analyzed, {} unchanged, {} errors'.format(num_analyzed, num_skipped, num_failed)
+            print 'index: {}'.format(index.stats())
+
+        elif args.command == 'query':
+            try:
+                filters = [parse_filter(text) for text in args.where]
+            except ValueError as e:
+                parser.error(str(e))
+            start = time.time()
+            results = index.query(filters, args.bin_divisions, args.bins, args.phrase, args.file, parse_weights(args.weights) if args.weights else None, args.order, args.descending, args.top)
+            elapsed = time.time() - start
+            if args.json:
+                for result in results:
+                    print json.dumps(result, sort_keys=True)
+            else:
+                print '{:<40} {:>6} {:>7} {:>5} {:>10} {:>12} {:>13} {:>11}'.format('file', 'part', 'measure', 'bin', 'density', 'syncopation', 'coordination', 'difficulty')
+                for result in results:
+                    measure = result['measure'] if args.phrase <= 1 else '{}-{}'.format(result['measure'], result['measure'] + args.phrase - 1)
+                    print '{:<40} {:>6} {:>7} {:>5} {density:>10.4f} {syncopation:>12.4f} {coordination:>13.4f} {difficulty:>11.4f}'.format(
+                        get_display_path(result['path'])[-40:] if result['path'] else result['score'][:8], result['part'], measure, result.get('bin', ''), **result)
+                print '{} results in {:.1f} ms'.format(len(results), elapsed * 1000)
+
+        else:
+            print json.dumps(index.stats(), indent=2, sort_keys=True)
+    finally:
+        index.close()
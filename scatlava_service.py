@@ -0,0 +1,303 @@
+# SCATLAVA service: analysis and generation over HTTP, with warm state
+#
+# Keeps uploaded scores in memory, keyed by content hash, and hands analysis and
+# generation to a bounded pool of worker processes, each with its own ScatlavaEngine
+# (so a score is only parsed and analyzed once per worker). Requests beyond what the
+# workers and the queue can hold are turned away with 503 instead of piling up.
+#
+#   POST /scores                          MusicXML (or .mxl) body; stores the score, returns its report
+#   GET  /scores/<hash>                   difficulty report (?weights=&bin_divisions=)
+#   POST /scores/<hash>/generate          variation as MusicXML, or as an edit log with format=edits
+#                                         (?target_difficulty=&seed=&strategy=&parts=&format=...)
+#   POST /generate                        same, for a MusicXML body that isn't stored
+#   GET  /stats                           score store, queue and worker engine stats
+
+
+import argparse
+import BaseHTTPServer
+import collections
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import SocketServer
+import StringIO
+import threading
+import urlparse
+import zipfile
+
+import scatlava
+
+log = logging.getLogger('scatlava.service')
+
+# Engine of a worker process (see init_worker())
+engine = None
+
+def init_worker(max_scores, bank=None):
+    global engine
+    engine = scatlava.ScatlavaEngine(max_scores, bank=bank)
+
+# Run one of the engine's methods in a worker process: task is (method, kwargs)
+def run_task(task):
+    method, kwargs = task
+    if method == 'stats':
+        return engine.stats()
+    return getattr(engine, method)(**kwargs)
+
+
+# Raised when the workers and the queue are full
+class ServiceBusy(Exception):
+    pass
+
+# Raised for requests the service can't make sense of (400)
+class BadRequest(Exception):
+    pass
+
+# Scores (kept as MusicXML, by content hash) and the worker pool they're analyzed and
+# generated with
+#   - jobs: number of worker processes
+#   - queue_size: number of requests that may wait for a worker before the service
+#     turns new ones away (see submit())
+#   - max_scores: number of scores to keep, both here and in every worker's engine
+#   - timeout: seconds to wait for a worker's result
+#   - bank: corpus index (see scatlava_index.py) for the retrieve strategy
+class ScatlavaService(object):
+    def __init__(self, jobs=2, queue_size=16, max_scores=32, timeout=60, bank=None):
+        self.jobs = jobs
+        self.queue_size = queue_size
+        self.max_scores = max_scores
+        self.timeout = timeout
+        self.bank = bank
+        self.pool = multiprocessing.Pool(jobs, init_worker, (max_scores, bank))
+        self.slots = threading.BoundedSemaphore(jobs + queue_size)
+        self.pending = 0
+        self.rejected = 0
+        self.scores = collections.OrderedDict() # hash -> MusicXML
+        self.lock = threading.Lock()
+
+    # Store a score (MusicXML) under its content hash (see get_score_hash())
+    def add_score(self, score_xml):
+        score_hash = get_score_hash(score_xml)
+        with self.lock:
+            self.scores.pop(score_hash, None)
+            self.scores[score_hash] = score_xml
+            while len(self.scores) > self.max_scores:
+                self.scores.popitem(last=False)
+        return score_hash
+
+    # MusicXML of a stored score, or None
+    def get_score(self, score_hash):
+        with self.lock:
+            score_xml = self.scores.pop(score_hash, None)
+            if score_xml is not None:
+                self.scores[score_hash] = score_xml # most recently used go last
+        return score_xml
+
+    # Run an engine method on a worker and wait for its result. Raises ServiceBusy if
+    # jobs + queue_size requests are in flight already.
+    def submit(self, method, **kwargs):
+        if not self.slots.acquire(False):
+            with self.lock:
+                self.rejected += 1
+            raise ServiceBusy()
+        with self.lock:
+            self.pending += 1
+        try:
+            return self.pool.apply_async(run_task, ((method, kwargs),)).get(self.timeout)
+        finally:
+            with self.lock:
+                self.pending -= 1
+            self.slots.release()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'jobs': self.jobs,
+                'queue_size': self.queue_size,
+                'pending': self.pending,
+                'rejected': self.rejected,
+                'scores': len(self.scores),
+                'max_scores': self.max_scores
+            }
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+
+# Content hash a score is stored and analyzed under
+def get_score_hash(score_xml):
+    return hashlib.sha1(score_xml).hexdigest()
+
+# Generation and report parameters from a query string, with the same defaults as
+# scatlava.py's command line
+def get_params(query):
+    params = urlparse.parse_qs(query)
+    def get(name, default, convert):
+        if name not in params:
+            return default
+        try:
+            return convert(params[name][-1])
+        except ValueError:
+            raise BadRequest('invalid {}: {}'.format(name, params[name][-1]))
+    def get_dsc(name, default):
+        values = get(name, default, lambda value: [float(v) for v in value.split(',')])
+        if len(values) != 3:
+            raise BadRequest('{} needs to be d,s,c'.format(name))
+        return {'d': values[0], 's': values[1], 'c': values[2]}
+
+    bin_divisions = get('bin_divisions', 4, int)
+    if bin_divisions < 1:
+        raise BadRequest('invalid bin_divisions: {}'.format(bin_divisions))
+    strategy = get('strategy', 'stochastic', str)
+    if strategy not in ('stochastic', 'greedy', 'beam', 'plan', 'retrieve'):
+        raise BadRequest('invalid strategy: {}'.format(strategy))
+    output_format = get('format', 'xml', str)
+    if output_format not in ('xml', 'edits'):
+        raise BadRequest('invalid format: {}'.format(output_format))
+    return {
+        'target_difficulty': get('target_difficulty', 0.5, float),
+        'weights': get_dsc('weights', [0.33, 0.33, 0.34]),
+        'gradients': get_dsc('gradients', [0.33, 0.33, 0.34]),
+        'bin_divisions': bin_divisions,
+        'stochastic_modifier': get('stochastic_modifier', 0.5, float),
+        'max_iterations': get('max_iterations', 11, int),
+        'seed': get('seed', None, int),
+        'strategy': strategy,
+        'budget': get('budget', 64, int),
+        'part_ids': get('parts', None, lambda value: value.split(',')),
+        'edits': output_format == 'edits'
+    }
+
+class ScatlavaRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        service = self.server.service
+        url = urlparse.urlparse(self.path)
+        path = [part for part in url.path.split('/') if part]
+        body = ''
+        if 'Content-Length' in self.headers:
+            body = self.rfile.read(int(self.headers['Content-Length']))
+        try:
+            if body.startswith('PK\x03\x04'): # compressed MusicXML (.mxl)
+                with scatlava.open_score(StringIO.StringIO(body)) as f:
+                    body = f.read()
+            params = get_params(url.query)
+            if method == 'GET' and path == ['stats']:
+                stats = service.stats()
+                stats['engine'] = service.submit('stats') # whichever worker picks it up
+                self.send_json(200, stats)
+            elif method == 'POST' and path == ['scores']:
+                report = self.analyze(get_score_hash(body), body, params) # only scores that can be analyzed are stored
+                service.add_score(body)
+                self.send_json(201, report)
+            elif method == 'GET' and len(path) == 2 and path[0] == 'scores':
+                self.send_json(200, self.analyze(path[1], self.get_score(path[1]), params))
+            elif method == 'POST' and len(path) == 3 and path[0] == 'scores' and path[2] == 'generate':
+                self.generate(path[1], self.get_score(path[1]), params)
+            elif method == 'POST' and path == ['generate']:
+                self.generate(None, body, params)
+            else:
+                self.send_json(404, {'error': 'not found: {} {}'.format(method, url.path)})
+        except BadRequest as e:
+            self.send_json(400, {'error': str(e)})
+        except ServiceBusy:
+            self.send_json(503, {'error': 'busy, try again later'}, {'Retry-After': '1'})
+        except multiprocessing.TimeoutError:
+            self.send_json(504, {'error': 'timed out'})
+        except scatlava.ScoreError as e:
+            self.send_json(400, {'error': str(e)})
+        except zipfile.BadZipfile as e:
+            self.send_json(400, {'error': 'could not read score: {!r}'.format(e)})
+        except Exception as e:
+            log.exception('%s %s failed', method, self.path)
+            self.send_json(500, {'error': 'internal error: {!r}'.format(e)})
+
+    def get_score(self, score_hash):
+        score_xml = self.server.service.get_score(score_hash)
+        if score_xml is None:
+            raise BadRequest('unknown score: {}'.format(score_hash))
+        return score_xml
+
+    def analyze(self, score_hash, score_xml, params):
+        return self.server.service.submit('analyze', score_xml=score_xml, weights=params['weights'], bin_divisions=params['bin_divisions'], score_hash=score_hash)
+
+    def generate(self, score_hash, score_xml, params):
+        if params['strategy'] == 'retrieve' and self.server.service.bank is None:
+            raise BadRequest('the retrieve strategy needs the service to be started with --bank')
+        variant_xml, report = self.server.service.submit('generate', score_xml=score_xml, score_hash=score_hash, **dict(params))
+        report.pop('measure_difficulties') # keep the header short (see GET /scores/<hash>)
+        self.send(200, variant_xml, 'application/x-ndjson' if params['edits'] else 'application/xml', {
+            'X-Scatlava-Report': json.dumps(report, separators=(',', ':'))
+        })
+
+    def send_json(self, status, data, headers={}):
+        self.send(status, json.dumps(data), 'application/json', headers)
+
+    def send(self, status, body, content_type, headers={}):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers.iteritems():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def address_string(self):
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return self.server.server_address # Unix socket
+
+    def log_message(self, format, *args):
+        log.info('%s %s', self.address_string(), format % args)
+
+class ScatlavaHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class ScatlavaUnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == '__main__':
+
+    # Setup command-line arguments
+    parser = argparse.ArgumentParser(description = 'SCATLAVA service: analysis and generation over HTTP, with warm state')
+    parser.add_argument('-p', '--port', help='port to listen on (on localhost)', default=8642, type=int)
+    parser.add_argument('-u', '--socket', help='Unix socket to listen on instead of a port', default=None)
+    parser.add_argument('-j', '--jobs', help='number of worker processes', default=2, type=int)
+    parser.add_argument('-q', '--queue_size', help='number of requests that may wait for a worker before new ones get 503', default=16, type=int)
+    parser.add_argument('--max_scores', help='number of scores to keep in memory', default=32, type=int)
+    parser.add_argument('--timeout', help='seconds to wait for a worker before giving up with 504', default=60, type=float)
+    parser.add_argument('--bank', help='corpus index (see scatlava_index.py) for the retrieve strategy', default=None)
+    parser.add_argument('-v', '--verbose', help='log every request', action='store_true')
+
+    args = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.INFO if args.verbose else logging.WARNING)
+
+    # Workers are forked before the server starts any threads
+    service = ScatlavaService(args.jobs, args.queue_size, args.max_scores, args.timeout, args.bank)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = ScatlavaUnixHTTPServer(args.socket, ScatlavaRequestHandler)
+    else:
+        server = ScatlavaHTTPServer(('127.0.0.1', args.port), ScatlavaRequestHandler)
+    server.service = service
+    print 'listening on {}'.format(args.socket or 'http://127.0.0.1:{}'.format(args.port))
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -0,0 +1,175 @@
+# Analysis: incremental, vectorized, memoized and multi-resolution values all agree with
+# analyzing one bin at a time
+
+import random
+import unittest
+
+import scatlava
+import scatlava_bench
+from tests.test_parse import read_fixture
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+fixtures = ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']
+
+# (bin, bin size, bin_divisions) of every bin of the fixtures and a synthetic score
+def get_score_bins(bin_divisions):
+    scores = [read_fixture(name) for name in fixtures] + [scatlava_bench.generate_score(8, seed=3).encode('utf-8')]
+    score_bins = []
+    for score_xml in scores:
+        score = scatlava.ScatlavaEngine().load(score_xml, bin_divisions)
+        bins = [bin for bins in score.measure_bins for bin in bins]
+        score_bins += [(bin, size, bin_divisions) for bin, size in zip(bins, score.bin_durations)]
+    return score_bins
+
+class AnalysisTest(unittest.TestCase):
+    def setUp(self):
+        self.bin_memo = scatlava.bin_memo
+        scatlava.bin_memo = scatlava.BinMemo()
+
+    def tearDown(self):
+        scatlava.bin_memo = self.bin_memo
+
+    def assert_values_equal(self, values, expected_values):
+        for key in ['density', 'syncopation', 'coordination']:
+            self.assertAlmostEqual(values[key], expected_values[key], places=12)
+
+class VectorizedTest(AnalysisTest):
+    def test_matches_one_bin_at_a_time(self):
+        if scatlava.np is None:
+            self.skipTest('needs numpy')
+        for bin_divisions in [1, 2, 4, 8]:
+            score_bins = get_score_bins(bin_divisions)
+            bins, bin_sizes = [bin for bin, bin_size, bd in score_bins], [bin_size for bin, bin_size, bd in score_bins]
+            densities, syncopations, coordinations = scatlava.calculate_values_for_bins(bins, bin_sizes, bin_divisions)
+            for bi, bin in enumerate(bins):
+                self.assert_values_equal({'density': densities[bi], 'syncopation': syncopations[bi], 'coordination': coordinations[bi]}, scatlava.calculate_values_for_bin(bin, bin_sizes[bi], bin_divisions))
+
+    def test_analyze_bins_without_numpy(self):
+        score_bins = get_score_bins(4)
+        bins, bin_sizes = [bin for bin, bin_size, bd in score_bins], [bin_size for bin, bin_size, bd in score_bins]
+        values = scatlava.analyze_bins(bins, bin_sizes, 4)
+        scatlava.bin_memo = scatlava.BinMemo()
+        np, scatlava.np = scatlava.np, None
+        try:
+            for bin_values, expected_values in zip(values, scatlava.analyze_bins(bins, bin_sizes, 4)):
+                self.assert_values_equal(bin_values, expected_values)
+        finally:
+            scatlava.np = np
+
+class ChordGroupTest(AnalysisTest):
+    def test_chord_sizes(self):
+        for bin, bin_size, bin_divisions in get_score_bins(4):
+            for note in bin:
+                self.assertEqual(bin.chord_size(note.chord), len([other for other in bin if other.chord == note.chord]))
+
+class BinScoreTest(AnalysisTest):
+    # Edit a bin at random, the way generation does, checking the incrementally updated
+    # values against analyzing the whole bin after every edit
+    def test_update_after_edits(self):
+        rng = random.Random(1)
+        instruments = [scatlava.get_instrument_id(step, '5') for step in 'CEFG']
+        for bin, bin_size, bin_divisions in get_score_bins(4) + get_score_bins(1):
+            if not bin:
+                continue
+            bin = bin.copy()
+            score = scatlava.BinScore(bin, bin_size, bin_divisions)
+            self.assert_values_equal(score.values(), scatlava.calculate_values_for_bin(bin, bin_size, bin_divisions))
+            for i in xrange(8):
+                operation = rng.choice(['rest', 'pitch', 'swap', 'remove', 'beam', 'replace'])
+                ni = rng.randrange(len(bin))
+                if operation == 'rest':
+                    bin.set_rest(ni)
+                elif operation == 'pitch':
+                    bin.set_pitch(ni, scatlava.Note(0, 0, rng.choice(instruments)))
+                elif operation == 'swap':
+                    bin.swap_notes(ni, rng.randrange(len(bin)))
+                elif operation == 'remove' and len(bin) > 1:
+                    bin.remove_note(ni)
+                elif operation == 'beam':
+                    bin.clear_beam(ni)
+                elif operation == 'replace':
+                    bin.replace_notes([[0, bin_size / 2, 'C', '5', None], [0, bin_size / 2, None, None, None], [bin_size / 2, bin_size / 2, 'G', '5', 'x']])
+                score.update()
+                self.assert_values_equal(score.values(), scatlava.calculate_values_for_bin(bin, bin_size, bin_divisions))
+
+class AdjustBinTest(AnalysisTest):
+    def test_bin_passed_in_is_untouched(self):
+        for bin, bin_size, bin_divisions in get_score_bins(4)[:64]:
+            layout = [(note.onset, note.rest, note.instrument) for note in bin]
+            adjusted_bin = scatlava.adjust_bin(bin, bin_size, bin_divisions, 0., weights, weights, 1., 11, random.Random(2))
+            self.assertEqual([(note.onset, note.rest, note.instrument) for note in bin], layout)
+            self.assertEqual(bin.changes, [])
+            if adjusted_bin is not bin:
+                self.assert_values_equal(scatlava.analyze_bins([adjusted_bin], bin_size, bin_divisions)[0], scatlava.calculate_values_for_bin(adjusted_bin, bin_size, bin_divisions))
+
+    def test_iteration_budget(self):
+        scatlava.metrics.take_counts()
+        bins = [bin for bin, bin_size, bin_divisions in get_score_bins(4) if bin]
+        for max_iterations in [0, 1, 3]:
+            for bin in bins:
+                scatlava.adjust_bin(bin, 256, 4, 0., weights, weights, 1., max_iterations, random.Random(3))
+            counters, mutations, iterations_per_bin, evaluations_per_bin = scatlava.metrics.take_counts()
+            self.assertEqual(sum(iterations_per_bin.values()), len(bins))
+            self.assertEqual(max(iterations_per_bin), max_iterations)
+            self.assertEqual(counters['evaluations'], counters['iterations'] + len(bins))
+            self.assertGreater(counters['iteration_cap_hits'], 0)
+        self.assertIs(scatlava.adjust_bin(bins[0], 256, 4, 0., weights, weights, 1., 0), bins[0])
+
+class BinMemoTest(AnalysisTest):
+    def test_lru(self):
+        memo = scatlava.BinMemo(max_size=2)
+        memo.put('a', 1)
+        memo.put('b', 2)
+        self.assertEqual(memo.get('a'), 1)
+        memo.put('c', 3) # evicts b, the least recently used
+        self.assertIsNone(memo.get('b'))
+        self.assertEqual((memo.get('a'), memo.get('c')), (1, 3))
+        self.assertEqual(memo.stats()['hits'], 3)
+        self.assertEqual(memo.stats()['misses'], 1)
+        self.assertEqual(memo.stats()['entries'], 2)
+
+    def test_same_signature_same_values(self):
+        score_bins = get_score_bins(4)
+        bins, bin_sizes = [bin for bin, bin_size, bd in score_bins], [bin_size for bin, bin_size, bd in score_bins]
+        scatlava.bin_memo = scatlava.BinMemo()
+        values = scatlava.analyze_bins(bins, bin_sizes, 4)
+        self.assertGreater(len(bins), len(scatlava.bin_memo.entries)) # repeated patterns share a signature
+        self.assertEqual(scatlava.analyze_bins(bins, bin_sizes, 4), values)
+        for bi, bin in enumerate(bins):
+            self.assert_values_equal(values[bi], scatlava.calculate_values_for_bin(bin, bin_sizes[bi], 4))
+
+    def test_signature_ignores_engraving(self):
+        bin = get_score_bins(4)[0][0]
+        moved = bin.copy()
+        for note in moved:
+            note.onset += 64
+            note.chord += 3
+            note.source = None
+        self.assertEqual(scatlava.get_bin_signature(moved, 256, 4), scatlava.get_bin_signature(bin, 256, 4))
+        self.assertNotEqual(scatlava.get_bin_signature(bin, 128, 4), scatlava.get_bin_signature(bin, 256, 4))
+
+class ScoreLevelsTest(AnalysisTest):
+    def test_levels_match_single_resolution(self):
+        for name in fixtures:
+            measures, parts = scatlava.get_score_measures(scatlava.parse_musicxml(read_fixture(name)))
+            meters = scatlava.get_measure_meters(measures, parts)
+            levels = scatlava.ScoreLevels(measures, [1, 4], meter=meters)
+            for bin_divisions in [1, 2, 4, 8]: # 2 and 8 are binned later
+                values = levels.get_values(bin_divisions)
+                self.assertEqual(len(values), len(measures) * bin_divisions)
+                for bin_values, expected_values in zip(values, scatlava.analyze_measures(measures, bin_divisions, meters)):
+                    self.assert_values_equal(bin_values, expected_values)
+
+class MultiPartReportTest(unittest.TestCase):
+    def test_parts_add_up(self):
+        report = scatlava.ScatlavaEngine().analyze(read_fixture('multipart.xml'), weights)
+        self.assertEqual([(part['part'], part['measures']) for part in report['parts']], [('P1', 3), ('P2', 3)])
+        self.assertEqual(len(report['measure_difficulties']), report['measures'])
+        for key in ['overall_difficulty', 'overall_difficulty_by_measure']:
+            self.assertAlmostEqual(sum(part[key] * part['measures'] for part in report['parts']) / report['measures'], report[key], places=12)
+        self.assertAlmostEqual(sum(report['measure_difficulties']) / report['measures'], report['overall_difficulty'], places=12)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+# Batch mode: a record per score, errors that don't stop the run, and resuming
+
+import csv
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import scatlava
+import scatlava_batch
+from tests.test_parse import tests_dir, read_fixture
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+fixtures = ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.scores_dir = os.path.join(self.dir, 'scores')
+        os.makedirs(os.path.join(self.scores_dir, 'more'))
+        for name in fixtures[:2]:
+            shutil.copy(os.path.join(tests_dir, name), self.scores_dir)
+        scatlava.write_mxl(os.path.join(self.scores_dir, 'more', 'multipart.mxl'), read_fixture('multipart.xml'))
+        with open(os.path.join(self.scores_dir, 'broken.xml'), 'wb') as f:
+            f.write('<score-partwise>')
+        with open(os.path.join(self.scores_dir, 'notes.txt'), 'wb') as f:
+            f.write('not a score')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def run_batch(self, *args):
+        subprocess.check_call([sys.executable, os.path.join(tests_dir, '..', 'scatlava_batch.py'), self.scores_dir, '-j', '2'] + list(args), stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    def read_records(self, out_path):
+        with open(out_path, 'rb') as f:
+            if out_path.endswith('.csv'):
+                return list(csv.DictReader(f))
+            return [json.loads(line) for line in f]
+
+    def test_find_scores(self):
+        self.assertEqual([os.path.relpath(path, self.scores_dir) for path in scatlava_batch.find_scores([self.scores_dir])], ['broken.xml', os.path.join('more', 'multipart.mxl'), 'multivoice.xml', 'notationTest1.xml'])
+        self.assertEqual(scatlava_batch.find_scores([os.path.join(self.scores_dir, 'm*.xml')]), [os.path.join(self.scores_dir, 'multivoice.xml')])
+
+    def test_records_are_the_analysis(self):
+        out_path = os.path.join(self.dir, 'summary.ndjson')
+        self.run_batch('-o', out_path)
+        records = dict((os.path.basename(record['path']), record) for record in self.read_records(out_path))
+        self.assertEqual(sorted(records), ['broken.xml', 'multipart.mxl', 'multivoice.xml', 'notationTest1.xml'])
+        self.assertIn('error', records['broken.xml'])
+        for name in fixtures:
+            record = records[name.replace('multipart.xml', 'multipart.mxl')]
+            report = scatlava.ScatlavaEngine().analyze(read_fixture(name), weights)
+            self.assertEqual(record['score'], scatlava_batch.hash_file(record['path']))
+            for key in ['measures', 'overall_difficulty', 'overall_difficulty_by_measure', 'measure_difficulties', 'parts']:
+                self.assertEqual(record[key], json.loads(json.dumps(report[key])))
+
+    def test_resume(self):
+        for out_path in [os.path.join(self.dir, 'summary.ndjson'), os.path.join(self.dir, 'summary.csv')]:
+            self.run_batch('-o', out_path)
+            self.run_batch('-o', out_path) # only the broken file is tried again
+            records = self.read_records(out_path)
+            self.assertEqual(len(records), 5)
+            self.assertEqual(len([record for record in records if record.get('error')]), 2)
+            self.run_batch('-o', out_path, '-b', '2') # other bin_divisions aren't done yet
+            self.assertEqual(len(self.read_records(out_path)), 9)
+
+    def test_resume_generation(self):
+        for out_path in [os.path.join(self.dir, 'summary.ndjson'), os.path.join(self.dir, 'summary.csv')]:
+            out_dir = os.path.join(self.dir, 'variants')
+            self.run_batch('-o', out_path, '-G', out_dir, '-r', '1')
+            self.run_batch('-o', out_path, '-G', out_dir, '-r', '1')
+            self.assertEqual(len(self.read_records(out_path)), 5)
+            self.run_batch('-o', out_path, '-G', out_dir, '-r', '2') # other options aren't done yet
+            self.run_batch('-o', out_path, '-G', out_dir, '-r', '2', '-S', 'greedy')
+            self.run_batch('-o', out_path, '-G', out_dir, '-r', '2', '-S', 'greedy', '-g', '0.5,0.5,0.5')
+            self.assertEqual(len(self.read_records(out_path)), 17)
+
+    def test_generated_edit_logs(self):
+        out_path = os.path.join(self.dir, 'summary.ndjson')
+        out_dir = os.path.join(self.dir, 'variants')
+        self.run_batch('-o', out_path, '-G', out_dir, '-E', '-r', '1', '-t', '0.3')
+        for record in self.read_records(out_path):
+            if 'error' in record:
+                continue
+            with scatlava.open_score(record['path']) as f:
+                score_xml = f.read()
+            with open(record['out'], 'rb') as f:
+                variant = scatlava.EditLog.loads(f.read()).apply(score_xml)
+            self.assertEqual(variant, scatlava.ScatlavaEngine().generate(score_xml, 0.3, weights, weights, seed=1)[0])
+            self.assertAlmostEqual(record['new_overall_difficulty'], scatlava.ScatlavaEngine().analyze(variant, weights)['overall_difficulty'], places=10)
+
+
+if __name__ == '__main__':
+    unittest.main()
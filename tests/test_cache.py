@@ -0,0 +1,97 @@
+# Analysis cache and snapshots: what is read back is what was analyzed or parsed
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import scatlava
+from tests.test_parse import tests_dir, read_fixture
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+fixtures = ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']
+
+# (onset, duration, instrument, rest, notehead) of every note of every bin of every measure
+def get_layout(measure_bins):
+    return [[[(note.onset, note.duration, note.instrument, note.rest, note.notehead) for note in bin] for bin in bins] for bins in measure_bins]
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+class AnalysisCacheTest(CacheTest):
+    def test_put_and_get(self):
+        cache = scatlava.AnalysisCache(os.path.join(self.dir, 'cache'))
+        self.assertIsNone(cache.get('score', 4))
+        values = [{'density': 0.25, 'syncopation': 1. / 3, 'coordination': 0.}]
+        cache.put('score', 4, values)
+        self.assertEqual(cache.get('score', 4), values)
+        self.assertIsNone(cache.get('score', 2))
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses'], cache.stats()['entries']), (1, 2, 1))
+
+    def test_least_recently_used_are_evicted(self):
+        cache = scatlava.AnalysisCache(os.path.join(self.dir, 'cache'))
+        values = [{'density': 0.25, 'syncopation': 0.5, 'coordination': 0.75}] * 16
+        cache.put('a', 4, values)
+        cache.max_size = os.path.getsize(cache.get_path('a', 4)) * 2
+        cache.put('b', 4, values)
+        os.utime(cache.get_path('a', 4), (0, 0))
+        cache.put('c', 4, values)
+        self.assertIsNone(cache.get('a', 4))
+        self.assertIsNotNone(cache.get('b', 4))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_engine_reports_are_the_same_from_the_cache(self):
+        cache = scatlava.AnalysisCache(os.path.join(self.dir, 'cache'))
+        for name in fixtures:
+            report = scatlava.ScatlavaEngine().analyze(read_fixture(name), weights)
+            self.assertEqual(scatlava.ScatlavaEngine(cache=cache).analyze(read_fixture(name), weights), report)
+            hits = cache.hits
+            self.assertEqual(scatlava.ScatlavaEngine(cache=cache).analyze(read_fixture(name), weights), report)
+            self.assertEqual(cache.hits, hits + 2) # by bins and by measures
+
+@unittest.skipIf(scatlava.np is None, 'snapshots need numpy')
+class SnapshotTest(CacheTest):
+    def put_snapshot(self, store, score_xml):
+        score_hash = scatlava.hashlib.sha1(score_xml).hexdigest()
+        measures, parts = scatlava.get_score_measures(scatlava.parse_musicxml(score_xml))
+        levels = scatlava.ScoreLevels(measures, [1, 4], meter=scatlava.get_measure_meters(measures, parts))
+        store.put(score_hash, score_xml, measures, parts, levels)
+        return score_hash, parts, levels
+
+    def test_snapshot_is_the_parsed_score(self):
+        store = scatlava.SnapshotStore(os.path.join(self.dir, 'snapshots'))
+        for name in fixtures:
+            score_xml = read_fixture(name)
+            score_hash, parts, levels = self.put_snapshot(store, score_xml)
+            snapshot = store.get(score_hash)
+            self.assertEqual(snapshot.parts, parts)
+            self.assertEqual(snapshot.meters, levels.meters)
+            for bin_divisions in [1, 2, 4, 8]:
+                for values, expected_values in zip(snapshot.get_values(bin_divisions), levels.get_values(bin_divisions)):
+                    for key in ['density', 'syncopation', 'coordination']:
+                        self.assertAlmostEqual(values[key], expected_values[key], places=12)
+                self.assertEqual(get_layout(snapshot.get_bins(bin_divisions)), get_layout(levels.get_bins(bin_divisions)))
+                self.assertEqual(snapshot.bin_durations[bin_divisions], levels.bin_durations[bin_divisions])
+        self.assertIsNone(store.get('nothing'))
+        self.assertEqual((store.stats()['hits'], store.stats()['misses']), (len(fixtures), 1))
+
+    def test_cli_output_is_the_same_with_snapshots(self):
+        outputs = []
+        for snapshot_dir in [[], ['--snapshot_dir', os.path.join(self.dir, 'snapshots')]] * 2:
+            out_path = os.path.join(self.dir, 'out.xml')
+            subprocess.check_call([sys.executable, os.path.join(tests_dir, '..', 'scatlava.py'), os.path.join(tests_dir, 'multipart.xml'), out_path, '-r', '1'] + snapshot_dir, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            with open(out_path, 'rb') as f:
+                outputs.append(f.read())
+        self.assertEqual(len(os.listdir(os.path.join(self.dir, 'snapshots'))), 1)
+        self.assertEqual(outputs[1:], outputs[:1] * 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Edit logs: only what changed about each note, replayed into the same variation
+
+import json
+import unittest
+
+import scatlava
+from tests.test_parse import read_fixture
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+class EditLogTest(unittest.TestCase):
+    fixtures = ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']
+
+    def test_apply_gives_the_variation(self):
+        for name in self.fixtures:
+            score_xml = read_fixture(name)
+            for strategy in ['stochastic', 'greedy', 'beam', 'plan']:
+                for bin_divisions in [1, 4]:
+                    session = scatlava.ScatlavaEngine().session(score_xml, 0.3, weights, weights, seed=1, strategy=strategy, bin_divisions=bin_divisions)
+                    edit_log = scatlava.EditLog.loads(session.edit_log().dumps())
+                    self.assertEqual(edit_log.apply(score_xml), session.variant())
+
+    def test_lines_have_only_changed_fields(self):
+        score_xml = read_fixture('notationTest1.xml')
+        session = scatlava.ScatlavaEngine().session(score_xml, 0.3, weights, weights, seed=1)
+        lines = session.edit_log().dumps().splitlines()
+        header = json.loads(lines[0])
+        self.assertEqual((header['format'], header['version']), (scatlava.EditLog.format, scatlava.EditLog.version))
+        self.assertTrue(lines[1:])
+        for line in lines[1:]:
+            mi, bins = json.loads(line)
+            self.assertIsNotNone(bins[-1])
+            for bi, edits in enumerate(bins):
+                if edits is None:
+                    continue
+                self.assertTrue(edits)
+                self.assertTrue(set(edits) <= set(['notes', 'pitch', 'rest', 'beam', 'order']))
+                notes = session.score.measure_bins[mi][bi]
+                for pitch in edits.get('pitch', []):
+                    self.assertNotEqual(scatlava.get_instrument_id(pitch[1][0], pitch[1][1:]), notes[pitch[0]].instrument)
+                if 'order' in edits:
+                    self.assertNotEqual(edits['order'], range(len(notes)))
+        self.assertLess(len(session.edit_log().dumps()) * 10, len(session.variant()))
+
+    def test_rejects_other_scores_and_versions(self):
+        score_xml = read_fixture('notationTest1.xml')
+        edits = scatlava.ScatlavaEngine().session(score_xml, 0.3, weights, weights, seed=1).edit_log().dumps()
+        self.assertRaises(ValueError, scatlava.EditLog.loads(edits).apply, read_fixture('multivoice.xml'))
+        lines = edits.splitlines()
+        header = json.loads(lines[0])
+        header['version'] = scatlava.EditLog.version - 1
+        self.assertRaises(ValueError, scatlava.EditLog.loads, '\n'.join([json.dumps(header)] + lines[1:]))
+        mi, bins = json.loads(lines[1])
+        bins[-1]['transpose'] = 1
+        edit_log = scatlava.EditLog.loads('\n'.join([lines[0], json.dumps([mi, bins])] + lines[2:]))
+        self.assertRaises(ValueError, edit_log.apply, score_xml)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+# Generation: a seed always gives the same variation, however it is generated
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import scatlava
+import scatlava_bench
+from tests.test_parse import tests_dir, read_fixture
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+class GenerateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.synthetic_path = os.path.join(self.dir, 'synthetic.xml')
+        with open(self.synthetic_path, 'wb') as f:
+            f.write(scatlava_bench.generate_score(8, seed=1).encode('utf-8'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    # Run scatlava.py on a score; returns {target difficulty: variation} (just the one
+    # under None without -T)
+    def run_cli(self, in_path, *args):
+        out_path = os.path.join(self.dir, 'out.xml')
+        subprocess.check_call([sys.executable, os.path.join(tests_dir, '..', 'scatlava.py'), in_path, out_path] + list(args), stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        targets = [None]
+        if '-T' in args:
+            targets = [float(target) for target in args[list(args).index('-T') + 1].split(',')]
+        variants = {}
+        for target_difficulty in targets:
+            path = out_path if target_difficulty is None else scatlava.get_variant_path(out_path, target_difficulty)
+            with open(path, 'rb') as f:
+                variants[target_difficulty] = f.read()
+            os.remove(path)
+        return variants
+
+    def test_same_seed_same_variation(self):
+        with open(self.synthetic_path, 'rb') as f:
+            synthetic_xml = f.read()
+        for score_xml in [read_fixture('multipart.xml'), synthetic_xml]:
+            for strategy in ['stochastic', 'greedy', 'beam', 'plan']:
+                variants = [scatlava.ScatlavaEngine().generate(score_xml, 0.3, weights, weights, seed=seed, strategy=strategy)[0] for seed in [1, 1]]
+                self.assertEqual(variants[1], variants[0])
+        variants = [scatlava.ScatlavaEngine().generate(synthetic_xml, 0.3, weights, weights, seed=seed)[0] for seed in [1, 2]]
+        self.assertNotEqual(variants[1], variants[0])
+
+    def test_jobs_give_the_same_variation(self):
+        for in_path in [self.synthetic_path, os.path.join(tests_dir, 'multipart.xml')]:
+            variant = self.run_cli(in_path, '-r', '3')[None]
+            with open(in_path, 'rb') as f:
+                self.assertEqual(variant, scatlava.ScatlavaEngine().generate(f.read(), 0.5, weights, weights, seed=3)[0])
+            self.assertEqual(self.run_cli(in_path, '-r', '3', '-j', '2')[None], variant)
+
+    def test_jobs_keep_chord_notes_without_a_voice(self):
+        in_path = os.path.join(tests_dir, 'notationTest1.xml') # its <chord/> notes have no <voice>
+        edits_path = os.path.join(self.dir, 'edits.ndjson')
+        variant = self.run_cli(in_path, '-r', '7')[None]
+        self.assertEqual(self.run_cli(in_path, '-r', '7', '-j', '4', '-E', edits_path)[None], variant)
+        self.assertEqual(self.run_cli(in_path, '--apply', edits_path)[None], variant)
+
+    def test_bin_rngs(self):
+        draws = [[rng.random() for i in xrange(4)] for rng in [scatlava.get_bin_rng(1, 0, 0), scatlava.get_bin_rng(1, 0, 0), scatlava.get_bin_rng(1, 0, 1), scatlava.get_bin_rng(2, 0, 0)]]
+        self.assertEqual(draws[1], draws[0])
+        self.assertNotEqual(draws[2], draws[0])
+        self.assertNotEqual(draws[3], draws[0])
+
+    def test_ladder_matches_single_targets(self):
+        in_path = os.path.join(tests_dir, 'notationTest1.xml')
+        for jobs in ['1', '2']:
+            variants = self.run_cli(in_path, '-S', 'plan', '-T', '0.2,0.7', '-j', jobs)
+            self.assertNotEqual(variants[0.2], variants[0.7])
+            for target_difficulty, variant in variants.items():
+                self.assertEqual(variant, self.run_cli(in_path, '-S', 'plan', '-t', str(target_difficulty))[None])
+
+    def test_synthetic_scores(self):
+        self.assertEqual(scatlava_bench.generate_score(8, seed=1), scatlava_bench.generate_score(8, seed=1))
+        self.assertNotEqual(scatlava_bench.generate_score(8, seed=2), scatlava_bench.generate_score(8, seed=1))
+        self.assertEqual(scatlava.ScatlavaEngine().analyze(scatlava_bench.generate_score(8, seed=1).encode('utf-8'), weights)['measures'], 8)
+
+    def test_other_parts_are_left_as_they_are(self):
+        score_xml = read_fixture('multipart.xml')
+        variant, report = scatlava.ScatlavaEngine().generate(score_xml, 0.1, weights, weights, seed=1, part_ids=['P2'])
+        offsets, variant_offsets = scatlava.get_measure_offsets(score_xml), scatlava.get_measure_offsets(variant)
+        for mi in xrange(3): # P1's measures
+            self.assertEqual(variant[variant_offsets[mi][0]:variant_offsets[mi][1]], score_xml[offsets[mi][0]:offsets[mi][1]])
+        self.assertEqual(report['parts'][0]['new_overall_difficulty'], report['parts'][0]['overall_difficulty'])
+        self.assertLess(report['parts'][1]['new_overall_difficulty'], report['parts'][1]['overall_difficulty'])
+
+
+if __name__ == '__main__':
+    unittest.main()
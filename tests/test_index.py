@@ -0,0 +1,89 @@
+# The corpus index: ingesting scores once and querying their measures, bins and phrases
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scatlava
+import scatlava_index
+from tests.test_parse import tests_dir
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+class ScoreIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.paths = [os.path.join(self.dir, name) for name in ['notationTest1.xml', 'multipart.xml']]
+        for path in self.paths:
+            shutil.copy(os.path.join(tests_dir, os.path.basename(path)), path)
+        self.index = scatlava_index.ScoreIndex(os.path.join(self.dir, 'index.db'))
+        self.assertEqual(self.index.ingest(self.paths, [1, 4], weights), (2, 0, 0))
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.dir)
+
+    def test_ingest_is_incremental(self):
+        broken_path = os.path.join(self.dir, 'broken.xml')
+        with open(broken_path, 'wb') as f:
+            f.write('<score-partwise>')
+        self.assertEqual(self.index.ingest(self.paths + [broken_path], [1, 4], weights), (0, 2, 1))
+        self.assertEqual(self.index.ingest(self.paths, [2], weights), (2, 0, 0)) # a new level
+        with open(self.paths[0], 'ab') as f:
+            f.write('\n')
+        self.assertEqual(self.index.ingest(self.paths, [1, 4], weights), (1, 1, 0))
+        stats = self.index.stats()
+        self.assertEqual((stats['files'], stats['scores']), (3, 2)) # the broken file is tried again next time
+
+    def test_measures_are_the_analysis(self):
+        for path in self.paths:
+            with open(path, 'rb') as f:
+                report = scatlava.ScatlavaEngine().analyze(f.read(), weights)
+            results = self.index.query(path=path, order='difficulty', limit=None)
+            self.assertEqual(len(results), report['measures'])
+            self.assertEqual(sorted(result['difficulty'] for result in results), [result['difficulty'] for result in results])
+            for result, measure_difficulty in zip(sorted(results, key=lambda result: (result['part'], result['measure'])), report['measure_difficulties']):
+                self.assertAlmostEqual(result['difficulty'], measure_difficulty, places=10)
+                self.assertEqual(result['path'], os.path.abspath(path))
+
+    def test_filters_order_and_limit(self):
+        results = self.index.query([scatlava_index.parse_filter('density>0.2'), scatlava_index.parse_filter('difficulty <= 0.5')], order='coordination', descending=True)
+        self.assertTrue(results)
+        for result in results:
+            self.assertGreater(result['density'], 0.2)
+            self.assertLessEqual(result['difficulty'], 0.5)
+        self.assertEqual(sorted([result['coordination'] for result in results], reverse=True), [result['coordination'] for result in results])
+        self.assertEqual(self.index.query(order='coordination', descending=True, limit=2), self.index.query(order='coordination', descending=True)[:2])
+        self.assertRaises(ValueError, scatlava_index.parse_filter, 'tempo>120')
+
+    def test_bins_and_phrases(self):
+        num_measures = len(self.index.query())
+        self.assertEqual(len(self.index.query(bins=True)), num_measures * 4)
+        self.assertEqual(len(self.index.query(bins=True, bin_divisions=1)), num_measures)
+        phrases = self.index.query(phrase=2, path=self.paths[1])
+        self.assertEqual(len(phrases), 4) # 2 per part, phrases don't cross parts
+        measures = dict(((result['part'], result['measure']), result) for result in self.index.query(path=self.paths[1]))
+        for phrase in phrases:
+            self.assertEqual(phrase['measures'], 2)
+            self.assertAlmostEqual(phrase['density'], (measures[phrase['part'], phrase['measure']]['density'] + measures[phrase['part'], phrase['measure'] + 1]['density']) / 2, places=10)
+
+    def test_weights(self):
+        other_weights = {'d': 0.1, 's': 0.2, 'c': 0.7}
+        results = self.index.query(weights=other_weights)
+        for result in results:
+            self.assertAlmostEqual(result['difficulty'], scatlava.calculate_difficulty_from_values(result['density'], result['syncopation'], result['coordination'], other_weights), places=10)
+        self.index.set_weights(other_weights)
+        self.assertEqual(self.index.get_weights(), other_weights)
+        difficulties = dict(((result['score'], result['part'], result['measure']), result['difficulty']) for result in results)
+        for result in self.index.query():
+            self.assertAlmostEqual(result['difficulty'], difficulties[result['score'], result['part'], result['measure']], places=10)
+
+    def test_other_versions_are_refused(self):
+        self.index.set_meta('version', scatlava_index.ScoreIndex.version + 1)
+        self.index.db.commit()
+        self.assertRaises(ValueError, scatlava_index.ScoreIndex, os.path.join(self.dir, 'index.db'))
+
+
+if __name__ == '__main__':
+    unittest.main()
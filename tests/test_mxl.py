@@ -0,0 +1,64 @@
+# Compressed MusicXML (.mxl): reading archives and writing the same bytes every time
+
+import contextlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+import zipfile
+
+import scatlava
+from tests.test_parse import tests_dir, read_fixture
+
+class MxlTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_write_and_read(self):
+        path = os.path.join(self.dir, 'score.mxl')
+        scatlava.write_mxl(path, read_fixture('multivoice.xml'))
+        with contextlib.closing(zipfile.ZipFile(path)) as zf:
+            self.assertEqual(zf.namelist()[0], 'mimetype')
+            self.assertEqual(zf.getinfo('mimetype').compress_type, zipfile.ZIP_STORED)
+            self.assertEqual(scatlava.get_mxl_rootfile(zf), 'score.xml')
+        with scatlava.open_score(path) as f:
+            self.assertEqual(f.read(), read_fixture('multivoice.xml'))
+
+    def test_streamed_archive_matches_write_mxl(self):
+        paths = [os.path.join(self.dir, name, 'score.mxl') for name in ['a', 'b', 'c']]
+        for path in paths:
+            os.mkdir(os.path.dirname(path))
+        scatlava.write_mxl(paths[0], read_fixture('multivoice.xml'))
+        for path in paths[1:]:
+            with scatlava.create_score(path) as f:
+                f.write(read_fixture('multivoice.xml'))
+            time.sleep(2) # zip dates have a resolution of 2 seconds
+        archives = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                archives.append(f.read())
+        self.assertEqual(archives[1], archives[0])
+        self.assertEqual(archives[2], archives[0])
+        self.assertEqual(os.listdir(os.path.dirname(paths[1])), ['score.mxl']) # no temporary file left behind
+
+    def test_cli_reads_and_writes_mxl(self):
+        mxl_path = os.path.join(self.dir, 'in.mxl')
+        scatlava.write_mxl(mxl_path, read_fixture('notationTest1.xml'))
+        outputs = []
+        for in_path, stream in [(os.path.join(tests_dir, 'notationTest1.xml'), []), (mxl_path, []), (mxl_path, ['-s'])]:
+            out_path = os.path.join(self.dir, 'out.mxl')
+            subprocess.check_call([sys.executable, os.path.join(tests_dir, '..', 'scatlava.py'), in_path, out_path, '-r', '1'] + stream, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            with scatlava.open_score(out_path) as f:
+                outputs.append(f.read())
+        self.assertEqual(outputs[1], outputs[0])
+        self.assertEqual(outputs[2], outputs[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,158 @@
+# Parsing and binning: onsets, chords and the bins notes end up in
+
+import cStringIO
+import fractions
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import scatlava
+
+tests_dir = os.path.dirname(os.path.abspath(__file__))
+
+def read_fixture(name):
+    with open(os.path.join(tests_dir, name), 'rb') as f:
+        return f.read()
+
+# Bins of every measure of a fixture, as (onset, duration, instrument name, chord) tuples
+def get_bin_notes(name, bin_divisions):
+    measures, parts = scatlava.get_score_measures(scatlava.parse_musicxml(read_fixture(name)))
+    meters = scatlava.get_measure_meters(measures, parts)
+    return [[[(note.onset, note.duration, scatlava.instrument_names[note.instrument], note.chord) for note in bin] for bin in scatlava.bin_measure(measure, bin_divisions, meter=meters[mi])[0]] for mi, measure in enumerate(measures)]
+
+def make_note(step=None, duration=1, chord=False, default_x=None):
+    note = scatlava.collections.OrderedDict()
+    if default_x is not None:
+        note['@default-x'] = default_x
+    if chord:
+        note['chord'] = None
+    if step is None:
+        note['rest'] = None
+    else:
+        note['unpitched'] = scatlava.collections.OrderedDict([('display-step', step), ('display-octave', '5')])
+    note['duration'] = str(duration)
+    return note
+
+class ParseNotesTest(unittest.TestCase):
+    def test_backup_and_forward(self):
+        bins = get_bin_notes('multivoice.xml', 4)[0]
+        self.assertEqual([len(bin) for bin in bins], [3, 3, 4, 4])
+        # the bass drum after <backup> starts the measure, and the one after <forward> is on beat 3
+        self.assertEqual(bins[0][1], (0, 4, ('F', '4'), 0))
+        self.assertEqual(bins[2][1], (8, 2, ('F', '4'), 4))
+        self.assertEqual(bins[3][2], (12, 4, ('B#', '0'), 6))
+
+    def test_chord_is_the_authority(self):
+        notes = scatlava.parse_notes([
+            make_note('C', 2, default_x='10'),
+            make_note('G', 2, chord=True, default_x='12'),
+            make_note('C', 2, default_x='12'),
+            make_note('G', 2, default_x='30')
+        ])
+        self.assertEqual([(note.onset, note.chord) for note in notes], [(0, 0), (0, 0), (2, 1), (4, 2)])
+
+    def test_default_x_without_chord(self):
+        notes = scatlava.parse_notes([
+            make_note('C', 2, default_x='10'),
+            make_note('G', 2, default_x='10'),
+            make_note('C', 2, default_x='30')
+        ])
+        self.assertEqual([(note.onset, note.chord) for note in notes], [(0, 0), (0, 0), (2, 1)])
+
+    def test_voices_share_chords_by_onset(self):
+        bins = get_bin_notes('multivoice.xml', 1)[1]
+        chords = [note[3] for note in bins[0] if note[0] == 10]
+        self.assertEqual(len(chords), 4)
+        self.assertEqual(len(set(chords)), 1)
+
+    def test_notes_past_the_measure_go_into_the_last_bin(self):
+        notes = scatlava.parse_notes([make_note('C', 1024), make_note('G', 256)])
+        bins, bin_durations = scatlava.bin_notes(notes, 4)
+        self.assertEqual([len(bin) for bin in bins], [1, 0, 0, 1])
+
+class BaselineParityTest(unittest.TestCase):
+    # overall difficulty of tests/notationTest1.xml at the default weights, as the
+    # original (dict-based) implementation analyzed it
+    baseline = {1: 0.497089646465, 2: 0.384779761905, 4: 0.213041666667}
+
+    def test_overall_difficulty(self):
+        engine = scatlava.ScatlavaEngine()
+        for bin_divisions, difficulty in sorted(self.baseline.items()):
+            report = engine.analyze(read_fixture('notationTest1.xml'), {'d': 0.33, 's': 0.33, 'c': 0.34}, bin_divisions)
+            self.assertAlmostEqual(report['overall_difficulty'], difficulty, places=10)
+            self.assertAlmostEqual(report['overall_difficulty_by_measure'], self.baseline[1], places=10)
+
+
+class MeterTest(unittest.TestCase):
+    def make_measure(self, divisions=None, beats=None, beat_type=None):
+        attrs = scatlava.collections.OrderedDict()
+        if divisions is not None:
+            attrs['divisions'] = str(divisions)
+        if beats is not None:
+            attrs['time'] = scatlava.collections.OrderedDict([('beats', beats), ('beat-type', beat_type)])
+        return {'attributes': attrs}
+
+    def test_time_signatures(self):
+        meter = scatlava.get_measure_meter(self.make_measure(2, '3', '4'))
+        self.assertEqual((meter.divisions, meter.length, meter.duration), (2, fractions.Fraction(3, 4), 6))
+        meter = scatlava.get_measure_meter(self.make_measure(beats='7', beat_type='8'), meter) # divisions carry over
+        self.assertEqual((meter.divisions, meter.duration), (2, 7))
+        self.assertEqual(scatlava.get_measure_meter({}, meter), meter)
+        self.assertEqual(scatlava.get_measure_meter(self.make_measure(4, '3+2', '8')).duration, 10)
+        self.assertEqual(scatlava.get_measure_meter(self.make_measure(4, ['2', '3'], ['4', '8'])).duration, 14)
+        self.assertIs(scatlava.get_measure_meter(self.make_measure(2, '3', '4')), scatlava.get_meter(2, fractions.Fraction(3, 4)))
+
+    def test_bin_grid(self):
+        meter = scatlava.get_meter(2, fractions.Fraction(7, 8))
+        self.assertEqual(meter.get_bin_starts(4), [0, 1, 3, 5])
+        self.assertEqual(meter.get_bin_durations(4), [1, 2, 2, 2])
+        self.assertEqual(meter.get_bin_durations(8), [1] * 8) # bins are never empty
+        self.assertEqual(scatlava.default_meter.get_bin_starts(4), [0, 256, 512, 768])
+
+    def test_notes_are_binned_by_the_grid(self):
+        notes = scatlava.parse_notes([make_note('C', 1), make_note('G', 2), make_note('C', 1), make_note('G', 1), make_note('C', 2)])
+        bins, bin_durations = scatlava.bin_notes(notes, 4, scatlava.get_meter(2, fractions.Fraction(7, 8)))
+        self.assertEqual([[note.onset for note in bin] for bin in bins], [[0], [1], [3, 4], [5]])
+        self.assertEqual(bin_durations, [1, 2, 2, 2])
+
+    def test_parts_start_from_the_default_meter(self):
+        measures, parts = scatlava.get_score_measures(scatlava.parse_musicxml(read_fixture('multipart.xml')))
+        meters = scatlava.get_measure_meters(measures, parts)
+        self.assertEqual([meter.duration for meter in meters], [6, 7, 7, 6, 7, 7])
+
+class MeasureStreamerTest(unittest.TestCase):
+    def test_measures_are_parsed_as_the_whole_score(self):
+        for name in ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']:
+            score_xml = read_fixture(name)
+            measures, parts = scatlava.get_score_measures(scatlava.parse_musicxml(score_xml))
+            streamed = []
+            def process_measure(measure, mi, part_id):
+                streamed.append((measure, mi, part_id))
+            f_out = cStringIO.StringIO()
+            self.assertEqual(scatlava.MeasureStreamer(cStringIO.StringIO(score_xml), f_out, process_measure, chunk_size=100).run(), len(measures))
+            self.assertEqual(f_out.getvalue(), score_xml) # copied through as it was
+            part_ids = [part_id for part_id, start, end in parts for mi in xrange(start, end)]
+            for mi, (measure, streamed_mi, part_id) in enumerate(streamed):
+                self.assertEqual((streamed_mi, part_id), (mi, part_ids[mi]))
+                self.assertEqual(measure, measures[mi])
+                self.assertEqual(scatlava.get_measure_moves(measure), scatlava.get_measure_moves(measures[mi]))
+
+    def test_streamed_cli_output_is_the_same(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            for name in ['notationTest1.xml', 'multipart.xml']:
+                outputs = []
+                for stream in [[], ['-s']]:
+                    out_path = os.path.join(out_dir, 'out.xml')
+                    subprocess.check_call([sys.executable, os.path.join(tests_dir, '..', 'scatlava.py'), os.path.join(tests_dir, name), out_path, '-r', '3'] + stream, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+                    with open(out_path, 'rb') as f:
+                        outputs.append(f.read())
+                self.assertEqual(outputs[1], outputs[0])
+        finally:
+            shutil.rmtree(out_dir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+# Planning edits across a score: the target is met with edits spread over the bins
+
+import unittest
+
+import scatlava
+import scatlava_bench
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+def get_difficulty(values):
+    return scatlava.calculate_difficulty_from_values(values['density'], values['syncopation'], values['coordination'], weights)
+
+class PlanBinsTest(unittest.TestCase):
+    def setUp(self):
+        self.score = scatlava.ScatlavaEngine().load(scatlava_bench.generate_score(16, seed=1).encode('utf-8'), 4)
+        self.bins = [bin for bins in self.score.measure_bins for bin in bins]
+        scatlava.metrics.take_counts()
+
+    def plan(self, target_difficulty, budget=64):
+        return scatlava.plan_bins(self.bins, self.score.score_values, self.score.bin_durations, 4, target_difficulty, weights, budget)
+
+    def get_ratio(self, bins):
+        values = scatlava.analyze_bins(bins, self.score.bin_durations, 4)
+        return sum(get_difficulty(v) for v in values) / sum(get_difficulty(v) for v in self.score.score_values)
+
+    def test_reaches_the_target(self):
+        for target_difficulty in [0.5, 0.8]:
+            for budget in [4, 64]:
+                bins = self.plan(target_difficulty, budget)
+                self.assertAlmostEqual(self.get_ratio(bins), target_difficulty, delta=0.01)
+
+    def test_bins_passed_in_are_untouched(self):
+        layout = [[(note.onset, note.rest, note.instrument) for note in bin] for bin in self.bins]
+        bins = self.plan(0.5)
+        self.assertEqual([[(note.onset, note.rest, note.instrument) for note in bin] for bin in self.bins], layout)
+        self.assertTrue(any(bin is not orig_bin for bin, orig_bin in zip(bins, self.bins)))
+
+    def test_budget_caps_are_counted(self):
+        self.plan(0.5, 2)
+        counters = scatlava.metrics.take_counts()[0]
+        self.assertGreater(counters['iteration_cap_hits'], 0)
+        self.plan(0.5, 1000)
+        self.assertEqual(scatlava.metrics.take_counts()[0]['iteration_cap_hits'], 0)
+
+    def test_deterministic(self):
+        first, second = self.plan(0.5), self.plan(0.5)
+        self.assertEqual([bin.changes for bin in first], [bin.changes for bin in second])
+
+
+if __name__ == '__main__':
+    unittest.main()
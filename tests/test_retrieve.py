@@ -0,0 +1,82 @@
+# Retrieving bins from a corpus: retrieved notes are played on the part's instruments
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import scatlava
+import scatlava_bench
+import scatlava_index
+from tests.test_parse import tests_dir, read_fixture
+from tests.test_write import get_bin_layout
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+class RetrieveTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        paths = [os.path.join(tests_dir, name) for name in ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']]
+        for seed, density in enumerate([0., 0.1, 0.3]): # plain rhythms, easier than the fixtures
+            paths.append(os.path.join(cls.dir, 'synthetic{}.xml'.format(seed)))
+            with open(paths[-1], 'wb') as f:
+                f.write(scatlava_bench.generate_score(16, density=density, tuplet_ratio=0., seed=seed).encode('utf-8'))
+        cls.index_path = os.path.join(cls.dir, 'index.db')
+        index = scatlava_index.ScoreIndex(cls.index_path)
+        try:
+            index.ingest(paths, [1, 4], weights)
+        finally:
+            index.close()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def generate(self, name, target_difficulty=0.3):
+        engine = scatlava.ScatlavaEngine(bank=self.index_path)
+        session = engine.session(read_fixture(name), target_difficulty, weights, weights, seed=1, strategy='retrieve')
+        return session.score, session
+
+    def get_replaced(self, score, session):
+        return [(mi, bi) for mi, bins in enumerate(session.measure_bins) for bi, bin in enumerate(bins) if bin is not score.measure_bins[mi][bi] and any(change[0] == 'replace' for change in bin.changes)]
+
+    def test_retrieved_bins_only_play_the_bins_instruments(self):
+        for name in ['multivoice.xml', 'multipart.xml']:
+            score, session = self.generate(name)
+            replaced = self.get_replaced(score, session)
+            self.assertTrue(replaced)
+            for mi, bi in replaced:
+                instruments = set(note.instrument for note in score.measure_bins[mi][bi] if not note.rest)
+                self.assertTrue(set(note.instrument for note in session.measure_bins[mi][bi] if not note.rest) <= instruments)
+
+    def test_retrieved_notes_are_written_as_the_parts(self):
+        for name in ['multivoice.xml', 'multipart.xml']:
+            score, session = self.generate(name)
+            variant = session.variant()
+            measures = scatlava.parse_measures_at(variant, scatlava.get_measure_offsets(variant), session.measures)
+            for mi, measure in measures.items():
+                originals = dict((scatlava.get_instrument_id_for_note(note), note) for note in scatlava.get_measure_notes(score.measures[mi]) if 'unpitched' in note)
+                voices = set(note.get('voice') for note in scatlava.get_measure_notes(score.measures[mi]))
+                for note in scatlava.get_measure_notes(measure):
+                    self.assertIn(note.get('voice'), voices)
+                    if 'unpitched' in note:
+                        self.assertEqual(note.get('instrument'), originals[scatlava.get_instrument_id_for_note(note)].get('instrument'))
+            parsed = scatlava.ScatlavaEngine().load(variant)
+            self.assertEqual(get_bin_layout(parsed.measure_bins), get_bin_layout(session.measure_bins))
+
+    def test_part_attrs_only_fill_in_what_is_missing(self):
+        source = scatlava.collections.OrderedDict([('unpitched', {'display-step': 'C', 'display-octave': '5'}), ('duration', '256'), ('tie', {'@type': 'start'}), ('instrument', {'@id': 'P1-I1'}), ('stem', 'up')])
+        note = scatlava.Note(0, 256, scatlava.get_instrument_id_for_note(source), source=source)
+        written = note.to_dict(part_attrs={'instrument': {'@id': 'P1-I2'}, 'voice': '2'})
+        self.assertEqual(written.items()[1:], [('duration', '256'), ('tie', {'@type': 'start'}), ('instrument', {'@id': 'P1-I1'}), ('voice', '2'), ('stem', 'up')])
+
+    def test_edit_log_replays_retrieved_bins(self):
+        score, session = self.generate('multivoice.xml')
+        self.assertTrue(self.get_replaced(score, session))
+        edit_log = scatlava.EditLog.loads(session.edit_log().dumps())
+        self.assertEqual(edit_log.apply(read_fixture('multivoice.xml')), session.variant())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+# The HTTP service: storing, analyzing and generating, and errors as JSON
+
+import httplib
+import json
+import logging
+import threading
+import unittest
+
+import scatlava
+import scatlava_service
+from tests.test_parse import read_fixture
+
+# Partwise MusicXML that can be read but not analyzed
+unreadable_duration_xml = '<score-partwise><part id="P1"><measure number="1"><note><rest/><duration>x</duration></note></measure></part></score-partwise>'
+
+class ServiceTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.service = scatlava_service.ScatlavaService(jobs=1, queue_size=2, max_scores=4)
+        cls.server = scatlava_service.ScatlavaHTTPServer(('127.0.0.1', 0), scatlava_service.ScatlavaRequestHandler)
+        cls.server.service = cls.service
+        cls.thread = threading.Thread(target=cls.server.serve_forever)
+        cls.thread.daemon = True
+        cls.thread.start()
+        logging.getLogger('scatlava.service').setLevel(logging.CRITICAL)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        cls.service.close()
+
+    def request(self, method, path, body=None):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.server_address[1], timeout=60)
+        try:
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            return response.status, response.getheaders(), response.read()
+        finally:
+            connection.close()
+
+    def test_store_analyze_and_generate(self):
+        score_xml = read_fixture('notationTest1.xml')
+        status, headers, body = self.request('POST', '/scores', score_xml)
+        self.assertEqual(status, 201)
+        report = json.loads(body)
+        self.assertEqual(report['score'], scatlava_service.get_score_hash(score_xml))
+        self.assertAlmostEqual(report['overall_difficulty'], 0.213041666667, places=10)
+
+        status, headers, body = self.request('GET', '/scores/{}?bin_divisions=1'.format(report['score']))
+        self.assertEqual(status, 200)
+        self.assertAlmostEqual(json.loads(body)['overall_difficulty'], 0.497089646465, places=10)
+
+        status, headers, variant = self.request('POST', '/scores/{}/generate?seed=1&target_difficulty=0.3'.format(report['score']))
+        self.assertEqual(status, 200)
+        weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+        self.assertEqual(variant, scatlava.ScatlavaEngine().generate(score_xml, 0.3, weights, weights, seed=1)[0])
+
+    def test_unanalyzable_scores_are_not_stored(self):
+        stored = self.service.stats()['scores']
+        status, headers, body = self.request('POST', '/scores', unreadable_duration_xml)
+        self.assertEqual(status, 500)
+        self.assertEqual(dict(headers)['content-type'], 'application/json')
+        self.assertIn('error', json.loads(body))
+        self.assertEqual(self.service.stats()['scores'], stored)
+        status, headers, body = self.request('GET', '/scores/{}'.format(scatlava_service.get_score_hash(unreadable_duration_xml)))
+        self.assertEqual(status, 400)
+
+    def test_bad_requests(self):
+        self.assertEqual(self.request('POST', '/scores', 'not xml')[0], 400)
+        self.assertEqual(self.request('POST', '/scores', '<score-timewise/>')[0], 400)
+        self.assertEqual(self.request('GET', '/scores/nothing?bin_divisions=0')[0], 400)
+        self.assertEqual(self.request('POST', '/generate?strategy=retrieve', read_fixture('notationTest1.xml'))[0], 400)
+        self.assertEqual(self.request('GET', '/nowhere')[0], 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+# Sessions: updated totals agree with analyzing the variation from scratch
+
+import multiprocessing
+import shutil
+import tempfile
+import unittest
+
+import scatlava
+from tests.test_parse import read_fixture
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+gradients = {'d': 0.5, 's': 0.5, 'c': 0.5}
+
+class SessionTest(unittest.TestCase):
+    fixtures = ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']
+
+    def assert_report_matches_variant(self, session):
+        report = session.report()
+        analysis = scatlava.ScatlavaEngine().analyze(session.variant(), weights, session.score.bin_divisions)
+        self.assertAlmostEqual(report['new_overall_difficulty'], analysis['overall_difficulty'], places=10)
+        self.assertAlmostEqual(report['new_overall_difficulty_by_measure'], analysis['overall_difficulty_by_measure'], places=10)
+        for part_report, part_analysis in zip(report['parts'], analysis['parts']):
+            self.assertAlmostEqual(part_report['new_overall_difficulty'], part_analysis['overall_difficulty'], places=10)
+            self.assertAlmostEqual(part_report['new_overall_difficulty_by_measure'], part_analysis['overall_difficulty_by_measure'], places=10)
+        for difficulty, measure_difficulty in zip(session.measure_difficulties(), analysis['measure_difficulties']):
+            self.assertAlmostEqual(difficulty, measure_difficulty, places=10)
+
+    def test_report_after_updates(self):
+        for name in self.fixtures:
+            for strategy in ['stochastic', 'greedy', 'plan']:
+                engine = scatlava.ScatlavaEngine()
+                session = engine.session(read_fixture(name), 0.5, weights, gradients, 0.7, seed=4, strategy=strategy)
+                self.assert_report_matches_variant(session)
+                self.assertEqual(session.update({0: 0.2}), [0])
+                self.assert_report_matches_variant(session)
+                session.update({(1, 2): 0.1}, {1: {'d': 0.9, 's': 0.1, 'c': 0.1}})
+                self.assert_report_matches_variant(session)
+                session.update({0: 1, 1: 1, (1, 2): 1}, {1: gradients})
+                self.assert_report_matches_variant(session)
+
+    def test_update_regenerates_from_the_original(self):
+        engine = scatlava.ScatlavaEngine()
+        score_xml = read_fixture('multipart.xml')
+        session = engine.session(score_xml, 0.5, weights, gradients, seed=2)
+        session.update({2: 0.1})
+        session.update({2: 0.5})
+        self.assertEqual(session.variant(), engine.session(score_xml, 0.5, weights, gradients, seed=2).variant())
+        self.assertEqual(session.update({2: 0.5}), [])
+
+    def test_process_pool(self):
+        engine = scatlava.ScatlavaEngine()
+        pool = multiprocessing.Pool(2)
+        try:
+            for strategy in ['stochastic', 'plan']:
+                score = engine.load(read_fixture('multipart.xml'))
+                session = scatlava.ScatlavaSession(score, 0.5, weights, gradients, seed=3, strategy=strategy, map_tasks=pool.map)
+                self.assertEqual(session.variant(), scatlava.ScatlavaSession(score, 0.5, weights, gradients, seed=3, strategy=strategy).variant())
+        finally:
+            pool.close()
+            pool.join()
+
+    @unittest.skipIf(scatlava.np is None, 'snapshots need numpy')
+    def test_scores_from_snapshots(self):
+        snapshot_dir = tempfile.mkdtemp()
+        try:
+            for name in self.fixtures:
+                score_xml = read_fixture(name)
+                score = scatlava.ScatlavaEngine().load(score_xml)
+                store = scatlava.SnapshotStore(snapshot_dir)
+                store.put(score.score_hash, score_xml, score.measures, score.parts, scatlava.ScoreLevels(score.measures, [1, 4], meter=score.meters))
+                snapshot = store.get(score.score_hash)
+                snapshot_score = scatlava.AnalyzedScore(score.score_hash, score_xml, None, snapshot.parts, snapshot.meters, snapshot.get_bins(4), snapshot.bin_durations[4], 4, snapshot.get_values(1), snapshot.get_values(4))
+                sessions = [scatlava.ScatlavaSession(analyzed_score, 0.5, weights, gradients, seed=5) for analyzed_score in [score, snapshot_score]]
+                self.assertEqual(sessions[1].variant(), sessions[0].variant())
+                for session in sessions:
+                    session.update({0: 0.1, 1: 0.5})
+                self.assertEqual(sessions[1].variant(), sessions[0].variant())
+                self.assert_report_matches_variant(sessions[1])
+        finally:
+            shutil.rmtree(snapshot_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+# Splicing variations into the score: only generated measures are written anew, and
+# they parse back into the bins they were generated as
+
+import unittest
+
+import scatlava
+from tests.test_parse import read_fixture
+from tests.test_write import get_bin_layout
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+class SpliceTest(unittest.TestCase):
+    fixtures = ['notationTest1.xml', 'multivoice.xml', 'multipart.xml']
+
+    def generate(self, name, seed, bin_divisions=4):
+        score = scatlava.ScatlavaEngine().load(read_fixture(name), bin_divisions)
+        session = scatlava.ScatlavaSession(score, 0.3, weights, {'d': 0.5, 's': 0.5, 'c': 0.5}, 0.7, seed=seed)
+        return score, session
+
+    def test_spliced_measures_parse_into_the_generated_bins(self):
+        for name in self.fixtures:
+            for seed in [1, 2, 3]:
+                score, session = self.generate(name, seed)
+                self.assertTrue(session.measures)
+                variant = session.variant()
+                offsets = scatlava.get_measure_offsets(variant)
+                measures = scatlava.parse_measures_at(variant, offsets, session.measures)
+                for mi, measure in measures.items():
+                    bins = scatlava.bin_measure(measure, 4, meter=score.meters[mi])[0]
+                    self.assertEqual(get_bin_layout([bins]), get_bin_layout([session.measure_bins[mi]]))
+
+    def test_report_matches_analysis_of_the_variant(self):
+        for name in self.fixtures:
+            for seed in [1, 2, 3]:
+                for bin_divisions in [1, 4]:
+                    score, session = self.generate(name, seed, bin_divisions)
+                    report = session.report()
+                    analysis = scatlava.ScatlavaEngine().analyze(session.variant(), weights, bin_divisions)
+                    self.assertAlmostEqual(report['new_overall_difficulty'], analysis['overall_difficulty'], places=10)
+                    self.assertAlmostEqual(report['new_overall_difficulty_by_measure'], analysis['overall_difficulty_by_measure'], places=10)
+
+    def test_unchanged_measures_are_copied(self):
+        score_xml = read_fixture('multipart.xml')
+        score, session = self.generate('multipart.xml', 1)
+        variant = session.variant()
+        offsets, new_offsets = scatlava.get_measure_offsets(score_xml), scatlava.get_measure_offsets(variant)
+        self.assertEqual(len(new_offsets), len(offsets))
+        for mi, ((start, end), (new_start, new_end)) in enumerate(zip(offsets, new_offsets)):
+            if mi not in session.measures:
+                self.assertEqual(variant[new_start:new_end], score_xml[start:end])
+        self.assertEqual(score.splice({}), score_xml)
+
+
+if __name__ == '__main__':
+    unittest.main()
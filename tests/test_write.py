@@ -0,0 +1,120 @@
+# Writing variations: adjusted bins written back as MusicXML parse into the same bins
+
+import unittest
+
+import scatlava
+from tests.test_parse import read_fixture, make_note
+
+weights = {'d': 0.33, 's': 0.33, 'c': 0.34}
+
+# Notes of every bin of a score, in order, as (duration, instrument name, rest, index of
+# its chord in the bin)
+def get_bin_layout(measure_bins):
+    layout = []
+    for bins in measure_bins:
+        for bin in bins:
+            chords = {}
+            layout.append([(note.duration, scatlava.instrument_names[note.instrument], note.rest, chords.setdefault(note.chord, len(chords))) for note in bin])
+    return layout
+
+class RoundTripTest(unittest.TestCase):
+    fixtures = ['notationTest1.xml', 'multivoice.xml']
+
+    def assert_round_trip(self, name, bin_divisions, **kwargs):
+        engine = scatlava.ScatlavaEngine()
+        score = engine.load(read_fixture(name), bin_divisions)
+        session = scatlava.ScatlavaSession(score, 0.3, weights, {'d': 0.5, 's': 0.5, 'c': 0.5}, 0.7, **kwargs)
+        variant = session.variant()
+        parsed = scatlava.ScatlavaEngine().load(variant, bin_divisions)
+        self.assertEqual(get_bin_layout(parsed.measure_bins), get_bin_layout(session.measure_bins))
+        self.assertEqual(parsed.score_values, session.score_values)
+
+    def test_stochastic(self):
+        for name in self.fixtures:
+            for seed in [1, 2, 3, 4, 5]:
+                for bin_divisions in [1, 2, 4]:
+                    self.assert_round_trip(name, bin_divisions, seed=seed)
+
+    def test_search(self):
+        for name in self.fixtures:
+            for strategy in ['greedy', 'beam', 'plan']:
+                self.assert_round_trip(name, 4, strategy=strategy)
+
+    def test_generated_is_deterministic(self):
+        engine = scatlava.ScatlavaEngine()
+        score_xml = read_fixture('multivoice.xml')
+        variant, report = engine.generate(score_xml, 0.3, weights, weights, seed=3)
+        self.assertEqual(engine.generate(score_xml, 0.3, weights, weights, seed=3), (variant, report))
+
+class SetMeasureBinsTest(unittest.TestCase):
+    def write_notes(self, notes, bin_divisions=4):
+        measure = scatlava.collections.OrderedDict([('note', notes)])
+        bins, bin_durations = scatlava.bin_measure(measure, bin_divisions)
+        return measure, bins
+
+    def test_chord_flags_follow_the_order(self):
+        measure, bins = self.write_notes([make_note('C', 128), make_note('G', 128, chord=True), make_note('A', 128)])
+        bins[0].swap_notes(0, 1) # the G now leads the chord
+        scatlava.set_measure_bins(measure, bins)
+        self.assertEqual([(note['unpitched']['display-step'], 'chord' in note) for note in measure['note']], [('G', False), ('C', True), ('A', False)])
+
+        reparsed = scatlava.bin_measure(measure, 4)[0]
+        self.assertEqual([(note.onset, note.chord) for note in reparsed[0]], [(0, 0), (0, 0), (128, 1)])
+
+    def test_chord_notes_without_a_voice(self):
+        notes = [make_note('C', 128), make_note('G', 128, chord=True), make_note('A', 128)]
+        notes[0]['voice'] = notes[2]['voice'] = '1' # as in notationTest1.xml, <chord/> notes have no <voice>
+        measure, bins = self.write_notes(notes)
+        scatlava.set_measure_bins(measure, bins)
+        self.assertEqual(['chord' in note for note in measure['note']], [False, True, False])
+        self.assertEqual(scatlava.get_measure_moves(measure), [])
+        self.assertNotIn('<backup>', scatlava.unparse_measure(measure))
+
+    def test_removed_chord_head(self):
+        measure, bins = self.write_notes([make_note('C', 128), make_note('G', 128, chord=True), make_note('A', 128)])
+        bins[0].remove_note(0)
+        scatlava.set_measure_bins(measure, bins)
+        self.assertEqual(['chord' in note for note in measure['note']], [False, False])
+        self.assertEqual([note.onset for note in scatlava.bin_measure(measure, 4)[0][0]], [0, 128])
+
+    def test_first_onset_moves_with_its_chord(self):
+        measure, bins = self.write_notes([make_note(None, 64), make_note('C', 64), make_note('G', 64, chord=True), make_note('A', 128)])
+        scatlava.move_first_onset(bins[0])
+        self.assertEqual([note.rest for note in bins[0]], [False, False, True, False])
+        self.assertEqual([note.onset for note in bins[0]], [0, 0, 64, 128])
+        scatlava.set_measure_bins(measure, bins)
+        self.assertEqual(get_bin_layout([scatlava.bin_measure(measure, 4)[0]]), get_bin_layout([bins]))
+
+    def test_only_moved_notes_lose_their_beams(self):
+        measure, bins = self.write_notes([make_note(None, 64), make_note('C', 64), make_note('A', 128), make_note('G', 256)])
+        measure['note'][1]['beam'] = 'begin'
+        measure['note'][2]['beam'] = 'end'
+        scatlava.move_first_onset(bins[1]) # already starts with an onset
+        self.assertEqual(bins[1].changes, [])
+        scatlava.move_first_onset(bins[0])
+        scatlava.set_measure_bins(measure, bins)
+        self.assertEqual([(note.get('unpitched', {}).get('display-step'), note.get('beam')) for note in measure['note']], [('C', None), (None, None), ('A', 'end'), ('G', None)])
+        self.assertNotIn('<beam', scatlava.unparse_measure(measure).replace('<beam>end</beam>', ''))
+
+    def test_gaps_are_written_as_forward(self):
+        measure, bins = self.write_notes([make_note('C', 256), make_note('G', 256), make_note('A', 512)])
+        bins[1].remove_note(0)
+        scatlava.set_measure_bins(measure, bins)
+        self.assertEqual(scatlava.get_measure_moves(measure), [(1, 256)])
+        self.assertIn('<forward>', scatlava.unparse_measure(measure))
+
+        reparsed = scatlava.bin_measure(scatlava.parse_musicxml(scatlava.unparse_measure(measure))['measure'], 4)[0]
+        self.assertEqual([[note.onset for note in bin] for bin in reparsed], [[0], [], [512], []])
+
+    def test_unchanged_measure_is_written_as_it_was(self):
+        measures, parts = scatlava.get_score_measures(scatlava.parse_musicxml(read_fixture('multivoice.xml')))
+        for measure in measures:
+            bins = scatlava.bin_measure(measure, 4)[0]
+            scatlava.set_measure_bins(measure, bins)
+            reparsed = scatlava.bin_measure(scatlava.parse_musicxml(scatlava.unparse_measure(measure))['measure'], 4)[0]
+            self.assertEqual(get_bin_layout([reparsed]), get_bin_layout([bins]))
+            self.assertEqual([[note.onset for note in bin] for bin in reparsed], [[note.onset for note in bin] for bin in bins])
+
+
+if __name__ == '__main__':
+    unittest.main()